@@ -0,0 +1,72 @@
+"""Benchmark the hit latency of the PersistentCache with growing cache size.
+
+Example:
+    python benchmarks/cache_benchmark.py --backend lmdb --sizes 1000 10000 100000 1000000 10000000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from flexrag.cache import LMDBBackendConfig, PersistentCache, PersistentCacheConfig
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["lmdb", "dict"], default="lmdb")
+    parser.add_argument("--evict_order", choices=["LRU", "LFU", "FIFO"], default="LRU")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000, 1000000, 10000000],
+    )
+    parser.add_argument("--num_queries", type=int, default=1000)
+    parser.add_argument("--fill_batch_size", type=int, default=10000)
+    parser.add_argument("--value_size", type=int, default=1024)
+    parser.add_argument("--map_size", type=int, default=512 * 1024**3)
+    parser.add_argument("--db_path", type=str, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(dir=args.db_path) as tmpdir:
+        cache = PersistentCache(
+            PersistentCacheConfig(
+                backend=args.backend,
+                maxsize=max(args.sizes),
+                evict_order=args.evict_order,
+                lmdb_config=LMDBBackendConfig(
+                    db_path=os.path.join(tmpdir, "cache.lmdb"),
+                    map_size=args.map_size,
+                ),
+            )
+        )
+        value = "x" * args.value_size
+        print(f"{'size':>10} | {'fill time':>10} | {'p50 (us)':>10} | {'p99 (us)':>10}")
+        for size in sorted(args.sizes):
+            # fill the cache
+            start_time = perf_counter()
+            for i in range(len(cache), size, args.fill_batch_size):
+                indices = range(i, min(i + args.fill_batch_size, size))
+                cache.set_many([f"key-{j}" for j in indices], [value] * len(indices))
+            fill_time = perf_counter() - start_time
+
+            # measure the hit latency
+            latencies = []
+            for i in random.choices(range(size), k=args.num_queries):
+                start_time = perf_counter()
+                _ = cache[f"key-{i}"]
+                latencies.append((perf_counter() - start_time) * 1e6)
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print(f"{size:>10} | {fill_time:>9.1f}s | {p50:>10.1f} | {p99:>10.1f}")
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
@@ -25,6 +26,30 @@ class AssistantBase(ABC):
         """
         return
 
+    def answer_batch(
+        self, questions: list[str]
+    ) -> list[tuple[str, Optional[list[RetrievedContext]], Optional[dict]]]:
+        """Answer a batch of questions.
+        The default implementation answers the questions one by one.
+        Subclasses could override this method to process the batch at once.
+
+        Args:
+            questions (list[str]): The questions to answer.
+
+        Returns:
+            list[tuple[str, Optional[list[RetrievedContext]], Optional[dict]]]:
+                The (response, contexts, metadata) tuple for each question, in the same order as `questions`.
+        """
+        return [self.answer(question) for question in questions]
+
+    async def async_answer(
+        self, question: str
+    ) -> tuple[str, Optional[list[RetrievedContext]], Optional[dict]]:
+        """The asynchronous version of `answer`.
+        The default implementation runs `answer` in a separate thread.
+        """
+        return await asyncio.to_thread(self.answer, question)
+
 
 @dataclass
 class SearchHistory:
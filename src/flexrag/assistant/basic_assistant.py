@@ -57,22 +57,64 @@ class BasicAssistant(AssistantBase):
             None: No contexts are used by the basic assistant.
             metadata (Optional[dict]): The chatprompt used by the assistant.
         """
+        prompt = self.get_prompt(question)
+
+        # generate response
+        response = self.generator.chat([prompt], generation_config=self.gen_cfg)[0][0]
+
+        # update history prompt
+        self.update_history(question, response)
+        return response, None, {"prompt": prompt}
+
+    def answer_batch(
+        self, questions: list[str]
+    ) -> list[tuple[str, None, dict[str, ChatPrompt]]]:
+        """Answer a batch of questions with a single call to the generator.
+        If `use_history` is enabled, the questions are answered one by one,
+        as each question depends on the responses to the previous ones.
+
+        Args:
+            questions (list[str]): The questions to answer.
+
+        Returns:
+            list[tuple[str, None, dict[str, ChatPrompt]]]:
+                The (response, None, metadata) tuple for each question, in the same order as `questions`.
+        """
+        if self.history_prompt is not None:
+            return super().answer_batch(questions)
+        prompts = [self.get_prompt(question) for question in questions]
+        responses = self.generator.chat(prompts, generation_config=self.gen_cfg)
+        return [
+            (response[0], None, {"prompt": prompt})
+            for response, prompt in zip(responses, prompts)
+        ]
+
+    async def async_answer(
+        self, question: str
+    ) -> tuple[str, None, dict[str, ChatPrompt]]:
+        """The asynchronous version of `answer`."""
+        prompt = self.get_prompt(question)
+        response = await self.generator.async_chat(
+            [prompt], generation_config=self.gen_cfg
+        )
+        response = response[0][0]
+        self.update_history(question, response)
+        return response, None, {"prompt": prompt}
+
+    def get_prompt(self, question: str) -> ChatPrompt:
         # prepare system prompt
         if self.history_prompt is not None:
             prompt = deepcopy(self.history_prompt)
         else:
             prompt = deepcopy(self.prompt)
-
         prompt.update(ChatTurn(role="user", content=question))
+        return prompt
 
-        # generate response
-        response = self.generator.chat([prompt], generation_config=self.gen_cfg)[0][0]
-
-        # update history prompt
+    def update_history(self, question: str, response: str) -> None:
         if self.history_prompt is not None:
             self.history_prompt.update(ChatTurn(role="user", content=question))
             self.history_prompt.update(ChatTurn(role="assistant", content=response))
-        return response, None, {"prompt": prompt}
+        return
 
     def clear_history(self) -> None:
         if self.history_prompt is not None:
@@ -37,6 +37,24 @@ class ChatQAAssistant(ModularAssistant):
         response = self.generator.generate([prefix], generation_config=self.gen_cfg)
         return response[0][0], prefix
 
+    async def async_answer_with_contexts(
+        self, question: str, contexts: list[RetrievedContext]
+    ) -> tuple[str, str]:
+        prefix = self.get_formatted_input(question, contexts)
+        response = await self.generator.async_generate(
+            [prefix], generation_config=self.gen_cfg
+        )
+        return response[0][0], prefix
+
+    def answer_with_contexts_batch(
+        self, questions: list[str], contexts: list[list[RetrievedContext]]
+    ) -> tuple[list[str], list[str]]:
+        prefixes = [
+            self.get_formatted_input(q, ctxs) for q, ctxs in zip(questions, contexts)
+        ]
+        responses = self.generator.generate(prefixes, generation_config=self.gen_cfg)
+        return [r[0] for r in responses], prefixes
+
     def get_formatted_input(
         self, question: str, contexts: list[RetrievedContext]
     ) -> str:
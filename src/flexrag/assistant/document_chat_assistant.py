@@ -76,8 +76,7 @@ class DocumentChatAssistant(AssistantBase):
     ) -> tuple[str, list[RetrievedContext], dict[str, Any]]:
         # answer without contexts
         if len(self.retriever) == 0:
-            prompt = ChatPrompt()
-            prompt.update(ChatTurn(role="user", content=question))
+            prompt = self.get_prompt(question, [])
             response = self.generator.chat([prompt], generation_config=self.gen_cfg)
             return response[0][0], [], {"prompt": prompt}
 
@@ -90,7 +89,61 @@ class DocumentChatAssistant(AssistantBase):
         else:
             contexts = retrieved_contexts
 
-        # prepare prompt
+        # generate response
+        prompt = self.get_prompt(question, contexts)
+        response = self.generator.chat([prompt], generation_config=self.gen_cfg)[0][0]
+        return response, contexts, {"prompt": prompt}
+
+    def answer_batch(
+        self, questions: list[str]
+    ) -> list[tuple[str, list[RetrievedContext], dict[str, Any]]]:
+        # retrieve
+        if len(self.retriever) == 0:
+            contexts = [[] for _ in questions]
+        else:
+            contexts = self.retriever.search(questions)
+
+        # rerank
+        if (self.reranker is not None) and (len(self.retriever) > 0):
+            results = self.reranker.rank_batch(questions, contexts)
+            contexts = [r.candidates for r in results]
+
+        # generate responses
+        prompts = [self.get_prompt(q, ctxs) for q, ctxs in zip(questions, contexts)]
+        responses = self.generator.chat(prompts, generation_config=self.gen_cfg)
+        return [
+            (response[0], ctxs, {"prompt": prompt})
+            for response, ctxs, prompt in zip(responses, contexts, prompts)
+        ]
+
+    async def async_answer(
+        self, question: str
+    ) -> tuple[str, list[RetrievedContext], dict[str, Any]]:
+        # retrieve
+        if len(self.retriever) == 0:
+            contexts = []
+        else:
+            contexts = (await self.retriever.async_search([question]))[0]
+
+        # rerank
+        if (self.reranker is not None) and (len(contexts) > 0):
+            contexts = (await self.reranker.async_rank(question, contexts)).candidates
+
+        # generate response
+        prompt = self.get_prompt(question, contexts)
+        response = await self.generator.async_chat(
+            [prompt], generation_config=self.gen_cfg
+        )
+        return response[0][0], contexts, {"prompt": prompt}
+
+    def get_prompt(self, question: str, contexts: list[RetrievedContext]) -> ChatPrompt:
+        # prompt without contexts
+        if len(contexts) == 0:
+            prompt = ChatPrompt()
+            prompt.update(ChatTurn(role="user", content=question))
+            return prompt
+
+        # prompt with contexts
         prompt = ChatPrompt(
             system="Answer the user question based on the given contexts."
         )
@@ -102,7 +155,4 @@ class DocumentChatAssistant(AssistantBase):
             usr_prompt += f"Context {n + 1}: {ctx}\n\n"
         usr_prompt += f"Question: {question}"
         prompt.update(ChatTurn(role="user", content=usr_prompt))
-
-        # generate response
-        response = self.generator.chat([prompt], generation_config=self.gen_cfg)[0][0]
-        return response, contexts, {"prompt": prompt}
+        return prompt
@@ -90,6 +90,40 @@ class ModularAssistant(AssistantBase):
         response, prompt = self.answer_with_contexts(question, ctxs)
         return response, ctxs, {"prompt": prompt, "search_histories": history}
 
+    def answer_batch(
+        self, questions: list[str]
+    ) -> list[tuple[str, list[RetrievedContext], dict[str, Any]]]:
+        """Answer a batch of questions.
+        The retriever and the generator are called once for the whole batch,
+        while the reranker ranks the candidates of all questions through `rank_batch`.
+
+        Args:
+            questions (list[str]): The questions to answer.
+
+        Returns:
+            list[tuple[str, list[RetrievedContext], dict[str, Any]]]:
+                The (response, contexts, metadata) tuple for each question, in the same order as `questions`.
+        """
+        ctxs_batch, histories = self.search_batch(questions)
+        responses, prompts = self.answer_with_contexts_batch(questions, ctxs_batch)
+        return [
+            (response, ctxs, {"prompt": prompt, "search_histories": history})
+            for response, ctxs, prompt, history in zip(
+                responses, ctxs_batch, prompts, histories
+            )
+        ]
+
+    async def async_answer(
+        self, question: str
+    ) -> tuple[str, list[RetrievedContext], dict[str, Any]]:
+        """The asynchronous version of `answer`.
+        The retriever, the reranker and the generator are awaited through their asynchronous interfaces,
+        so that multiple questions could be answered concurrently.
+        """
+        ctxs, history = await self.async_search(question)
+        response, prompt = await self.async_answer_with_contexts(question, ctxs)
+        return response, ctxs, {"prompt": prompt, "search_histories": history}
+
     def search(
         self, question: str
     ) -> tuple[list[RetrievedContext], list[SearchHistory]]:
@@ -113,9 +147,85 @@ class ModularAssistant(AssistantBase):
 
         return ctxs, search_histories
 
+    def search_batch(
+        self, questions: list[str]
+    ) -> tuple[list[list[RetrievedContext]], list[list[SearchHistory]]]:
+        if self.retriever is None:
+            return [[] for _ in questions], [[] for _ in questions]
+        # searching for contexts
+        ctxs_batch = self.retriever.search(query=questions)
+        search_histories = [
+            [SearchHistory(query=q, contexts=ctxs)]
+            for q, ctxs in zip(questions, ctxs_batch)
+        ]
+
+        # reranking
+        if self.reranker is not None:
+            results = self.reranker.rank_batch(questions, ctxs_batch)
+            ctxs_batch = [result.candidates for result in results]
+            for q, ctxs, history in zip(questions, ctxs_batch, search_histories):
+                history.append(SearchHistory(query=q, contexts=ctxs))
+
+        # packing
+        for n, (q, ctxs) in enumerate(zip(questions, ctxs_batch)):
+            if len(ctxs) > 1:
+                ctxs_batch[n] = self.context_packer.refine(ctxs)
+                search_histories[n].append(
+                    SearchHistory(query=q, contexts=ctxs_batch[n])
+                )
+        return ctxs_batch, search_histories
+
+    async def async_search(
+        self, question: str
+    ) -> tuple[list[RetrievedContext], list[SearchHistory]]:
+        """The asynchronous version of `search`."""
+        if self.retriever is None:
+            return [], []
+        # searching for contexts
+        search_histories = []
+        ctxs = (await self.retriever.async_search(query=[question]))[0]
+        search_histories.append(SearchHistory(query=question, contexts=ctxs))
+
+        # reranking
+        if self.reranker is not None:
+            results = await self.reranker.async_rank(question, ctxs)
+            ctxs = results.candidates
+            search_histories.append(SearchHistory(query=question, contexts=ctxs))
+
+        # packing
+        if len(ctxs) > 1:
+            ctxs = self.context_packer.refine(ctxs)
+            search_histories.append(SearchHistory(query=question, contexts=ctxs))
+
+        return ctxs, search_histories
+
     def answer_with_contexts(
         self, question: str, contexts: list[RetrievedContext] = []
     ) -> tuple[str, ChatPrompt]:
+        prompt = self.get_prompt(question, contexts)
+        response = self.generator.chat([prompt], generation_config=self.gen_cfg)[0][0]
+        return response, prompt
+
+    async def async_answer_with_contexts(
+        self, question: str, contexts: list[RetrievedContext] = []
+    ) -> tuple[str, ChatPrompt]:
+        """The asynchronous version of `answer_with_contexts`."""
+        prompt = self.get_prompt(question, contexts)
+        response = await self.generator.async_chat(
+            [prompt], generation_config=self.gen_cfg
+        )
+        return response[0][0], prompt
+
+    def answer_with_contexts_batch(
+        self, questions: list[str], contexts: list[list[RetrievedContext]]
+    ) -> tuple[list[str], list[ChatPrompt]]:
+        prompts = [self.get_prompt(q, ctxs) for q, ctxs in zip(questions, contexts)]
+        responses = self.generator.chat(prompts, generation_config=self.gen_cfg)
+        return [r[0] for r in responses], prompts
+
+    def get_prompt(
+        self, question: str, contexts: list[RetrievedContext] = []
+    ) -> ChatPrompt:
         # prepare system prompts
         if len(contexts) > 0:
             prompt = deepcopy(self.prompt_with_ctx)
@@ -138,7 +248,4 @@ class ModularAssistant(AssistantBase):
             usr_prompt += f"Context {n + 1}: {ctx}\n\n"
         usr_prompt += f"Question: {question}"
         prompt.update(ChatTurn(role="user", content=usr_prompt))
-
-        # generate response
-        response = self.generator.chat([prompt], generation_config=self.gen_cfg)[0][0]
-        return response, prompt
+        return prompt
@@ -1,4 +1,5 @@
 from .backends import ShelveBackendConfig, LMDBBackendConfig
+from .identity import NON_IDENTITY_KEYS, strip_identity
 from .persistent_cache import PersistentCacheConfig, PersistentCache
 
 
@@ -7,4 +8,6 @@ __all__ = [
     "LMDBBackendConfig",
     "PersistentCacheConfig",
     "PersistentCache",
+    "NON_IDENTITY_KEYS",
+    "strip_identity",
 ]
@@ -3,10 +3,12 @@ import json
 import os
 import pickle
 import shelve
+import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass, field
 from hashlib import blake2b
-from typing import Any, MutableMapping
+from typing import Any, ContextManager, Iterable, MutableMapping
 
 import lmdb
 from omegaconf import MISSING
@@ -82,14 +84,73 @@ class MsgpackSerializer(Serializer):
 class LMDBBackendConfig:
     db_path: str = MISSING
     serializer: Choices(["pickle", "json", "msgpack", "cloudpickle"]) = "pickle"  # type: ignore
+    map_size: int = 10485760  # the maximum size of the database in bytes
+
+
+class PersistentBackendBase(MutableMapping):
+    """The base class of the persistent backends.
+    Besides the `MutableMapping` interface, the backends support batched operations,
+    which are performed in a single transaction.
+    """
+
+    def transaction(self, write: bool = False) -> ContextManager:
+        """Return a context manager in which all the operations share a single transaction.
+        Nested transactions reuse the outermost one,
+        thus a write transaction can not be nested in a read-only transaction.
+
+        :param write: Whether the transaction will modify the backend, defaults to False.
+        :type write: bool, optional
+        :return: The context manager.
+        :rtype: ContextManager
+        """
+        return nullcontext()
+
+    def get_many(self, keys: Iterable[Any], default: Any = None) -> list[Any]:
+        """Get the values of the given keys in a single transaction.
+
+        :param keys: The keys to get.
+        :type keys: Iterable[Any]
+        :param default: The value to return for the missing keys, defaults to None.
+        :type default: Any, optional
+        :return: The values of the keys.
+        :rtype: list[Any]
+        """
+        with self.transaction():
+            return [self.get(key, default) for key in keys]
+
+    def set_many(self, keys: Iterable[Any], values: Iterable[Any]) -> None:
+        """Set the values of the given keys in a single transaction.
+
+        :param keys: The keys to set.
+        :type keys: Iterable[Any]
+        :param values: The values to set.
+        :type values: Iterable[Any]
+        :return: None
+        """
+        with self.transaction(write=True):
+            for key, value in zip(keys, values):
+                self[key] = value
+        return
+
+    def delete_many(self, keys: Iterable[Any]) -> None:
+        """Delete the given keys in a single transaction. Missing keys are ignored.
+
+        :param keys: The keys to delete.
+        :type keys: Iterable[Any]
+        :return: None
+        """
+        with self.transaction(write=True):
+            for key in keys:
+                self.pop(key, None)
+        return
 
 
-class LMDBBackend(MutableMapping):
+class LMDBBackend(PersistentBackendBase):
     def __init__(self, cfg: LMDBBackendConfig) -> None:
         self.db_path = cfg.db_path
         if not os.path.exists(os.path.dirname(cfg.db_path)):
             os.makedirs(os.path.dirname(cfg.db_path), exist_ok=True)
-        self.database = lmdb.open(cfg.db_path)
+        self.database = lmdb.open(cfg.db_path, map_size=cfg.map_size)
         atexit.register(self.database.close)
         match cfg.serializer:
             case "pickle":
@@ -102,10 +163,39 @@ class LMDBBackend(MutableMapping):
                 self.serializer = CloudPickleSerializer()
             case _:
                 raise ValueError(f"Invalid serializer: {cfg.serializer}")
+        self._local = threading.local()
+        return
+
+    @contextmanager
+    def transaction(self, write: bool = False):
+        with self._begin(write=write) as txn:
+            outer_txn = getattr(self._local, "txn", None)
+            outer_write = getattr(self._local, "write", False)
+            self._local.txn = txn
+            self._local.write = write or outer_write
+            try:
+                yield txn
+            finally:
+                self._local.txn = outer_txn
+                self._local.write = outer_write
+        return
+
+    @contextmanager
+    def _begin(self, write: bool = False):
+        txn = getattr(self._local, "txn", None)
+        if txn is not None:
+            if write and not self._local.write:
+                raise RuntimeError(
+                    "Can not write in the outer read-only transaction."
+                )
+            yield txn
+            return
+        with self.database.begin(write=write) as txn:
+            yield txn
         return
 
     def __getitem__(self, key: Any) -> Any:
-        with self.database.begin() as txn:
+        with self._begin() as txn:
             hashed_key = blake2b(self.serializer.serialize(key)).digest()
             data = txn.get(hashed_key)
         if data is None:
@@ -114,32 +204,39 @@ class LMDBBackend(MutableMapping):
 
     def __setitem__(self, key: Any, value: Any) -> None:
         hashed_key = blake2b(self.serializer.serialize(key)).digest()
-        with self.database.begin(write=True) as txn:
+        with self._begin(write=True) as txn:
             txn.put(hashed_key, self.serializer.serialize((key, value)))
         return
 
     def __delitem__(self, key: Any) -> None:
         hashed_key = blake2b(self.serializer.serialize(key)).digest()
-        with self.database.begin(write=True) as txn:
+        with self._begin(write=True) as txn:
             txn.delete(hashed_key)
         return
 
     def __contains__(self, key: Any) -> bool:
         hashed_key = blake2b(self.serializer.serialize(key)).digest()
-        with self.database.begin() as txn:
+        with self._begin() as txn:
             return txn.get(hashed_key) is not None
 
     def __len__(self) -> int:
-        with self.database.begin() as txn:
+        with self._begin() as txn:
             return txn.stat()["entries"]
 
     def __iter__(self):
-        with self.database.begin() as txn:
+        with self._begin() as txn:
             cursor = txn.cursor()
             for _, kv_bytes in cursor:
                 yield self.serializer.deserialize(kv_bytes)[0]
         return
 
+    def delete_many(self, keys: Iterable[Any]) -> None:
+        # deleting a missing key is a no-op in LMDB
+        with self.transaction(write=True):
+            for key in keys:
+                del self[key]
+        return
+
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(db_path={self.db_path}, len={len(self)})"
 
@@ -150,42 +247,64 @@ class ShelveBackendConfig:
     protocal: int = pickle.DEFAULT_PROTOCOL
 
 
-class ShelveBackend(MutableMapping):
+class ShelveBackend(PersistentBackendBase):
     def __init__(self, cfg: ShelveBackendConfig) -> None:
         if not os.path.exists(cfg.db_path):
             os.makedirs(cfg.db_path, exist_ok=True)
         self.db_path = os.path.join(cfg.db_path, "cache")
         self.protocal = cfg.protocal
+        self._local = threading.local()
+        return
+
+    @contextmanager
+    def transaction(self, write: bool = False):
+        with self._open() as database:
+            outer_database = getattr(self._local, "database", None)
+            self._local.database = database
+            try:
+                yield database
+            finally:
+                self._local.database = outer_database
+        return
+
+    @contextmanager
+    def _open(self):
+        database = getattr(self._local, "database", None)
+        if database is not None:
+            yield database
+            return
+        with shelve.open(self.db_path, protocol=self.protocal) as database:
+            yield database
         return
 
     def __getitem__(self, key: Any) -> Any:
         key_ = json.dumps(key)
-        with shelve.open(self.db_path, protocol=self.protocal) as database:
+        with self._open() as database:
             return database[key_]
 
     def __setitem__(self, key: Any, value: Any) -> None:
         key_ = json.dumps(key)
-        with shelve.open(self.db_path, protocol=self.protocal) as database:
+        with self._open() as database:
             database[key_] = value
         return
 
     def __delitem__(self, key: Any) -> None:
         key_ = json.dumps(key)
-        with shelve.open(self.db_path, protocol=self.protocal) as database:
+        with self._open() as database:
             del database[key_]
         return
 
     def __contains__(self, key: Any) -> bool:
         key_ = json.dumps(key)
-        with shelve.open(self.db_path, protocol=self.protocal) as database:
+        with self._open() as database:
             return key_ in database
 
     def __len__(self) -> int:
-        with shelve.open(self.db_path, protocol=self.protocal) as database:
+        with self._open() as database:
             return len(database)
 
     def __iter__(self):
-        with shelve.open(self.db_path, protocol=self.protocal) as database:
+        with self._open() as database:
             for key in database:
                 yield json.loads(key)
 
@@ -193,6 +312,37 @@ class ShelveBackend(MutableMapping):
         return f"{self.__class__.__name__}(db_path={self.db_path}, len={len(self)})"
 
 
+class DictBackend(PersistentBackendBase):
+    """An in-memory backend, mainly used for testing."""
+
+    def __init__(self) -> None:
+        self._data = {}
+        return
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._data[key]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._data[key] = value
+        return
+
+    def __delitem__(self, key: Any) -> None:
+        del self._data[key]
+        return
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(len={len(self)})"
+
+
 @dataclass
 class PersistentBackendConfig:
     backend: str = "lmdb"
@@ -200,14 +350,14 @@ class PersistentBackendConfig:
     shelve_config: ShelveBackendConfig = field(default_factory=ShelveBackendConfig)
 
 
-def load_backend(cfg: PersistentBackendConfig) -> MutableMapping:
+def load_backend(cfg: PersistentBackendConfig) -> PersistentBackendBase:
     match cfg.backend:
         case "lmdb":
             return LMDBBackend(cfg.lmdb_config)
         case "shelve":
             return ShelveBackend(cfg.shelve_config)
         case "dict":
-            return dict()
+            return DictBackend()
         case _:
             raise ValueError(f"Invalid backend: {cfg.backend}")
     return
@@ -0,0 +1,37 @@
+from typing import Any, Iterable
+
+
+# the arguments that do not affect the outputs of a model, thus excluded from its cache identity
+NON_IDENTITY_KEYS = [
+    "device_id",
+    "batch_size",
+    "max_tokens",
+    "api_key",
+    "base_url",
+    "proxy",
+    "timeout",
+    "max_retries",
+    "verbose",
+    "allow_parallel",
+]
+
+
+def strip_identity(config: Any, keys: Iterable[str] = NON_IDENTITY_KEYS) -> Any:
+    """Remove the arguments that do not affect the outputs from the config,
+    including those of the nested configs.
+
+    :param config: The config converted to python containers (e.g. by `OmegaConf.to_container`).
+    :type config: Any
+    :param keys: The names of the arguments to remove. Defaults to `NON_IDENTITY_KEYS`.
+    :type keys: Iterable[str]
+    :return: The config without the arguments in `keys`.
+    :rtype: Any
+    """
+    keys = set(keys)
+    if isinstance(config, dict):
+        return {
+            key: strip_identity(value, keys)
+            for key, value in config.items()
+            if key not in keys
+        }
+    return config
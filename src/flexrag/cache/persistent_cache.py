@@ -1,7 +1,6 @@
-from collections import Counter, OrderedDict
 from dataclasses import dataclass
 from hashlib import blake2b
-from typing import Any, MutableMapping, Optional, Literal
+from typing import Any, Iterable, Literal, MutableMapping, Optional
 
 from flexrag.utils import Choices, LOGGER_MANAGER
 
@@ -10,6 +9,26 @@ from .backends import PersistentBackendConfig, load_backend
 logger = LOGGER_MANAGER.get_logger("flexrag.cache")
 
 
+_META_PREFIX = "__flexrag_cache_meta__"
+_HEADER_KEY = (_META_PREFIX, "header", None)
+_LEGACY_META_KEY = blake2b("meta".encode()).hexdigest()
+
+
+def _node_key(key) -> tuple:
+    return (_META_PREFIX, "node", key)
+
+
+def _bucket_key(freq: int) -> tuple:
+    return (_META_PREFIX, "bucket", freq)
+
+
+def _is_meta_key(key) -> bool:
+    # tuples may be loaded as lists by the json based backends
+    if isinstance(key, (tuple, list)):
+        return (len(key) == 3) and (key[0] == _META_PREFIX)
+    return key == _LEGACY_META_KEY
+
+
 def tupled_hashkey(*args, **kwargs):
     """Return a cache key for the specified hashable arguments."""
     return tuple(args), tuple(sorted(kwargs.items()))
@@ -23,6 +42,18 @@ class PersistentCacheConfig(PersistentBackendConfig):
 
 
 class PersistentCache(MutableMapping):
+    """A persistent cache that supports LRU, LFU and FIFO eviction.
+
+    The eviction metadata is stored as separate records in the backend.
+    Each cached key owns a small node record that links it into a doubly linked list,
+    and the linked lists are grouped into frequency buckets ordered by the access frequency
+    (LRU and FIFO only use a single bucket).
+    Therefore, getting, setting and evicting an item only touch a constant number of records,
+    no matter how many items the cache holds.
+    All the records touched by a single operation or by a batched operation
+    (`get_many`, `set_many` and `delete_many`) are read and written in one transaction.
+    """
+
     def __init__(self, cfg: PersistentCacheConfig) -> None:
         self.__backend = load_backend(cfg)
 
@@ -32,49 +63,116 @@ class PersistentCache(MutableMapping):
             maxsize = float("inf")
         else:
             maxsize = cfg.maxsize
-        self.__meta_key = blake2b("meta".encode()).hexdigest()
-        meta_data = self.__backend.get(
-            self.__meta_key,
-            {
-                "maxsize": maxsize,
-                "evict_order": cfg.evict_order,
-                "order": OrderedDict(),
-                "counter": Counter(),
-            },
-        )
-        self.__backend[self.__meta_key] = meta_data
+        with self.__backend.transaction(write=True):
+            fresh = _HEADER_KEY not in self.__backend
+            if fresh:
+                self.__backend[_HEADER_KEY] = {
+                    "maxsize": maxsize,
+                    "evict_order": str(cfg.evict_order),
+                    "size": 0,
+                    "buckets": 0,
+                    "head": None,
+                }
+            # the legacy metadata may be written again by an older version
+            if _LEGACY_META_KEY in self.__backend:
+                self.__migrate_legacy_meta(fresh)
         if cfg.reset_arguments:
-            self.reset_arguments(maxsize, cfg.evict_order)
+            self.reset_arguments(maxsize, str(cfg.evict_order))
 
         # check consistency
-        self.__check(fully_check=True)
+        self.__check()
         return
 
     def __getitem__(self, key) -> Any:
-        if key in self.__backend:
-            self.__update(key, action="get")
-            return self.__backend[key]
-        raise KeyError(key)
+        touch = self.__touch_on_get()
+        with self.__backend.transaction(write=touch):
+            return self.__get(key, touch)
 
     def __setitem__(self, key, value: Any) -> None:
-        self.__update(key, action="set")
-        self.__backend[key] = value
-        while len(self) > self.maxsize:
-            self.popitem()
+        with self.__backend.transaction(write=True):
+            header = self.__backend[_HEADER_KEY]
+            if _node_key(key) in self.__backend:
+                self.__touch(key, header, action="set")
+            else:
+                self.__append(key, self.__init_freq(header), header)
+                header["size"] += 1
+                self.__backend[_HEADER_KEY] = header
+            self.__backend[key] = value
+            while len(self) > self.maxsize:
+                self.popitem()
         return
 
     def __delitem__(self, key) -> None:
-        del self.__backend[key]
-        self.__update(key, action="delete")
+        with self.__backend.transaction(write=True):
+            if _node_key(key) not in self.__backend:
+                raise KeyError(key)
+            node = self.__backend[_node_key(key)]
+            header = self.__backend[_HEADER_KEY]
+            del self.__backend[key]
+            self.__unlink(key, node, header)
+            del self.__backend[_node_key(key)]
+            header["size"] -= 1
+            self.__backend[_HEADER_KEY] = header
         return
 
+    def get_many(self, keys: Iterable[Any], default: Any = None) -> list[Any]:
+        """Get the values of the given keys in a single transaction.
+
+        :param keys: The keys to get.
+        :type keys: Iterable[Any]
+        :param default: The value to return for the missing keys, defaults to None.
+        :type default: Any, optional
+        :return: The values of the keys.
+        :rtype: list[Any]
+        """
+        touch = self.__touch_on_get()
+        values = []
+        with self.__backend.transaction(write=touch):
+            for key in keys:
+                try:
+                    values.append(self.__get(key, touch))
+                except KeyError:
+                    values.append(default)
+        return values
+
+    def set_many(self, keys: Iterable[Any], values: Iterable[Any]) -> None:
+        """Set the values of the given keys in a single transaction.
+
+        :param keys: The keys to set.
+        :type keys: Iterable[Any]
+        :param values: The values to set.
+        :type values: Iterable[Any]
+        :return: None
+        """
+        with self.__backend.transaction(write=True):
+            for key, value in zip(keys, values):
+                self[key] = value
+        return
+
+    def delete_many(self, keys: Iterable[Any]) -> None:
+        """Delete the given keys in a single transaction. Missing keys are ignored.
+
+        :param keys: The keys to delete.
+        :type keys: Iterable[Any]
+        :return: None
+        """
+        with self.__backend.transaction(write=True):
+            for key in keys:
+                if key in self:
+                    del self[key]
+        return
+
+    def __contains__(self, key) -> bool:
+        if _is_meta_key(key):
+            return False
+        return key in self.__backend
+
     def __len__(self) -> int:
-        return len(self.__backend) - 1
+        return self.__backend[_HEADER_KEY]["size"]
 
     def __iter__(self):
-        meta_key = blake2b("meta".encode()).hexdigest()
         for key in self.__backend:
-            if key == meta_key:
+            if _is_meta_key(key):
                 continue
             yield key
 
@@ -97,70 +195,245 @@ class PersistentCache(MutableMapping):
         return wrapper
 
     def popitem(self) -> tuple:
-        if not self:
-            raise KeyError("popitem(): cache is empty")
-        meta = self.__backend[self.__meta_key]
-        meta["counter"] = Counter(meta["counter"])
-        meta["order"] = OrderedDict(meta["order"])
-        match meta["evict_order"]:
-            case "LRU":
-                key, _ = meta["order"].popitem(last=False)
-            case "LFU":
-                key, _ = meta["counter"].most_common(1)[0]
-            case "FIFO":
-                key, _ = meta["order"].popitem(last=False)
-        value = self.__backend.pop(key)
-        del meta["counter"][key]
-        self.__backend[self.__meta_key] = meta
+        with self.__backend.transaction(write=True):
+            header = self.__backend[_HEADER_KEY]
+            if header["size"] == 0:
+                raise KeyError("popitem(): cache is empty")
+            key = self.__backend[_bucket_key(header["head"])]["head"]
+            node = self.__backend[_node_key(key)]
+            value = self.__backend.pop(key)
+            self.__unlink(key, node, header)
+            del self.__backend[_node_key(key)]
+            header["size"] -= 1
+            self.__backend[_HEADER_KEY] = header
         return key, value
 
     def reset_arguments(self, maxsize: int, evict_order: str = None) -> None:
-        meta = self.__backend[self.__meta_key]
-        meta["maxsize"] = maxsize
-        meta["evict_order"] = evict_order or meta["evict_order"]
-        while self.currsize > self.maxsize:
-            self.popitem()
+        with self.__backend.transaction(write=True):
+            header = self.__backend[_HEADER_KEY]
+            header["maxsize"] = maxsize
+            if (evict_order is not None) and (evict_order != header["evict_order"]):
+                header["evict_order"] = evict_order
+                self.__backend[_HEADER_KEY] = header
+                # the frequency buckets are meaningless after switching the eviction order
+                keys = self.__ordered_keys()
+                self.__rebuild(keys, [self.__init_freq(header)] * len(keys))
+            else:
+                self.__backend[_HEADER_KEY] = header
+            while self.currsize > self.maxsize:
+                self.popitem()
         return
 
-    def __update(self, key, action: Literal["delete", "get", "set"]) -> None:
-        meta = self.__backend[self.__meta_key]
-        meta["counter"] = Counter(meta["counter"])
-        meta["order"] = OrderedDict(meta["order"])
-        match action:
-            case "delete":
-                if key in meta["order"]:
-                    del meta["order"][key]
-                if key in meta["counter"]:
-                    del meta["counter"][key]
-            case "get":
-                if (meta["evict_order"] == "LRU") and (key in meta["order"]):
-                    meta["order"].move_to_end(key)
-                meta["counter"][key] -= 1
-            case "set":
-                if key in meta["order"]:
-                    meta["order"].move_to_end(key)
+    def __touch_on_get(self) -> bool:
+        """Whether getting an item updates the metadata. FIFO only reads the backend,
+        so that the readers do not block each other in the backends like LMDB."""
+        return self.evict_order != "FIFO"
+
+    def __get(self, key, touch: bool) -> Any:
+        """Get the value in the current transaction, which should be writable if `touch` is True.
+        If the eviction order is changed to LRU or LFU concurrently, missing a touch is harmless.
+        """
+        value = self.__backend[key]
+        if touch:
+            header = self.__backend[_HEADER_KEY]
+            self.__touch(key, header, action="get")
+        return value
+
+    def __init_freq(self, header: dict) -> int:
+        """The frequency of a newly added key. LRU and FIFO use a single bucket."""
+        return 1 if header["evict_order"] == "LFU" else 0
+
+    def __touch(self, key, header: dict, action: Literal["get", "set"]) -> None:
+        """Update the metadata of an existing key after it is accessed."""
+        match header["evict_order"]:
+            case "FIFO" if action == "get":
+                return
+            case "LRU" | "FIFO":
+                node = self.__backend[_node_key(key)]
+                if node["next"] is None:  # already the most recent one
+                    return
+                self.__unlink(key, node, header)
+                self.__append(key, node["freq"], header)
+            case "LFU":
+                node = self.__backend[_node_key(key)]
+                # the new bucket should be placed after the current bucket,
+                # or after its predecessor if the current bucket will be emptied
+                if (node["prev"] is None) and (node["next"] is None):
+                    prev_freq = self.__backend[_bucket_key(node["freq"])]["prev"]
                 else:
-                    meta["order"][key] = None
-                meta["counter"][key] -= 1
-        self.__backend[self.__meta_key] = meta  # write back
+                    prev_freq = node["freq"]
+                self.__unlink(key, node, header)
+                self.__append(key, node["freq"] + 1, header, prev_freq)
+                self.__backend[_HEADER_KEY] = header
+        return
+
+    def __unlink(self, key, node: dict, header: dict) -> None:
+        """Remove the node from its bucket. Empty bucket will be removed as well."""
+        bucket_key = _bucket_key(node["freq"])
+        bucket = self.__backend[bucket_key]
+        if node["prev"] is None:
+            bucket["head"] = node["next"]
+        else:
+            prev_node = self.__backend[_node_key(node["prev"])]
+            prev_node["next"] = node["next"]
+            self.__backend[_node_key(node["prev"])] = prev_node
+        if node["next"] is None:
+            bucket["tail"] = node["prev"]
+        else:
+            next_node = self.__backend[_node_key(node["next"])]
+            next_node["prev"] = node["prev"]
+            self.__backend[_node_key(node["next"])] = next_node
+
+        # remove the empty bucket
+        if bucket["head"] is None:
+            if bucket["prev"] is None:
+                header["head"] = bucket["next"]
+            else:
+                prev_bucket = self.__backend[_bucket_key(bucket["prev"])]
+                prev_bucket["next"] = bucket["next"]
+                self.__backend[_bucket_key(bucket["prev"])] = prev_bucket
+            if bucket["next"] is not None:
+                next_bucket = self.__backend[_bucket_key(bucket["next"])]
+                next_bucket["prev"] = bucket["prev"]
+                self.__backend[_bucket_key(bucket["next"])] = next_bucket
+            del self.__backend[bucket_key]
+            header["buckets"] -= 1
+        else:
+            self.__backend[bucket_key] = bucket
+        return
+
+    def __append(self, key, freq: int, header: dict, prev_freq: int = None) -> None:
+        """Append the key to the tail of the bucket `freq`.
+        If the bucket does not exist, it will be created right after the bucket `prev_freq`.
+        """
+        bucket_key = _bucket_key(freq)
+        if bucket_key in self.__backend:
+            bucket = self.__backend[bucket_key]
+        else:
+            if prev_freq is None:
+                next_freq = header["head"]
+                header["head"] = freq
+            else:
+                prev_bucket = self.__backend[_bucket_key(prev_freq)]
+                next_freq = prev_bucket["next"]
+                prev_bucket["next"] = freq
+                self.__backend[_bucket_key(prev_freq)] = prev_bucket
+            if next_freq is not None:
+                next_bucket = self.__backend[_bucket_key(next_freq)]
+                next_bucket["prev"] = freq
+                self.__backend[_bucket_key(next_freq)] = next_bucket
+            bucket = {"head": None, "tail": None, "prev": prev_freq, "next": next_freq}
+            header["buckets"] += 1
+
+        # link the node
+        node = {"prev": bucket["tail"], "next": None, "freq": freq}
+        if bucket["tail"] is None:
+            bucket["head"] = key
+        else:
+            tail_node = self.__backend[_node_key(bucket["tail"])]
+            tail_node["next"] = key
+            self.__backend[_node_key(bucket["tail"])] = tail_node
+        bucket["tail"] = key
+        self.__backend[_node_key(key)] = node
+        self.__backend[bucket_key] = bucket
         return
 
-    def __check(self, fully_check: bool = False) -> None:
-        """Check the consistency of the cache."""
-        meta = self.__backend[self.__meta_key]
-        assert len(meta["order"]) == len(self)
-        assert len(meta["counter"]) == len(self)
-        if fully_check:
-            keys = set(self.__backend.keys())
-            meta_key = blake2b("meta".encode()).hexdigest()
-            assert set(meta["order"].keys()) == keys - {meta_key}
-            assert set(meta["counter"].keys()) == keys - {meta_key}
+    def __ordered_keys(self) -> list:
+        """Return all keys in the eviction order by walking through the buckets."""
+        keys = []
+        freq = self.__backend[_HEADER_KEY]["head"]
+        while freq is not None:
+            bucket = self.__backend[_bucket_key(freq)]
+            key = bucket["head"]
+            while key is not None:
+                keys.append(key)
+                key = self.__backend[_node_key(key)]["next"]
+            freq = bucket["next"]
+        return keys
+
+    def __rebuild(self, keys: list, freqs: list[int]) -> None:
+        """Rebuild the eviction metadata for the given keys."""
+        header = self.__backend[_HEADER_KEY]
+        freq = header["head"]
+        while freq is not None:
+            freq_ = self.__backend[_bucket_key(freq)]["next"]
+            del self.__backend[_bucket_key(freq)]
+            freq = freq_
+        header.update({"size": 0, "buckets": 0, "head": None})
+
+        # add keys with ascending frequency
+        prev_freq = None
+        for freq, key in sorted(zip(freqs, keys), key=lambda x: x[0]):
+            self.__append(key, freq, header, prev_freq)
+            prev_freq = freq
+            header["size"] += 1
+        self.__backend[_HEADER_KEY] = header
+        return
+
+    def __migrate_legacy_meta(self, fresh: bool) -> None:
+        """Convert the single meta blob used by the previous versions.
+        If the cache has been converted before, the legacy metadata is dropped,
+        and the items written by the previous versions are recovered by `__check`.
+        """
+        meta = self.__backend.pop(_LEGACY_META_KEY)
+        if not fresh:
+            logger.warning("Dropping the legacy cache metadata.")
+            return
+        logger.info("Converting the legacy cache metadata.")
+        header = self.__backend[_HEADER_KEY]
+        header["maxsize"] = meta["maxsize"]
+        header["evict_order"] = meta["evict_order"]
+        self.__backend[_HEADER_KEY] = header
+        keys = list(meta["order"].keys())
+        if meta["evict_order"] == "LFU":
+            freqs = [-meta["counter"].get(key, -1) for key in keys]
+        else:
+            freqs = [0] * len(keys)
+        self.__rebuild(keys, freqs)
+        return
+
+    def __check(self) -> None:
+        """Check the consistency of the cache and repair the metadata if needed."""
+        header = self.__backend[_HEADER_KEY]
+        # each item owns a data record and a node record
+        if len(self.__backend) == 2 * header["size"] + header["buckets"] + 1:
+            return
+        logger.warning("The cache metadata is inconsistent. Rebuilding it.")
+        self.__repair()
+        while self.currsize > self.maxsize:
+            self.popitem()
+        return
+
+    def __repair(self) -> None:
+        """Rebuild the eviction metadata from the cached items.
+        The frequencies of the items are kept if their node records exist,
+        while the order of the items within the same frequency may be lost.
+        """
+        with self.__backend.transaction(write=True):
+            header = self.__backend[_HEADER_KEY]
+            keys, freqs, meta_keys = [], [], []
+            for key in list(self.__backend):
+                if not _is_meta_key(key):
+                    keys.append(key)
+                elif (key != _LEGACY_META_KEY) and (key[1] != "header"):
+                    meta_keys.append(key)
+            for key in keys:
+                node = self.__backend.get(_node_key(key), None)
+                if node is None:
+                    freqs.append(self.__init_freq(header))
+                else:
+                    freqs.append(node["freq"])
+            for key in meta_keys:
+                del self.__backend[key]
+            header["head"] = None
+            self.__backend[_HEADER_KEY] = header
+            self.__rebuild(keys, freqs)
         return
 
     @property
     def maxsize(self) -> int:
         """The maximum size of the cache."""
-        return self.__backend[self.__meta_key]["maxsize"]
+        return self.__backend[_HEADER_KEY]["maxsize"]
 
     @property
     def currsize(self) -> int:
@@ -170,4 +443,4 @@ class PersistentCache(MutableMapping):
     @property
     def evict_order(self) -> str:
         """The eviction order of the cache."""
-        return self.__backend[self.__meta_key]["evict_order"]
+        return self.__backend[_HEADER_KEY]["evict_order"]
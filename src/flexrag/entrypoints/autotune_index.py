@@ -0,0 +1,75 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import hydra
+import numpy as np
+from hydra.core.config_store import ConfigStore
+from omegaconf import MISSING, OmegaConf
+
+from flexrag.data import RAGTestIterableDataset
+from flexrag.retriever import DenseRetriever, DenseRetrieverConfig
+from flexrag.utils import LOGGER_MANAGER
+
+logger = LOGGER_MANAGER.get_logger("flexrag.autotune_index")
+
+
+@dataclass
+class Config(DenseRetrieverConfig):
+    data_path: str = MISSING
+    data_range: Optional[list[int]] = None
+    target_recall: float = 0.9
+    output_path: Optional[str] = None
+
+
+cs = ConfigStore.instance()
+cs.store(name="default", node=Config)
+
+
+@hydra.main(version_base="1.3", config_path=None, config_name="default")
+def main(cfg: Config):
+    default_cfg = OmegaConf.structured(Config)
+    cfg = OmegaConf.merge(default_cfg, cfg)
+
+    # load retriever
+    retriever = DenseRetriever(cfg)
+
+    # encode the held-out queries
+    testset = RAGTestIterableDataset(cfg.data_path, cfg.data_range)
+    queries = [item.question for item in testset]
+    query_embs = np.concatenate(
+        [
+            retriever.query_encoder.encode(queries[i : i + retriever.batch_size])
+            for i in range(0, len(queries), retriever.batch_size)
+        ],
+        axis=0,
+    )
+
+    # tune the index with the ground truth provided by the exact search
+    ground_truth, _ = retriever.exact_search(query_embs, cfg.top_k)
+    frontier = retriever.index.autotune(
+        retriever._get_query_input(query_embs),
+        ground_truth,
+        top_k=cfg.top_k,
+        target_recall=cfg.target_recall,
+    )
+    frontier_str = "\n".join(
+        [
+            f"{r['params']}: Recall@{cfg.top_k} {r['recall']*100:.2f}%, QPS {r['qps']:.2f}"
+            for r in frontier
+        ]
+    )
+    logger.info(f"Pareto frontier:\n{frontier_str}")
+
+    # save the pareto frontier
+    if cfg.output_path is not None:
+        if not os.path.exists(os.path.dirname(os.path.abspath(cfg.output_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(cfg.output_path)))
+        with open(cfg.output_path, "w", encoding="utf-8") as f:
+            json.dump(frontier, f, indent=4)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import hydra
+from hydra.core.config_store import ConfigStore
+from omegaconf import OmegaConf
+
+from flexrag.retriever import DenseRetriever, DenseRetrieverConfig
+from flexrag.utils import LOGGER_MANAGER
+
+logger = LOGGER_MANAGER.get_logger("flexrag.compact_database")
+
+
+cs = ConfigStore.instance()
+cs.store(name="default", node=DenseRetrieverConfig)
+
+
+@hydra.main(version_base="1.3", config_path=None, config_name="default")
+def main(cfg: DenseRetrieverConfig):
+    default_cfg = OmegaConf.structured(DenseRetrieverConfig)
+    cfg = OmegaConf.merge(default_cfg, cfg)
+
+    # compact database
+    retriever = DenseRetriever(cfg)
+    retriever.compact()
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,14 @@ import logging
 import os
 import sys
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Iterable, Optional
 
 import hydra
 from hydra.core.config_store import ConfigStore
 from omegaconf import MISSING, OmegaConf
 
 from flexrag.assistant import ASSISTANTS
-from flexrag.data import RAGTestIterableDataset
+from flexrag.data import RAGTestData, RAGTestIterableDataset
 from flexrag.metrics import RAGEvaluatorConfig, RAGEvaluator
 from flexrag.retriever import RetrievedContext
 from flexrag.utils import (
@@ -40,6 +40,7 @@ AssistantConfig = ASSISTANTS.make_config()
 class Config(AssistantConfig, DataConfig):
     eval_config: RAGEvaluatorConfig = field(default_factory=RAGEvaluatorConfig)  # fmt: skip
     log_interval: int = 10
+    batch_size: int = 1
 
 
 cs = ConfigStore.instance()
@@ -47,6 +48,18 @@ cs.store(name="default", node=Config)
 logger = LOGGER_MANAGER.get_logger("run_assistant")
 
 
+def iterate_batch(testset: Iterable[RAGTestData], batch_size: int):
+    batch = []
+    for item in testset:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+    return
+
+
 @hydra.main(version_base="1.3", config_path=None, config_name="default")
 def main(config: Config):
     # merge config
@@ -88,28 +101,32 @@ def main(config: Config):
     responses = []
     contexts: list[list[RetrievedContext]] = []
     with open(details_path, "w") as f:
-        for item in testset:
-            questions.append(item.question)
-            golden_answers.append(item.golden_answers)
-            golden_contexts.append(item.golden_contexts)
-            response, ctxs, metadata = assistant.answer(question=item.question)
-            responses.append(response)
-            contexts.append(ctxs)
-            json.dump(
-                {
-                    "question": item.question,
-                    "golden": item.golden_answers,
-                    "golden_contexts": item.golden_contexts,
-                    "metadata": item.meta_data,
-                    "response": response,
-                    "contexts": ctxs,
-                    "metadata": metadata,
-                },
-                f,
-                ensure_ascii=False,
-            )
-            f.write("\n")
-            p_logger.update(desc="Searching")
+        for batch in iterate_batch(testset, config.batch_size):
+            if config.batch_size > 1:
+                outputs = assistant.answer_batch([item.question for item in batch])
+            else:
+                outputs = [assistant.answer(question=batch[0].question)]
+            for item, (response, ctxs, metadata) in zip(batch, outputs):
+                questions.append(item.question)
+                golden_answers.append(item.golden_answers)
+                golden_contexts.append(item.golden_contexts)
+                responses.append(response)
+                contexts.append(ctxs)
+                json.dump(
+                    {
+                        "question": item.question,
+                        "golden": item.golden_answers,
+                        "golden_contexts": item.golden_contexts,
+                        "metadata": item.meta_data,
+                        "response": response,
+                        "contexts": ctxs,
+                        "metadata": metadata,
+                    },
+                    f,
+                    ensure_ascii=False,
+                )
+                f.write("\n")
+                p_logger.update(desc="Searching")
 
     # evaluate
     evaluator = RAGEvaluator(config.eval_config)
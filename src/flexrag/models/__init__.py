@@ -42,6 +42,8 @@ from .sentence_transformers_model import (
     SentenceTransformerEncoderConfig,
 )
 
+# the cached encoder should be imported after all the other encoders are registered
+from .cached_encoder import CachedEncoder, CachedEncoderConfig
 
 __all__ = [
     "GeneratorBase",
@@ -77,6 +79,8 @@ __all__ = [
     "CohereEncoderConfig",
     "SentenceTransformerEncoder",
     "SentenceTransformerEncoderConfig",
+    "CachedEncoder",
+    "CachedEncoderConfig",
     "GENERATORS",
     "ENCODERS",
 ]
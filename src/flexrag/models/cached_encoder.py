@@ -0,0 +1,173 @@
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import blake2b
+from typing import Optional
+
+import lmdb
+import numpy as np
+from omegaconf import MISSING, OmegaConf
+
+from flexrag.cache import strip_identity
+from flexrag.utils import LOGGER_MANAGER, TIME_METER
+
+from .model_base import ENCODERS, EncoderBase
+
+logger = LOGGER_MANAGER.get_logger("flexrag.models.cached_encoder")
+
+
+# the base encoder config is created before the cached encoder is registered,
+# thus the cached encoder could not be nested.
+BaseEncoderConfig = ENCODERS.make_config(
+    default=MISSING, config_name="BaseEncoderConfig"
+)
+_META_KEY = b"__flexrag_encoder_cache_meta__"
+
+
+@dataclass
+class CachedEncoderConfig(BaseEncoderConfig):
+    """The configuration for the cached encoder.
+
+    :param model_identity: The identity of the base encoder used in the cache keys.
+        None means the type and the config of the base encoder,
+        excluding the arguments that do not affect the embeddings (e.g. `device_id` and `api_key`).
+        Defaults to None.
+    :type model_identity: Optional[str]
+    :param maxsize: The maximum number of embeddings kept in the in-memory LRU cache. Defaults to 100000.
+    :type maxsize: int
+    :param cache_path: The path of the LMDB database used as the second cache tier.
+        None means only the in-memory cache is used. Defaults to None.
+    :type cache_path: Optional[str]
+    :param map_size: The maximum size of the LMDB database in bytes. Defaults to 1GB.
+    :type map_size: int
+    """
+
+    model_identity: Optional[str] = None
+    maxsize: int = 100000
+    cache_path: Optional[str] = None
+    map_size: int = 1073741824
+
+
+@ENCODERS("cached", config_class=CachedEncoderConfig)
+class CachedEncoder(EncoderBase):
+    """CachedEncoder wraps any registered encoder and caches the embeddings of the encoded texts.
+    The embeddings are looked up in a bounded in-memory LRU cache first,
+    then in an optional LMDB database, and the missing texts are encoded by the base encoder.
+    The cache key is the hash of the model identity and the text,
+    and the embeddings are stored as raw bytes in the LMDB database.
+    """
+
+    def __init__(self, cfg: CachedEncoderConfig) -> None:
+        self.encoder: EncoderBase = ENCODERS.load(cfg)
+        if cfg.model_identity is not None:
+            self.model_identity = cfg.model_identity
+        else:
+            cfg_name = f"{ENCODERS[cfg.encoder_type]['short_names'][0]}_config"
+            identity = OmegaConf.to_container(getattr(cfg, cfg_name))
+            # the arguments that do not affect the embeddings are excluded from the identity
+            identity = strip_identity(identity)
+            identity = json.dumps(identity, sort_keys=True)
+            self.model_identity = f"{cfg.encoder_type}:{identity}"
+        self.maxsize = cfg.maxsize
+        self._memory: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # open the persistent cache
+        self.dtype: Optional[np.dtype] = None
+        if cfg.cache_path is not None:
+            self.env = lmdb.open(cfg.cache_path, map_size=cfg.map_size)
+            with self.env.begin() as txn:
+                meta = txn.get(_META_KEY)
+            if meta is not None:
+                meta = json.loads(meta)
+                self.dtype = np.dtype(meta["dtype"])
+        else:
+            self.env = None
+        return
+
+    @TIME_METER("cached_encode")
+    def encode(self, texts: list[str]) -> np.ndarray:
+        keys = [self._hash(text) for text in texts]
+        embeddings = self._lookup(keys)
+        missing = {k: t for k, t, e in zip(keys, texts, embeddings) if e is None}
+        if missing:
+            new_embeddings = self.encoder.encode(list(missing.values()))
+            new_embeddings = dict(zip(missing.keys(), new_embeddings))
+            self._update(new_embeddings)
+            embeddings = [
+                new_embeddings[k] if e is None else e for k, e in zip(keys, embeddings)
+            ]
+        return np.stack(embeddings)
+
+    async def async_encode(self, texts: list[str]) -> np.ndarray:
+        keys = [self._hash(text) for text in texts]
+        embeddings = self._lookup(keys)
+        missing = {k: t for k, t, e in zip(keys, texts, embeddings) if e is None}
+        if missing:
+            new_embeddings = await self.encoder.async_encode(list(missing.values()))
+            new_embeddings = dict(zip(missing.keys(), new_embeddings))
+            self._update(new_embeddings)
+            embeddings = [
+                new_embeddings[k] if e is None else e for k, e in zip(keys, embeddings)
+            ]
+        return np.stack(embeddings)
+
+    def _hash(self, text: str) -> bytes:
+        return blake2b(
+            f"{self.model_identity}\0{text}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def _lookup(self, keys: list[bytes]) -> list[Optional[np.ndarray]]:
+        """Look up the embeddings in the memory and then in the LMDB database."""
+        embeddings = [None] * len(keys)
+        with self._lock:
+            for n, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    embeddings[n] = self._memory[key]
+        if (self.env is None) or (self.dtype is None):
+            return embeddings
+
+        found = {}
+        with self.env.begin() as txn:
+            for n, key in enumerate(keys):
+                if embeddings[n] is not None:
+                    continue
+                value = txn.get(key)
+                if value is not None:
+                    embeddings[n] = np.frombuffer(value, dtype=self.dtype)
+                    found[key] = embeddings[n]
+        self._update(found, persist=False)
+        return embeddings
+
+    def _update(
+        self, embeddings: dict[bytes, np.ndarray], persist: bool = True
+    ) -> None:
+        """Add the embeddings to the memory and the LMDB database."""
+        if not embeddings:
+            return
+        with self._lock:
+            for key, emb in embeddings.items():
+                self._memory[key] = np.array(emb)
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+        if (self.env is None) or (not persist):
+            return
+
+        try:
+            with self.env.begin(write=True) as txn:
+                if self.dtype is None:
+                    self.dtype = next(iter(embeddings.values())).dtype
+                    meta = {"dtype": self.dtype.name}
+                    txn.put(_META_KEY, json.dumps(meta).encode("utf-8"))
+                for key, emb in embeddings.items():
+                    txn.put(key, np.ascontiguousarray(emb, dtype=self.dtype).tobytes())
+        except lmdb.MapFullError:
+            logger.warning("The encoder cache is full, new embeddings are not saved.")
+        return
+
+    @property
+    def embedding_size(self) -> int:
+        return self.encoder.embedding_size
@@ -46,7 +46,7 @@ from .model_base import (
     GeneratorBaseConfig,
     VLMGeneratorBase,
 )
-from .utils import guess_model_name
+from .utils import bucket_by_length, guess_model_name
 
 logger = LOGGER_MANAGER.get_logger("flexrag.models.hf_model")
 
@@ -495,6 +495,8 @@ class HFEncoderConfig(EncoderBaseConfig, HFModelConfig):
     normalize: bool = False
     prompt: str = ""  # used in nomic-text-embedding
     task: str = ""  # used in jina-embedding
+    # the token budget of each batch, None means no limit
+    max_tokens: Optional[int] = None
 
 
 @ENCODERS("hf", config_class=HFEncoderConfig)
@@ -524,6 +526,7 @@ class HFEncoder(EncoderBase):
         self.normalize = cfg.normalize
         self.prompt = cfg.prompt
         self.task = cfg.task
+        self.max_tokens = cfg.max_tokens
         return
 
     def get_embedding(
@@ -567,13 +570,34 @@ class HFEncoder(EncoderBase):
     def _encode(
         self, texts: list[str | list[str]], model: torch.nn.Module | DP
     ) -> np.ndarray:
+        if self.max_tokens is None:
+            input_dict = self.tokenizer.batch_encode_plus(
+                texts,
+                return_tensors="pt",
+                max_length=self.max_encode_length,
+                padding=True,
+                truncation=True,
+            )  # TODO: This step is slow
+            return self._forward(input_dict, model)
+
+        # sort the texts by length and batch them under the token budget to reduce padding
         input_dict = self.tokenizer.batch_encode_plus(
             texts,
-            return_tensors="pt",
             max_length=self.max_encode_length,
-            padding=True,
             truncation=True,
-        )  # TODO: This step is slow
+        )
+        lengths = [len(ids) for ids in input_dict["input_ids"]]
+        embeddings = [None] * len(texts)
+        for batch in bucket_by_length(lengths, self.max_tokens):
+            batch_dict = self.tokenizer.pad(
+                {key: [value[i] for i in batch] for key, value in input_dict.items()},
+                return_tensors="pt",
+            )
+            for i, emb in zip(batch, self._forward(batch_dict, model)):
+                embeddings[i] = emb
+        return np.stack(embeddings)
+
+    def _forward(self, input_dict, model: torch.nn.Module | DP) -> np.ndarray:
         if not isinstance(model, DP):
             input_dict = input_dict.to(model.device)
         mask = input_dict["attention_mask"]
@@ -597,6 +621,8 @@ class HFClipEncoderConfig(EncoderBaseConfig, HFModelConfig):
     max_encode_length: int = 512
     normalize: bool = False
     convert_to_rgb: bool = False
+    # the token budget of each text batch, None means no limit
+    max_tokens: Optional[int] = None
 
 
 @ENCODERS("hf_clip", config_class=HFClipEncoderConfig)
@@ -620,6 +646,7 @@ class HFClipEncoder(EncoderBase):
         self.max_encode_length = cfg.max_encode_length
         self.normalize = cfg.normalize
         self.convert_to_rgb = cfg.convert_to_rgb
+        self.max_tokens = cfg.max_tokens
         return
 
     def encode(self, data: list[str | ImageFile]) -> np.ndarray:
@@ -644,13 +671,34 @@ class HFClipEncoder(EncoderBase):
     @TIME_METER("hf_clip_encode")
     @torch.no_grad()
     def encode_text(self, texts: list[str]) -> np.ndarray:
+        if self.max_tokens is None:
+            input_dict = self.tokenizer.batch_encode_plus(
+                texts,
+                return_tensors="pt",
+                max_length=self.max_encode_length,
+                padding=True,
+                truncation=True,
+            )
+            return self._encode_text(input_dict)
+
+        # sort the texts by length and batch them under the token budget to reduce padding
         input_dict = self.tokenizer.batch_encode_plus(
             texts,
-            return_tensors="pt",
             max_length=self.max_encode_length,
-            padding=True,
             truncation=True,
         )
+        lengths = [len(ids) for ids in input_dict["input_ids"]]
+        embeddings = [None] * len(texts)
+        for batch in bucket_by_length(lengths, self.max_tokens):
+            batch_dict = self.tokenizer.pad(
+                {key: [value[i] for i in batch] for key, value in input_dict.items()},
+                return_tensors="pt",
+            )
+            for i, emb in zip(batch, self._encode_text(batch_dict)):
+                embeddings[i] = emb
+        return np.stack(embeddings)
+
+    def _encode_text(self, input_dict) -> np.ndarray:
         input_dict = input_dict.to(self.model.device)
         embeddings = self.model.get_text_features(**input_dict)
         if self.normalize:
@@ -8,6 +8,7 @@ from omegaconf import MISSING
 from flexrag.utils import TIME_METER
 
 from .model_base import ENCODERS, EncoderBase, EncoderBaseConfig
+from .utils import bucket_by_length, estimate_token_lengths
 
 
 @dataclass
@@ -20,6 +21,8 @@ class SentenceTransformerEncoderConfig(EncoderBaseConfig):
     prompt: Optional[str] = None
     prompt_dict: Optional[dict] = None
     normalize: bool = False
+    # the token budget of each batch, None means no limit
+    max_tokens: Optional[int] = None
 
 
 @ENCODERS("sentence_transformer", config_class=SentenceTransformerEncoderConfig)
@@ -48,6 +51,7 @@ class SentenceTransformerEncoder(EncoderBase):
         self.task = config.task
         self.prompt = config.prompt
         self.normalize = config.normalize
+        self.max_tokens = config.max_tokens
         return
 
     @TIME_METER("st_encode")
@@ -69,6 +73,19 @@ class SentenceTransformerEncoder(EncoderBase):
             args["pool"] = self.pool
             args["batch_size"] = math.ceil(args["batch_size"] / len(self.devices))
             embeddings = self.model.encode_multi_process(**args)
+        elif self.max_tokens is not None:
+            # sort the texts by length and batch them under the token budget to reduce padding
+            # the lengths are estimated to avoid tokenizing the texts twice
+            lengths = estimate_token_lengths(
+                texts, self.model.tokenizer, self.model.max_seq_length
+            )
+            embeddings = [None] * len(texts)
+            for batch in bucket_by_length(lengths, self.max_tokens):
+                args["sentences"] = [texts[i] for i in batch]
+                args["batch_size"] = len(batch)
+                for i, emb in zip(batch, self.model.encode(**args)):
+                    embeddings[i] = emb
+            embeddings = np.stack(embeddings)
         else:
             embeddings = self.model.encode(**args)
         return embeddings
@@ -1,11 +1,73 @@
+import math
+
 from transformers import PretrainedConfig
 
 from flexrag.utils import LOGGER_MANAGER
 
-
 logger = LOGGER_MANAGER.get_logger("flexrag.models.utils")
 
 
+def bucket_by_length(lengths: list[int], max_tokens: int) -> list[list[int]]:
+    """Sort the inputs by length and group them into batches under the token budget.
+    The padded size of each batch (the batch size times the longest length in the batch)
+    does not exceed `max_tokens`, unless a single input is longer than `max_tokens`.
+    The longest inputs come first, so that running out of memory happens as early as possible.
+
+    :param lengths: The lengths of the inputs.
+    :type lengths: list[int]
+    :param max_tokens: The maximum number of tokens (including the padding tokens) in a batch.
+    :type max_tokens: int
+    :return: The indices of the inputs in each batch.
+    :rtype: list[list[int]]
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    batch = []
+    for idx in order:
+        # the first input in the batch is the longest one
+        if batch and (len(batch) + 1) * lengths[batch[0]] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def estimate_token_lengths(
+    texts: list[str],
+    tokenizer,
+    max_length: int,
+    sample_size: int = 64,
+) -> list[int]:
+    """Estimate the token lengths of the texts by their character lengths,
+    which is much cheaper than tokenizing all the texts.
+    The number of characters per token is measured on up to `sample_size` texts evenly sampled from the inputs.
+
+    :param texts: The texts to estimate.
+    :type texts: list[str]
+    :param tokenizer: The tokenizer of the model.
+    :type tokenizer: PreTrainedTokenizer
+    :param max_length: The maximum length of the tokenized texts.
+    :type max_length: int
+    :param sample_size: The number of texts to tokenize. Defaults to 64.
+    :type sample_size: int
+    :return: The estimated token length of each text.
+    :rtype: list[int]
+    """
+    step = max(len(texts) // sample_size, 1)
+    samples = texts[::step][:sample_size]
+    num_tokens = sum(
+        len(ids)
+        for ids in tokenizer(samples, max_length=max_length, truncation=True)[
+            "input_ids"
+        ]
+    )
+    num_chars = sum(min(len(text), max_length * 32) for text in samples)
+    chars_per_token = max(num_chars / max(num_tokens, 1), 1e-3)
+    return [min(math.ceil(len(text) / chars_per_token), max_length) for text in texts]
+
+
 def guess_model_name(model_cfg: PretrainedConfig) -> str | None:
     arch_name = getattr(model_cfg, "architectures", [None])[0]
     hidden_size = getattr(model_cfg, "hidden_size", None)
@@ -95,7 +95,7 @@ class ChatPrompt:
         if len(history) > 0:
             if isinstance(history[0], dict):
                 history = [ChatTurn.from_dict(turn) for turn in history]
-        self.history = history
+        self.history = list(history)
 
         # set demonstrations
         if len(demonstrations) > 0:
@@ -104,7 +104,7 @@ class ChatPrompt:
                     [ChatTurn.from_dict(turn) for turn in demo]
                     for demo in demonstrations
                 ]
-        self.demonstrations = demonstrations
+        self.demonstrations = list(demonstrations)
         return
 
     def to_list(self) -> list[dict[str, str]]:
@@ -220,7 +220,7 @@ class MultiModelChatPrompt:
         if len(history) > 0:
             if isinstance(history[0], dict):
                 history = [MultiModelChatTurn.from_dict(turn) for turn in history]
-        self.history = history
+        self.history = list(history)
 
         # set demonstrations
         if len(demonstrations) > 0:
@@ -229,7 +229,7 @@ class MultiModelChatPrompt:
                     [MultiModelChatTurn.from_dict(turn) for turn in demo]
                     for demo in demonstrations
                 ]
-        self.demonstrations = demonstrations
+        self.demonstrations = list(demonstrations)
         return
 
     def to_list(self) -> list[dict[str, str]]:
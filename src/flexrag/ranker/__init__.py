@@ -14,6 +14,9 @@ from .voyage_ranker import VoyageRanker, VoyageRankerConfig
 
 from .ranker import RankerBase, RankerBaseConfig, RANKERS, RankingResult  # isort: skip
 
+# the cascade ranker should be imported after all the other rankers are registered
+from .cascade_ranker import CascadeRanker, CascadeRankerConfig  # isort: skip
+
 
 __all__ = [
     "RankerBase",
@@ -36,4 +39,6 @@ __all__ = [
     "VoyageRankerConfig",
     "RankGPTRanker",
     "RankGPTRankerConfig",
+    "CascadeRanker",
+    "CascadeRankerConfig",
 ]
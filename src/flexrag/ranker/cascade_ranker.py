@@ -0,0 +1,182 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from flexrag.retriever import RetrievedContext
+from flexrag.utils import LOGGER_MANAGER, TIME_METER
+
+from .ranker import RANKERS, RankerBase, RankerBaseConfig, RankingResult
+
+logger = LOGGER_MANAGER.get_logger("flexrag.rankers.cascade")
+
+
+# the stage config is created before the cascade ranker is registered,
+# thus the cascade ranker could not be nested.
+StageRankersConfig = RANKERS.make_config(
+    allow_multiple=True, config_name="StageRankersConfig"
+)
+
+
+@dataclass
+class CascadeRankerConfig(RankerBaseConfig, StageRankersConfig):
+    """The configuration for the cascade ranker.
+    The stages are specified by `ranker_type` in order,
+    and the `reserve_num` of each stage config decides how many candidates are passed to the next stage.
+
+    :param early_exit_margins: The score margins of each stage to skip the later stages.
+        If the score of the top candidate exceeds the score of the second one by the margin,
+        the result of the stage is returned directly.
+        None or a missing margin means the stage never exits early. Defaults to [].
+    :type early_exit_margins: list[Optional[float]]
+    """
+
+    early_exit_margins: list[Optional[float]] = field(default_factory=list)
+
+
+@RANKERS("cascade", config_class=CascadeRankerConfig)
+class CascadeRanker(RankerBase):
+    """CascadeRanker chains several registered rankers from the cheap ones to the expensive ones.
+    Each stage ranks the candidates reserved by the previous stage,
+    so that the expensive rankers only see the top candidates.
+    The latency of each stage is recorded by `TIME_METER` under ("cascade_rank", "stage_{n}_{ranker_type}").
+    If `use_score_cache` is set, the final order of the candidates is cached,
+    thus the `ranking_field` is required to rank the `RetrievedContext`.
+    """
+
+    # the scores of different stages are not comparable, thus the whole ranking is cached
+    cache_listwise = True
+
+    def __init__(self, cfg: CascadeRankerConfig) -> None:
+        super().__init__(cfg)
+        self.stage_names = [str(name) for name in cfg.ranker_type]
+        self.stages: list[RankerBase] = RANKERS.load(cfg)
+        assert len(self.stages) > 0, "At least one stage is required."
+        self.early_exit_margins = list(cfg.early_exit_margins)
+        self.early_exit_margins += [None] * (
+            len(self.stages) - len(self.early_exit_margins)
+        )
+        return
+
+    def rank(
+        self, query: str, candidates: list[RetrievedContext | str]
+    ) -> RankingResult:
+        return self.rank_batch([query], [candidates])[0]
+
+    async def async_rank(
+        self, query: str, candidates: list[RetrievedContext | str]
+    ) -> RankingResult:
+        # the score cache is looked up with the texts of the candidates
+        if self.score_cache is not None:
+            return await super().async_rank(query, candidates)
+        return await self._cascade_async_rank(query, candidates)
+
+    def rank_batch(
+        self,
+        queries: list[str],
+        candidates: list[list[RetrievedContext | str]],
+    ) -> list[RankingResult]:
+        # the score cache is looked up with the texts of the candidates
+        if self.score_cache is not None:
+            return super().rank_batch(queries, candidates)
+        return self._cascade_rank_batch(queries, candidates)
+
+    async def _cascade_async_rank(
+        self, query: str, candidates: list[RetrievedContext | str]
+    ) -> RankingResult:
+        result = RankingResult(query=query, candidates=list(candidates))
+        for n, ranker in enumerate(self.stages):
+            if len(result.candidates) == 0:
+                break
+            async_rank = TIME_METER("cascade_rank", self._stage_name(n))(
+                ranker.async_rank
+            )
+            result = await async_rank(query, result.candidates)
+            if self._exit_early(n, result):
+                break
+        return self._reserve(result)
+
+    def _cascade_rank_batch(
+        self,
+        queries: list[str],
+        candidates: list[list[RetrievedContext | str]],
+    ) -> list[RankingResult]:
+        results = [
+            RankingResult(query=q, candidates=list(cands))
+            for q, cands in zip(queries, candidates)
+        ]
+        active = [n for n, cands in enumerate(candidates) if len(cands) > 0]
+        for n, ranker in enumerate(self.stages):
+            if len(active) == 0:
+                break
+            rank_batch = TIME_METER("cascade_rank", self._stage_name(n))(
+                ranker.rank_batch
+            )
+            stage_results = rank_batch(
+                [queries[i] for i in active],
+                [results[i].candidates for i in active],
+            )
+            for i, result in zip(active, stage_results):
+                results[i] = result
+            # the confident queries skip the later stages
+            active = [
+                i
+                for i in active
+                if (len(results[i].candidates) > 0)
+                and (not self._exit_early(n, results[i]))
+            ]
+            if (len(active) < len(stage_results)) and (n < len(self.stages) - 1):
+                logger.debug(
+                    f"{len(stage_results) - len(active)} queries exit after stage {n}."
+                )
+        return [self._reserve(result) for result in results]
+
+    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        return self._rank_batch([query], [candidates])[0]
+
+    async def _async_rank(
+        self, query: str, candidates: list[str]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        result = await self._cascade_async_rank(query, candidates)
+        return self._get_indices(candidates, result)
+
+    def _rank_batch(
+        self, queries: list[str], candidates: list[list[str]]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        results = self._cascade_rank_batch(queries, candidates)
+        return [
+            self._get_indices(cands, result)
+            for cands, result in zip(candidates, results)
+        ]
+
+    def _get_indices(
+        self, candidates: list[str], result: RankingResult
+    ) -> tuple[np.ndarray, Optional[np.ndarray]]:
+        """Map the ranked candidates back to their positions in the input."""
+        positions: dict[str, list[int]] = {}
+        for n, candidate in enumerate(candidates):
+            positions.setdefault(candidate, []).append(n)
+        indices = np.array([positions[c].pop(0) for c in result.candidates], dtype=int)
+        if result.scores is None:
+            return indices, None
+        # the candidates dropped by the stages are scored as -inf
+        scores = np.full(len(candidates), -np.inf, dtype=np.float32)
+        scores[indices] = result.scores
+        return indices, scores
+
+    def _stage_name(self, stage_id: int) -> str:
+        return f"stage_{stage_id}_{self.stage_names[stage_id]}"
+
+    def _exit_early(self, stage_id: int, result: RankingResult) -> bool:
+        """Whether the result of the stage is confident enough to skip the later stages."""
+        margin = self.early_exit_margins[stage_id]
+        if (margin is None) or (result.scores is None) or (len(result.scores) < 2):
+            return False
+        return (result.scores[0] - result.scores[1]) >= margin
+
+    def _reserve(self, result: RankingResult) -> RankingResult:
+        if self.reserve_num > 0:
+            result.candidates = result.candidates[: self.reserve_num]
+            if result.scores is not None:
+                result.scores = result.scores[: self.reserve_num]
+        return result
@@ -17,6 +17,7 @@ class CohereRankerConfig(RankerBaseConfig):
     base_url: Optional[str] = None
     api_key: str = MISSING
     proxy: Optional[str] = None
+    max_concurrency: int = 8
 
 
 @RANKERS("cohere", config_class=CohereRankerConfig)
@@ -43,7 +44,9 @@ class CohereRanker(RankerBase):
             model=self.model,
             top_n=len(candidates),
         )
-        scores = [i.relevance_score for i in result.results]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in result.results:
+            scores[r.index] = r.relevance_score
         return None, scores
 
     @TIME_METER("cohere_rank")
@@ -57,5 +60,7 @@ class CohereRanker(RankerBase):
                 top_n=len(candidates),
             )
         )
-        scores = [i.relevance_score for i in result.results]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in result.results:
+            scores[r.index] = r.relevance_score
         return None, scores
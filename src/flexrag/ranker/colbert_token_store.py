@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+from typing import Optional
+
+import numpy as np
+
+from flexrag.retriever.embedding_store import EmbeddingQuantizer, EmbeddingStore
+from flexrag.utils import LOGGER_MANAGER
+
+logger = LOGGER_MANAGER.get_logger("flexrag.rankers.colbert_token_store")
+
+
+class ColBertTokenStore:
+    """A memory-mapped store of the per-token document embeddings of ColBERT, keyed by passage id.
+
+    The token embeddings of all documents are quantized by an `EmbeddingQuantizer`
+    and concatenated in an `EmbeddingStore` under `{path}/tokens`.
+    The end offsets of the documents and the passage ids are appended to
+    `{path}/offsets.bin` and `{path}/ids.jsonl` after the token embeddings are written,
+    thus the documents written partially are dropped when the store is loaded.
+    If a passage id is added more than once, the latest embeddings are used.
+
+    :param path: The directory of the store.
+    :type path: str
+    :param precision: The precision of the stored token embeddings. Defaults to "float16".
+    :type precision: str
+    :param model_identity: The identity of the model that encodes the documents.
+        The store built by another model is cleaned. None means not checking. Defaults to None.
+    :type model_identity: Optional[str]
+    """
+
+    def __init__(
+        self,
+        path: str,
+        precision: str = "float16",
+        model_identity: Optional[str] = None,
+    ) -> None:
+        self.path = path
+        self.ids_path = os.path.join(self.path, "ids.jsonl")
+        self.offsets_path = os.path.join(self.path, "offsets.bin")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.model_identity = model_identity
+        os.makedirs(self.path, exist_ok=True)
+
+        # the embeddings encoded by another model are not reusable
+        if os.path.exists(self.meta_path) and (model_identity is not None):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["model_identity"] != model_identity:
+                logger.warning(
+                    "The token store is built by another model, cleaning it."
+                )
+                shutil.rmtree(self.path)
+                os.makedirs(self.path, exist_ok=True)
+        self._save_meta()
+
+        self.quantizer = EmbeddingQuantizer(
+            os.path.join(self.path, "quantizer"), precision=precision
+        )
+        self.tokens = EmbeddingStore(
+            os.path.join(self.path, "tokens"), dtype=self.quantizer.dtype.name
+        )
+        self._load()
+        return
+
+    def _save_meta(self) -> None:
+        if os.path.exists(self.meta_path) and (self.model_identity is None):
+            return
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"model_identity": self.model_identity}, f)
+        return
+
+    def _load(self) -> None:
+        """Load the passage ids and the offsets, and drop the uncommitted documents."""
+        lines = []
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "rb") as f:
+                lines = f.read().splitlines(keepends=True)
+            # the last line without the line break is written partially
+            if lines and (not lines[-1].endswith(b"\n")):
+                lines.pop()
+        ids = [json.loads(line) for line in lines]
+        ends = np.zeros([0], dtype=np.int64)
+        if os.path.exists(self.offsets_path):
+            count = os.path.getsize(self.offsets_path) // 8
+            ends = np.fromfile(self.offsets_path, dtype=np.int64, count=count)
+
+        # only the documents whose embeddings, offsets and ids are all written are valid
+        num_docs = min(len(ids), len(ends))
+        num_docs = int(np.searchsorted(ends[:num_docs], len(self.tokens), "right"))
+        if num_docs < max(len(ids), len(ends)):
+            logger.warning("Dropping the uncommitted documents.")
+        self._truncate_file(self.ids_path, sum(len(line) for line in lines[:num_docs]))
+        self._truncate_file(self.offsets_path, num_docs * 8)
+        self.offsets = [0] + ends[:num_docs].tolist()
+        self.id_map = {pid: n for n, pid in enumerate(ids[:num_docs])}
+
+        # drop the tokens that are written after the last commit
+        if len(self.tokens) > self.offsets[-1]:
+            logger.warning("Dropping the uncommitted token embeddings.")
+            self.tokens.truncate(self.offsets[-1])
+        return
+
+    @staticmethod
+    def _truncate_file(path: str, size: int) -> None:
+        if os.path.exists(path) and (os.path.getsize(path) > size):
+            with open(path, "r+b") as f:
+                f.truncate(size)
+        return
+
+    def add(self, ids: list[str], embeddings: list[np.ndarray]) -> None:
+        """Add the token embeddings of the documents.
+
+        :param ids: The passage ids of the documents.
+        :type ids: list[str]
+        :param embeddings: The float32 token embeddings of each document with shape [doc_len, embedding_size].
+        :type embeddings: list[np.ndarray]
+        :return: None
+        """
+        assert len(ids) == len(embeddings), "The number of ids and documents mismatch."
+        if len(ids) == 0:
+            return
+        embeddings_cat = np.concatenate(embeddings, axis=0)
+        if not self.quantizer.is_fitted:
+            self.quantizer.fit(embeddings_cat)
+        self.tokens.append(self.quantizer.encode(embeddings_cat))
+
+        # commit the offsets and then the passage ids
+        lengths = np.array([emb.shape[0] for emb in embeddings], dtype=np.int64)
+        ends = self.offsets[-1] + np.cumsum(lengths)
+        with open(self.offsets_path, "ab") as f:
+            f.write(ends.tobytes())
+        ids = [str(pid) for pid in ids]
+        with open(self.ids_path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(pid) + "\n" for pid in ids))
+        for pid, end in zip(ids, ends.tolist()):
+            self.id_map[pid] = len(self.offsets) - 1
+            self.offsets.append(end)
+        return
+
+    def get(self, ids: list[str]) -> list[Optional[np.ndarray]]:
+        """Get the float32 token embeddings of the documents.
+
+        :param ids: The passage ids of the documents.
+        :type ids: list[str]
+        :return: The token embeddings of each document, None if the document is not in the store.
+        :rtype: list[Optional[np.ndarray]]
+        """
+        embeddings = []
+        for pid in ids:
+            row = self.id_map.get(str(pid), None)
+            if row is None:
+                embeddings.append(None)
+                continue
+            start, end = self.offsets[row], self.offsets[row + 1]
+            embeddings.append(self.quantizer.decode(self.tokens.data[start:end]))
+        return embeddings
+
+    def clean(self) -> None:
+        self.tokens.clean()
+        self.quantizer.clean()
+        self.id_map = {}
+        self.offsets = [0]
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        self._save_meta()
+        return
+
+    def __contains__(self, pid: str) -> bool:
+        return str(pid) in self.id_map
+
+    def __len__(self) -> int:
+        return len(self.id_map)
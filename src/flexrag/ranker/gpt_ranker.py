@@ -1,13 +1,16 @@
+import asyncio
 import copy
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from typing import Generator, Optional
 
 import numpy as np
 
-from flexrag.models import GENERATORS
+from flexrag.models import GENERATORS, GeneratorBase
 from flexrag.prompt import ChatPrompt, ChatTurn
-from flexrag.utils import TIME_METER
+from flexrag.utils import TIME_METER, Choices
 
 from .ranker import RankerBase, RankerBaseConfig, RANKERS
 
@@ -20,6 +23,13 @@ class RankGPTRankerConfig(RankerBaseConfig, GeneratorConfig):
     step_size: int = 10
     window_size: int = 20
     max_chunk_size: int = 300
+    max_concurrency: int = 8
+    # `sliding` slides the window from the tail to the head serially,
+    # `tournament` ranks the non-overlapping windows concurrently and
+    # promotes the top `step_size` candidates of each window to the next round.
+    window_strategy: Choices(["sliding", "tournament"]) = "sliding"  # type: ignore
+    # rank the windows of all queries in `rank_batch` with one `chat` call per round
+    batch_queries: bool = False
 
 
 @RANKERS("rank_gpt", config_class=RankGPTRankerConfig)
@@ -28,6 +38,8 @@ class RankGPTRanker(RankerBase):
     Code was adapted from the original implementation from https://github.com/sunnweiwei/RankGPT
     """
 
+    cache_listwise = True
+
     def __init__(self, cfg: RankGPTRankerConfig):
         super().__init__(cfg)
         self.generator = GENERATORS.load(cfg)
@@ -42,44 +54,156 @@ class RankGPTRanker(RankerBase):
         self.step_size = cfg.step_size
         self.window_size = cfg.window_size
         self.max_chunk_size = cfg.max_chunk_size
+        self.window_strategy = str(cfg.window_strategy)
+        self.batch_queries = cfg.batch_queries
+        if self.window_strategy == "tournament":
+            assert (
+                self.step_size < self.window_size
+            ), "The `step_size` should be smaller than the `window_size`."
         return
 
     @TIME_METER("rankgpt_rank")
     def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, None]:
-        # perform slide window ranking
-        indices = list(range(len(candidates)))
-        start_idx = max(len(candidates) - self.window_size, 0)
-        end_idx = len(candidates)
-        while start_idx >= 0:
-            start_idx = max(start_idx, 0)
-            candidates_ = [candidates[i] for i in indices[start_idx:end_idx]]
-            indices_, _ = self._rank_piece(query, candidates_)
-            indices[start_idx:end_idx] = indices_
-            start_idx = start_idx - self.step_size
-            end_idx -= self.step_size
+        schedule = self._get_schedule(len(candidates))
+        windows, indices = _advance(schedule, None)
+        while windows is not None:
+            # the windows in the same round are ranked in one call
+            prompts = [
+                self._get_prompt(query, [candidates[i] for i in window])
+                for window in windows
+            ]
+            responses = self._chat(prompts)
+            rankings = [
+                self._parse_response(r[0], len(w)) for r, w in zip(responses, windows)
+            ]
+            windows, indices = _advance(schedule, rankings)
         return np.array(indices), None
 
+    def _chat(self, prompts: list[ChatPrompt]) -> list[list[str]]:
+        """Chat with the prompts of a round.
+        The prompts are sent concurrently by `async_chat` if the generator implements it,
+        as the `chat` of the API-based generators (e.g. OpenAI and Anthropic) sends the prompts serially.
+        """
+        native_async = type(self.generator).async_chat is not GeneratorBase.async_chat
+        if (len(prompts) <= 1) or (not native_async):
+            return self.generator.chat(prompts=prompts)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.generator.async_chat(prompts=prompts))
+        # `asyncio.run` could not be called in a running event loop
+        with ThreadPoolExecutor(1) as pool:
+            return pool.submit(
+                asyncio.run, self.generator.async_chat(prompts=prompts)
+            ).result()
+
     @TIME_METER("rankgpt_rank")
     async def _async_rank(
         self, query: str, candidates: list[str]
     ) -> tuple[np.ndarray, None]:
-        # perform slide window ranking
-        indices = list(range(len(candidates)))
-        start_idx = max(len(candidates) - self.window_size, 0)
-        end_idx = len(candidates)
+        schedule = self._get_schedule(len(candidates))
+        windows, indices = _advance(schedule, None)
+        while windows is not None:
+            # the windows in the same round are ranked concurrently
+            prompts = [
+                self._get_prompt(query, [candidates[i] for i in window])
+                for window in windows
+            ]
+            responses = await self.generator.async_chat(prompts=prompts)
+            rankings = [
+                self._parse_response(r[0], len(w)) for r, w in zip(responses, windows)
+            ]
+            windows, indices = _advance(schedule, rankings)
+        return np.array(indices), None
+
+    @TIME_METER("rankgpt_rank")
+    def _rank_batch(
+        self, queries: list[str], candidates: list[list[str]]
+    ) -> list[tuple[np.ndarray, None]]:
+        if not self.batch_queries:
+            return super()._rank_batch(queries, candidates)
+
+        # advance the schedules of all queries in lockstep
+        schedules = [self._get_schedule(len(cands)) for cands in candidates]
+        pending = {}
+        results = [None] * len(queries)
+        for n, schedule in enumerate(schedules):
+            windows, indices = _advance(schedule, None)
+            if windows is None:
+                results[n] = (np.array(indices), None)
+            else:
+                pending[n] = windows
+        while pending:
+            # rank the windows of all pending queries in one call
+            requests = [(n, w) for n, windows in pending.items() for w in windows]
+            prompts = [
+                self._get_prompt(queries[n], [candidates[n][i] for i in w])
+                for n, w in requests
+            ]
+            responses = self._chat(prompts)
+            rankings = {n: [] for n in pending}
+            for (n, w), r in zip(requests, responses):
+                rankings[n].append(self._parse_response(r[0], len(w)))
+            for n in list(pending.keys()):
+                windows, indices = _advance(schedules[n], rankings[n])
+                if windows is None:
+                    results[n] = (np.array(indices), None)
+                    pending.pop(n)
+                else:
+                    pending[n] = windows
+        return results
+
+    def _get_schedule(self, num: int) -> Generator[list[list[int]], list, list[int]]:
+        """Get the ranking schedule of the candidates.
+        The schedule yields the windows (lists of candidate indices) of each round,
+        receives the ranking of each window, and returns the final order of the candidates.
+        """
+        if self.window_strategy == "tournament":
+            return self._tournament(num)
+        return self._sliding_window(num)
+
+    def _sliding_window(self, num: int) -> Generator[list[list[int]], list, list[int]]:
+        # perform slide window ranking from the tail to the head
+        indices = list(range(num))
+        start_idx = max(num - self.window_size, 0)
+        end_idx = num
         while start_idx >= 0:
             start_idx = max(start_idx, 0)
-            candidates_ = [candidates[i] for i in indices[start_idx:end_idx]]
-            indices_, _ = await self._async_rank_piece(query, candidates_)
-            indices[start_idx:end_idx] = indices_
+            window = indices[start_idx:end_idx]
+            ranking = (yield [window])[0]
+            indices[start_idx:end_idx] = [window[i] for i in ranking]
             start_idx = start_idx - self.step_size
             end_idx -= self.step_size
-        return np.array(indices), None
-
-    def _rank_piece(self, query: str, candidates: list[str]) -> tuple[np.ndarray, None]:
-        prompt = self._get_prompt(query=query, candidates=candidates)
-        response = self.generator.chat(prompts=[prompt])[0][0]
-
+        return indices
+
+    def _tournament(self, num: int) -> Generator[list[list[int]], list, list[int]]:
+        # rank the non-overlapping windows concurrently and promote the winners
+        pool = list(range(num))
+        eliminated = []
+        while len(pool) > self.window_size:
+            windows = [
+                pool[i : i + self.window_size]
+                for i in range(0, len(pool), self.window_size)
+            ]
+            rankings = yield windows
+            ranked = [[w[i] for i in r] for w, r in zip(windows, rankings)]
+            pool = [idx for r in ranked for idx in r[: self.step_size]]
+            # interleave the eliminated candidates by their ranks in the windows
+            losers = [r[self.step_size :] for r in ranked]
+            eliminated = [
+                r[pos]
+                for pos in range(self.window_size - self.step_size)
+                for r in losers
+                if pos < len(r)
+            ] + eliminated
+
+        # refine the top candidates
+        if len(pool) > 1:
+            ranking = (yield [pool])[0]
+            pool = [pool[i] for i in ranking]
+        return pool + eliminated
+
+    def _parse_response(self, response: str, num: int) -> list[int]:
         # convert string to indices
         response = re.sub(r"\D", " ", response)
         indices_ = [int(x) - 1 for x in response.split()]
@@ -91,36 +215,12 @@ class RankGPTRanker(RankerBase):
                 indices.append(i)
 
         # refine indices
-        ori_indices = list(range(len(candidates)))
+        ori_indices = list(range(num))
         new_indices = [idx for idx in indices if idx in ori_indices]
         new_indices = new_indices + [
             idx for idx in ori_indices if idx not in new_indices
         ]
-        return new_indices, None
-
-    async def _async_rank_piece(
-        self, query: str, candidates: list[str]
-    ) -> tuple[np.ndarray, None]:
-        prompt = self._get_prompt(query=query, candidates=candidates)
-        response = (await self.generator.async_chat(prompts=[prompt]))[0][0]
-
-        # convert string to indices
-        response = re.sub(r"\D", " ", response)
-        indices_ = [int(x) - 1 for x in response.split()]
-
-        # deduplicate indices
-        indices = []
-        for i in indices_:
-            if i not in indices:
-                indices.append(i)
-
-        # refine indices
-        ori_indices = list(range(len(candidates)))
-        new_indices = [idx for idx in indices if idx in ori_indices]
-        new_indices = new_indices + [
-            idx for idx in ori_indices if idx not in new_indices
-        ]
-        return new_indices, None
+        return new_indices
 
     def _get_prompt(self, query: str, candidates: list[str]):
         max_length = 300
@@ -143,3 +243,13 @@ class RankGPTRanker(RankerBase):
             )
         prompt.update(last_turn)
         return prompt
+
+
+def _advance(
+    schedule: Generator[list[list[int]], list, list[int]], rankings: Optional[list]
+) -> tuple[Optional[list[list[int]]], Optional[list[int]]]:
+    """Send the rankings to the schedule, return the next windows or the final order."""
+    try:
+        return schedule.send(rankings), None
+    except StopIteration as e:
+        return None, e.value
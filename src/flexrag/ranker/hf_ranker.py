@@ -1,19 +1,26 @@
 import asyncio
+import json
 import math
 from dataclasses import dataclass
+from typing import Iterable, Optional
 
 import torch
 import numpy as np
 
 from flexrag.models.hf_model import HFModelConfig, load_hf_model, HFGenerationConfig
-from flexrag.utils import TIME_METER
+from flexrag.models.utils import bucket_by_length
+from flexrag.retriever import RetrievedContext
+from flexrag.utils import TIME_METER, Choices
 
-from .ranker import RankerBase, RankerBaseConfig, RANKERS
+from .colbert_token_store import ColBertTokenStore
+from .ranker import RankerBase, RankerBaseConfig, RANKERS, RankingResult
 
 
 @dataclass
 class HFCrossEncoderRankerConfig(RankerBaseConfig, HFModelConfig):
     max_encode_length: int = 512
+    # the token budget of each batch, None means no limit
+    max_tokens: Optional[int] = 65536
 
 
 @RANKERS("hf_cross_encoder", config_class=HFCrossEncoderRankerConfig)
@@ -30,23 +37,36 @@ class HFCrossEncoderRanker(RankerBase):
             trust_remote_code=cfg.trust_remote_code,
         )
         self.max_encode_length = cfg.max_encode_length
+        self.max_tokens = cfg.max_tokens
         return
 
+    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        return self._rank_batch([query], [candidates])[0]
+
     @TIME_METER("hf_rank")
     @torch.no_grad()
-    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
-        # score the candidates
-        input_texts = [(query, cand) for cand in candidates]
+    def _rank_batch(
+        self, queries: list[str], candidates: list[list[str]]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        # score the (query, candidate) pairs of all queries together
+        input_texts = [
+            (q, cand) for q, cands in zip(queries, candidates) for cand in cands
+        ]
         inputs = self.tokenizer(
             input_texts,
-            return_tensors="pt",
             max_length=self.max_encode_length,
-            padding=True,
             truncation=True,
         )
-        inputs = inputs.to(self.model.device)
-        scores = self.model(**inputs).logits.squeeze().cpu().numpy()
-        return None, scores
+        scores = np.zeros(len(input_texts), dtype=np.float32)
+        for batch in _get_batches(inputs, self.max_tokens):
+            batch_inputs = self.tokenizer.pad(
+                {key: [value[i] for i in batch] for key, value in inputs.items()},
+                return_tensors="pt",
+            )
+            batch_inputs = batch_inputs.to(self.model.device)
+            logits = self.model(**batch_inputs).logits.squeeze(-1)
+            scores[batch] = logits.float().cpu().numpy()
+        return _split_scores(scores, candidates)
 
     async def _async_rank(
         self, query: str, candidates: list[str]
@@ -60,6 +80,8 @@ class HFSeq2SeqRankerConfig(RankerBaseConfig, HFModelConfig):
     input_template: str = "Query: {query} Document: {candidate} Relevant:"
     positive_token: str = "▁true"
     negative_token: str = "▁false"
+    # the token budget of each batch, None means no limit
+    max_tokens: Optional[int] = 65536
 
 
 @RANKERS("hf_seq2seq", config_class=HFSeq2SeqRankerConfig)
@@ -82,36 +104,47 @@ class HFSeq2SeqRanker(RankerBase):
         self.generation_config = HFGenerationConfig(
             max_new_tokens=1, output_logits=True
         )
+        self.max_tokens = cfg.max_tokens
         return
 
+    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        return self._rank_batch([query], [candidates])[0]
+
     @TIME_METER("hf_rank")
     @torch.no_grad()
-    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
-        # prepare prompts
+    def _rank_batch(
+        self, queries: list[str], candidates: list[list[str]]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        # prepare prompts of all queries
         input_texts = [
-            self.input_template.format(query=query, candidate=cand)
-            for cand in candidates
+            self.input_template.format(query=q, candidate=cand)
+            for q, cands in zip(queries, candidates)
+            for cand in cands
         ]
         inputs = self.tokenizer(
             input_texts,
-            return_tensors="pt",
             max_length=self.max_encode_length,
-            padding=True,
             truncation=True,
         )
-        inputs = inputs.to(self.model.device)
-        outputs = self.model.generate(
-            **inputs,
-            generation_config=self.generation_config,
-            return_dict_in_generate=True,
-        )
-        logits = outputs.logits[0]
-        positive_scores = logits[:, self.positive_token : self.positive_token + 1]
-        negative_scores = logits[:, self.negative_token : self.negative_token + 1]
-        scores = torch.softmax(
-            torch.cat([positive_scores, negative_scores], dim=1), dim=1
-        )[:, 0].cpu().numpy()  # fmt: skip
-        return None, scores
+        scores = np.zeros(len(input_texts), dtype=np.float32)
+        for batch in _get_batches(inputs, self.max_tokens):
+            batch_inputs = self.tokenizer.pad(
+                {key: [value[i] for i in batch] for key, value in inputs.items()},
+                return_tensors="pt",
+            )
+            batch_inputs = batch_inputs.to(self.model.device)
+            outputs = self.model.generate(
+                **batch_inputs,
+                generation_config=self.generation_config,
+                return_dict_in_generate=True,
+            )
+            logits = outputs.logits[0]
+            positive_scores = logits[:, self.positive_token : self.positive_token + 1]
+            negative_scores = logits[:, self.negative_token : self.negative_token + 1]
+            scores[batch] = torch.softmax(
+                torch.cat([positive_scores, negative_scores], dim=1), dim=1
+            )[:, 0].float().cpu().numpy()  # fmt: skip
+        return _split_scores(scores, candidates)
 
     async def _async_rank(
         self, query: str, candidates: list[str]
@@ -127,11 +160,24 @@ class HFColBertRankerConfig(RankerBaseConfig, HFModelConfig):
     query_token: str = "[unused0]"
     document_token: str = "[unused1]"
     normalize_embeddings: bool = True
+    # the token budget of each batch, None means no limit
+    max_tokens: Optional[int] = 65536
+    # the path of the precomputed document token embeddings,
+    # None means the documents are always encoded on the fly
+    token_store_path: Optional[str] = None
+    token_store_precision: Choices(["float32", "float16", "int8"]) = "float16"  # type: ignore
+    # the field of the passage id used to look up the token store
+    id_field: str = "id"
 
 
 @RANKERS("hf_colbert", config_class=HFColBertRankerConfig)
 class HFColBertRanker(RankerBase):
-    """Code adapted from https://github.com/hotchpotch/JQaRA/blob/main/evaluator/reranker/colbert_reranker.py"""
+    """Code adapted from https://github.com/hotchpotch/JQaRA/blob/main/evaluator/reranker/colbert_reranker.py
+
+    If `token_store_path` is set, the token embeddings of the passages added by `add_passages`
+    are stored on disk and looked up by the `id_field` of the candidates,
+    so that only the query and the unseen candidates are encoded when ranking.
+    """
 
     def __init__(self, cfg: HFColBertRankerConfig) -> None:
         super().__init__(cfg)
@@ -151,31 +197,179 @@ class HFColBertRanker(RankerBase):
             cfg.document_token
         )
         self.normalize = cfg.normalize_embeddings
+        self.max_tokens = cfg.max_tokens
+
+        # load the token store
+        self.id_field = cfg.id_field
+        if cfg.token_store_path is not None:
+            # the token embeddings depend on the model and the document encoding
+            identity = {
+                "model_path": cfg.model_path,
+                "base_model_type": cfg.base_model_type,
+                "output_dim": cfg.output_dim,
+                "max_encode_length": cfg.max_encode_length,
+                "document_token": cfg.document_token,
+                "normalize_embeddings": cfg.normalize_embeddings,
+            }
+            self.token_store = ColBertTokenStore(
+                cfg.token_store_path,
+                precision=str(cfg.token_store_precision),
+                model_identity=json.dumps(identity, sort_keys=True),
+            )
+        else:
+            self.token_store = None
         return
 
-    @TIME_METER("hf_rank")
-    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
-        # tokenize the query & candidates
-        query_inputs = self._query_encode([query])
-        cand_inputs = self._document_encode(candidates)
-        # encode the query & candidates
-        query_embeds = self._encode(query_inputs)
-        cand_embeds = self._encode(cand_inputs)
-        # compute the scores using maxsim(max-cosine)
-        token_scores = torch.einsum("qin,pjn->qipj", query_embeds, cand_embeds)
-        token_scores = token_scores.masked_fill(
-            cand_inputs["attention_mask"].unsqueeze(0).unsqueeze(0) == 0, -1e4
+    def add_passages(self, passages: Iterable[dict], batch_size: int = 1024) -> None:
+        """Encode the passages and add their token embeddings to the token store.
+
+        :param passages: The passages to add, each passage should contain the `id_field` and the `ranking_field`.
+        :type passages: Iterable[dict]
+        :param batch_size: The number of passages written to the token store at a time. Defaults to 1024.
+        :type batch_size: int
+        :return: None
+        """
+        assert self.token_store is not None, "`token_store_path` is not set."
+        assert self.ranking_field is not None, "`ranking_field` is not set."
+
+        def add_batch(ids: list[str], docs: list[str]) -> None:
+            doc_embeds = self._encode_documents(docs)
+            self.token_store.add(ids, [emb.float().cpu().numpy() for emb in doc_embeds])
+            return
+
+        ids, docs = [], []
+        for passage in passages:
+            ids.append(passage[self.id_field])
+            docs.append(passage[self.ranking_field])
+            if len(docs) == batch_size:
+                add_batch(ids, docs)
+                ids, docs = [], []
+        if len(docs) > 0:
+            add_batch(ids, docs)
+        return
+
+    def rank(
+        self, query: str, candidates: list[RetrievedContext | str]
+    ) -> RankingResult:
+        if self.token_store is None:
+            return super().rank(query, candidates)
+        return self.rank_batch([query], [candidates])[0]
+
+    async def async_rank(
+        self, query: str, candidates: list[RetrievedContext | str]
+    ) -> RankingResult:
+        if self.token_store is None:
+            return await super().async_rank(query, candidates)
+        return await asyncio.to_thread(self.rank, query, candidates)
+
+    def rank_batch(
+        self,
+        queries: list[str],
+        candidates: list[list[RetrievedContext | str]],
+    ) -> list[RankingResult]:
+        if self.token_store is None:
+            return super().rank_batch(queries, candidates)
+
+        # pass the passage ids of the candidates to look up the token store
+        non_empty = [n for n, cands in enumerate(candidates) if len(cands) > 0]
+        ranked = self._cached_rank_batch(
+            [queries[n] for n in non_empty],
+            [self._get_texts(candidates[n]) for n in non_empty],
+            doc_ids=[
+                [
+                    (
+                        c.data.get(self.id_field)
+                        if isinstance(c, RetrievedContext)
+                        else None
+                    )
+                    for c in candidates[n]
+                ]
+                for n in non_empty
+            ],
         )
-        scores, _ = token_scores.max(-1)
-        scores = scores.sum(1) / query_inputs["attention_mask"].sum(-1, keepdim=True)
-        scores = scores.cpu().squeeze().float().numpy()
-        return None, scores
+        results = [RankingResult(query=q, candidates=[]) for q in queries]
+        for n, (indices, scores) in zip(non_empty, ranked):
+            results[n] = self._get_result(queries[n], candidates[n], indices, scores)
+        return results
+
+    def _rank(self, query: str, candidates: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        return self._rank_batch([query], [candidates])[0]
 
     async def _async_rank(
         self, query: str, candidates: list[str]
     ) -> tuple[np.ndarray, np.ndarray]:
         return await asyncio.to_thread(self._rank, query, candidates)
 
+    @TIME_METER("hf_rank")
+    @torch.no_grad()
+    def _rank_batch(
+        self,
+        queries: list[str],
+        candidates: list[list[str]],
+        doc_ids: Optional[list[list[Optional[str]]]] = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        # encode each query once, the queries are encoded separately
+        # as the length of the query augmentation depends on the query
+        query_embeds = []
+        query_lengths = []
+        for query in queries:
+            query_inputs = self._query_encode([query])
+            query_embeds.append(self._encode(query_inputs)[0])
+            query_lengths.append(query_inputs["attention_mask"].sum())
+
+        # look up the token store and encode the missing candidates of all queries together
+        docs = [cand for cands in candidates for cand in cands]
+        doc_embeds: list[Optional[torch.Tensor]] = [None] * len(docs)
+        if (doc_ids is not None) and (self.token_store is not None):
+            flat_ids = [pid for ids in doc_ids for pid in ids]
+            for n, emb in enumerate(self.token_store.get(flat_ids)):
+                if emb is not None:
+                    doc_embeds[n] = torch.from_numpy(emb).to(self.model.device)
+        missing = [n for n, emb in enumerate(doc_embeds) if emb is None]
+        for n, emb in zip(missing, self._encode_documents([docs[n] for n in missing])):
+            doc_embeds[n] = emb
+
+        # compute the scores using maxsim(max-cosine)
+        results = []
+        bounds = np.cumsum([0] + [len(c) for c in candidates])
+        for query_id, query_embed in enumerate(query_embeds):
+            embeds = doc_embeds[bounds[query_id] : bounds[query_id + 1]]
+            lengths = torch.tensor([emb.shape[0] for emb in embeds])
+            embeds = torch.nn.utils.rnn.pad_sequence(embeds, batch_first=True)
+            token_scores = torch.einsum(
+                "in,pjn->pij", query_embed, embeds.to(query_embed.dtype)
+            )
+            mask = torch.arange(embeds.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)
+            token_scores = token_scores.masked_fill(
+                ~mask.unsqueeze(1).to(token_scores.device), -1e4
+            )
+            scores = token_scores.max(-1)[0].sum(1) / query_lengths[query_id]
+            results.append((None, scores.float().cpu().numpy()))
+        return results
+
+    @torch.no_grad()
+    def _encode_documents(self, documents: list[str]) -> list[torch.Tensor]:
+        """Encode the documents into the token embeddings without padding."""
+        inputs = self.tokenizer(
+            documents, max_length=self.max_encode_length - 1, truncation=True
+        )
+        doc_embeds = [None] * len(documents)
+        for batch in _get_batches(inputs, self.max_tokens):
+            # pad the tokenized documents instead of tokenizing them again
+            doc_inputs = self.tokenizer.pad(
+                {key: [value[i] for i in batch] for key, value in inputs.items()},
+                return_tensors="pt",
+            )
+            doc_inputs = self._insert_token(doc_inputs, self.document_token_id)
+            doc_inputs = {
+                key: value.to(self.model.device) for key, value in doc_inputs.items()
+            }
+            embeds = self._encode(doc_inputs)
+            lengths = doc_inputs["attention_mask"].sum(-1).tolist()
+            for i, emb, length in zip(batch, embeds, lengths):
+                doc_embeds[i] = emb[:length]
+        return doc_embeds
+
     @torch.no_grad()
     def _tokenize(self, texts: list[str], insert_token_id: int, is_query: bool = False):
         # tokenize the input
@@ -271,3 +465,19 @@ class HFColBertRanker(RankerBase):
 
     def _document_encode(self, documents: list[str]):
         return self._tokenize(documents, self.document_token_id)
+
+
+def _get_batches(inputs: dict[str, list], max_tokens: Optional[int]) -> list[list[int]]:
+    """Group the tokenized inputs into batches under the token budget."""
+    lengths = [len(ids) for ids in inputs["input_ids"]]
+    if max_tokens is None:
+        return [list(range(len(lengths)))]
+    return bucket_by_length(lengths, max_tokens)
+
+
+def _split_scores(
+    scores: np.ndarray, candidates: list[list[str]]
+) -> list[tuple[None, np.ndarray]]:
+    """Scatter the flattened scores back to each query."""
+    bounds = np.cumsum([0] + [len(c) for c in candidates])
+    return [(None, scores[bounds[n] : bounds[n + 1]]) for n in range(len(candidates))]
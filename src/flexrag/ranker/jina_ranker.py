@@ -15,6 +15,7 @@ class JinaRankerConfig(RankerBaseConfig):
     model: str = "jina-reranker-v2-base-multilingual"
     base_url: str = "https://api.jina.ai/v1/rerank"
     api_key: str = MISSING
+    max_concurrency: int = 8
 
 
 @RANKERS("jina", config_class=JinaRankerConfig)
@@ -42,7 +43,9 @@ class JinaRanker(RankerBase):
         data["top_n"] = len(candidates)
         response = requests.post(self.base_url, json=data, headers=self.headers)
         response.raise_for_status()
-        scores = [i["relevance_score"] for i in response.json()["results"]]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in response.json()["results"]:
+            scores[r["index"]] = r["relevance_score"]
         return None, scores
 
     @TIME_METER("jina_rank")
@@ -59,5 +62,7 @@ class JinaRanker(RankerBase):
             )
         )
         response.raise_for_status()
-        scores = [i["relevance_score"] for i in response.json()["results"]]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in response.json()["results"]:
+            scores[r["index"]] = r["relevance_score"]
         return None, scores
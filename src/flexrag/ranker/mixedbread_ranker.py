@@ -17,6 +17,7 @@ class MixedbreadRankerConfig(RankerBaseConfig):
     base_url: Optional[str] = None
     api_key: str = MISSING
     proxy: Optional[str] = None
+    max_concurrency: int = 8
 
 
 @RANKERS("mixedbread", config_class=MixedbreadRankerConfig)
@@ -43,7 +44,9 @@ class MixedbreadRanker(RankerBase):
             model=self.model,
             top_k=len(candidates),
         )
-        scores = [i.score for i in result.data]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in result.data:
+            scores[r.index] = r.score
         return None, scores
 
     @TIME_METER("mixedbread_rank")
@@ -59,5 +62,7 @@ class MixedbreadRanker(RankerBase):
                 top_k=len(candidates),
             )
         )
-        scores = [i.score for i in result.data]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in result.data:
+            scores[r.index] = r.score
         return None, scores
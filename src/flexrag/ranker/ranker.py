@@ -1,20 +1,43 @@
+import json
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from hashlib import blake2b
 from typing import Optional
 
 import numpy as np
+from omegaconf import OmegaConf
 
+from flexrag.cache import (
+    NON_IDENTITY_KEYS,
+    PersistentCache,
+    PersistentCacheConfig,
+    strip_identity,
+)
 from flexrag.retriever import RetrievedContext
 from flexrag.utils import Register, LOGGER_MANAGER
 
 
 logger = LOGGER_MANAGER.get_logger("flexrag.rankers")
 
+# the arguments that do not affect the scores, the candidate texts are hashed instead of `ranking_field`
+_NON_RANKER_IDENTITY_KEYS = NON_IDENTITY_KEYS + [
+    "reserve_num",
+    "ranking_field",
+    "max_concurrency",
+    "use_score_cache",
+    "score_cache_config",
+]
+
 
 @dataclass
 class RankerBaseConfig:
     reserve_num: int = -1
     ranking_field: Optional[str] = None
+    max_concurrency: int = 1
+    # cache the scores of the (query, candidate) pairs to skip the scored pairs
+    use_score_cache: bool = False
+    score_cache_config: PersistentCacheConfig = field(default_factory=PersistentCacheConfig)  # fmt: skip
 
 
 @dataclass
@@ -25,9 +48,26 @@ class RankingResult:
 
 
 class RankerBase(ABC):
+    # the rankers that only return the order of the candidates (e.g. listwise rankers)
+    # cache the order of the whole candidate list instead of the score of each pair
+    cache_listwise: bool = False
+
     def __init__(self, cfg: RankerBaseConfig) -> None:
         self.reserve_num = cfg.reserve_num
         self.ranking_field = cfg.ranking_field
+        self.max_concurrency = cfg.max_concurrency
+
+        # load score cache
+        if cfg.use_score_cache:
+            self.score_cache = PersistentCache(cfg.score_cache_config)
+            # the arguments that do not affect the scores are excluded from the identity
+            identity = OmegaConf.to_container(OmegaConf.structured(cfg))
+            identity = strip_identity(identity, _NON_RANKER_IDENTITY_KEYS)
+            self.ranker_identity = (
+                f"{self.__class__.__name__}:{json.dumps(identity, sort_keys=True)}"
+            )
+        else:
+            self.score_cache = None
         return
 
     def rank(
@@ -42,35 +82,68 @@ class RankerBase(ABC):
         :return: indices and scores of the ranked candidates.
         :rtype: tuple[np.ndarray, np.ndarray]
         """
-        if isinstance(candidates[0], RetrievedContext):
-            assert self.ranking_field is not None
-            texts = [ctx.data[self.ranking_field] for ctx in candidates]
+        texts = self._get_texts(candidates)
+        if self.score_cache is None:
+            indices, scores = self._rank(query, texts)
         else:
-            texts = candidates
-        indices, scores = self._rank(query, texts)
-        if indices is None:
-            assert scores is not None
-            indices = np.argsort(scores)[::-1]
-        if self.reserve_num > 0:
-            indices = indices[: self.reserve_num]
-
-        result = RankingResult(query=query, candidates=[])
-        for idx in indices:
-            result.candidates.append(candidates[idx])
-        if scores is not None:
-            result.scores = [scores[idx] for idx in indices]
-        return result
+            indices, scores = self._cached_rank_batch([query], [texts])[0]
+        return self._get_result(query, candidates, indices, scores)
 
     async def async_rank(
         self, query: str, candidates: list[RetrievedContext | str]
     ) -> RankingResult:
         """The asynchronous version of `rank`."""
+        texts = self._get_texts(candidates)
+        if self.score_cache is None:
+            indices, scores = await self._async_rank(query, texts)
+            return self._get_result(query, candidates, indices, scores)
+
+        keys, ranked, requests = self._lookup_cache([query], [texts])
+        if requests:
+            ((n, selected),) = requests
+            new_ranked = await self._async_rank(query, [texts[i] for i in selected])
+            self._update_cache(keys, ranked, requests, [new_ranked])
+        indices, scores = ranked[0]
+        return self._get_result(query, candidates, indices, scores)
+
+    def rank_batch(
+        self,
+        queries: list[str],
+        candidates: list[list[RetrievedContext | str]],
+    ) -> list[RankingResult]:
+        """Rank the candidates of a batch of queries.
+
+        :param queries: The queries.
+        :type queries: list[str]
+        :param candidates: The candidates of each query.
+        :type candidates: list[list[RetrievedContext | str]]
+        :return: The ranking result of each query.
+        :rtype: list[RankingResult]
+        """
+        # the queries without candidates are skipped
+        non_empty = [n for n, cands in enumerate(candidates) if len(cands) > 0]
+        ranked = self._cached_rank_batch(
+            [queries[n] for n in non_empty],
+            [self._get_texts(candidates[n]) for n in non_empty],
+        )
+        results = [RankingResult(query=q, candidates=[]) for q in queries]
+        for n, (indices, scores) in zip(non_empty, ranked):
+            results[n] = self._get_result(queries[n], candidates[n], indices, scores)
+        return results
+
+    def _get_texts(self, candidates: list[RetrievedContext | str]) -> list[str]:
         if isinstance(candidates[0], RetrievedContext):
             assert self.ranking_field is not None
-            texts = [ctx.data[self.ranking_field] for ctx in candidates]
-        else:
-            texts = candidates
-        indices, scores = await self._async_rank(query, texts)
+            return [ctx.data[self.ranking_field] for ctx in candidates]
+        return candidates
+
+    def _get_result(
+        self,
+        query: str,
+        candidates: list[RetrievedContext | str],
+        indices: Optional[np.ndarray],
+        scores: Optional[np.ndarray],
+    ) -> RankingResult:
         if indices is None:
             assert scores is not None
             indices = np.argsort(scores)[::-1]
@@ -104,5 +177,112 @@ class RankerBase(ABC):
         logger.warning("async_rank is not implemented, using the synchronous version.")
         return self._rank(query, candidates)
 
+    def _rank_batch(
+        self, queries: list[str], candidates: list[list[str]]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Rank the candidates of a batch of queries.
+        The default implementation calls `_rank` for each query with `max_concurrency` threads.
+
+        :param queries: The queries.
+        :param candidates: The candidate strings of each query.
+        :type queries: list[str]
+        :type candidates: list[list[str]]
+        :return: indices and scores of the ranked candidates of each query.
+        :rtype: list[tuple[np.ndarray, np.ndarray]]
+        """
+        if self.max_concurrency <= 1:
+            return [self._rank(q, cands) for q, cands in zip(queries, candidates)]
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            return list(pool.map(self._rank, queries, candidates))
+
+    def _cached_rank_batch(
+        self, queries: list[str], candidates: list[list[str]], **candidate_kwargs
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Call `_rank_batch` with the uncached candidates only.
+        The `candidate_kwargs` are the arguments of `_rank_batch` with one value per candidate (e.g. the passage ids),
+        which are selected along with the candidates."""
+        if self.score_cache is None:
+            return self._rank_batch(queries, candidates, **candidate_kwargs)
+        keys, ranked, requests = self._lookup_cache(queries, candidates)
+        if requests:
+            new_ranked = self._rank_batch(
+                [queries[n] for n, _ in requests],
+                [[candidates[n][i] for i in selected] for n, selected in requests],
+                **{
+                    key: [[values[n][i] for i in selected] for n, selected in requests]
+                    for key, values in candidate_kwargs.items()
+                },
+            )
+            self._update_cache(keys, ranked, requests, new_ranked)
+        return ranked
+
+    def _lookup_cache(
+        self, queries: list[str], candidates: list[list[str]]
+    ) -> tuple[list[list[str]], list, list[tuple[int, list[int]]]]:
+        """Look up the score cache.
+
+        :return: The cache keys of each query, the cached results of each query (None if not fully cached),
+            and the (query index, uncached candidate indices) pairs to rank.
+        :rtype: tuple[list[list[str]], list, list[tuple[int, list[int]]]]
+        """
+        if self.cache_listwise:
+            keys = [[self._hash(q, *cands)] for q, cands in zip(queries, candidates)]
+        else:
+            keys = [
+                [self._hash(q, cand) for cand in cands]
+                for q, cands in zip(queries, candidates)
+            ]
+        values = self.score_cache.get_many([key for ks in keys for key in ks])
+
+        ranked = []
+        requests = []
+        offset = 0
+        for n, ks in enumerate(keys):
+            cached = values[offset : offset + len(ks)]
+            offset += len(ks)
+            if self.cache_listwise:
+                if cached[0] is None:
+                    ranked.append(None)
+                    requests.append((n, list(range(len(candidates[n])))))
+                else:
+                    ranked.append((np.array(cached[0]), None))
+                continue
+            missing = [i for i, score in enumerate(cached) if score is None]
+            scores = np.array([np.nan if s is None else s for s in cached])
+            ranked.append((None, scores))
+            if missing:
+                requests.append((n, missing))
+        return keys, ranked, requests
+
+    def _update_cache(
+        self,
+        keys: list[list[str]],
+        ranked: list,
+        requests: list[tuple[int, list[int]]],
+        new_ranked: list[tuple[np.ndarray, np.ndarray]],
+    ) -> None:
+        """Fill the ranking results of the uncached candidates and update the score cache."""
+        new_keys = []
+        new_values = []
+        for (n, selected), (indices, scores) in zip(requests, new_ranked):
+            if self.cache_listwise:
+                if indices is None:
+                    indices = np.argsort(scores)[::-1]
+                ranked[n] = (indices, scores)
+                new_keys.append(keys[n][0])
+                new_values.append([int(i) for i in indices])
+                continue
+            assert scores is not None, "The scores are required for the score cache."
+            ranked[n][1][selected] = scores
+            for i, score in zip(selected, scores):
+                new_keys.append(keys[n][i])
+                new_values.append(float(score))
+        self.score_cache.set_many(new_keys, new_values)
+        return
+
+    def _hash(self, query: str, *candidates: str) -> str:
+        texts = [self.ranker_identity, query, *candidates]
+        return blake2b("\0".join(texts).encode("utf-8"), digest_size=16).hexdigest()
+
 
 RANKERS = Register[RankerBase]("ranker")
@@ -15,6 +15,7 @@ class VoyageRankerConfig(RankerBaseConfig):
     api_key: str = MISSING
     timeout: float = 3.0
     max_retries: int = 3
+    max_concurrency: int = 8
 
 
 @RANKERS("voyage", config_class=VoyageRankerConfig)
@@ -37,7 +38,9 @@ class VoyageRanker(RankerBase):
             model=self.model,
             top_k=len(candidates),
         )
-        scores = [i.relevance_score for i in result.results]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in result.results:
+            scores[r.index] = r.relevance_score
         return None, scores
 
     @TIME_METER("voyage_rank")
@@ -53,5 +56,7 @@ class VoyageRanker(RankerBase):
                 top_k=len(candidates),
             )
         )
-        scores = [i.relevance_score for i in result.results]
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for r in result.results:
+            scores[r.index] = r.relevance_score
         return None, scores
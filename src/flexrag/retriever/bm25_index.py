@@ -0,0 +1,466 @@
+import json
+import os
+import shutil
+import threading
+from typing import Optional
+
+import numpy as np
+from bm25s.scoring import _select_idf_scorer, _select_tfc_scorer
+
+from flexrag.utils import LOGGER_MANAGER, TIME_METER
+
+logger = LOGGER_MANAGER.get_logger("flexrag.retrievers.bm25_index")
+
+
+class BM25Segment:
+    """An immutable segment of the BM25 index.
+    The segment stores the raw term frequencies of a contiguous range of documents in CSC format,
+    so that the BM25 scores could be computed with the up-to-date global statistics.
+
+    The following files are stored in the segment directory:
+        - indptr.npy: The start offset of the postings of each token, with shape [vocab_size + 1].
+        - doc_ids.npy: The segment-local document ids of the postings.
+        - tfs.npy: The term frequencies of the postings.
+        - doc_lens.npy: The length of each document in the segment.
+    """
+
+    def __init__(self, path: str, start: int) -> None:
+        self.path = path
+        self.start = start
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(path, "tfs.npy"), mmap_mode="r")
+        self.doc_lens = np.load(os.path.join(path, "doc_lens.npy"), mmap_mode="r")
+        return
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lens)
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.indptr) - 1
+
+    @staticmethod
+    def write(
+        path: str,
+        tokens: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_lens: np.ndarray,
+        vocab_size: int,
+    ) -> None:
+        """Write the postings to a new segment.
+
+        :param path: The directory of the segment.
+        :type path: str
+        :param tokens: The token id of each posting, sorted in ascending order.
+        :type tokens: np.ndarray
+        :param doc_ids: The segment-local document id of each posting.
+        :type doc_ids: np.ndarray
+        :param tfs: The term frequency of each posting.
+        :type tfs: np.ndarray
+        :param doc_lens: The length of each document in the segment.
+        :type doc_lens: np.ndarray
+        :param vocab_size: The size of the vocabulary.
+        :type vocab_size: int
+        :return: None
+        """
+        os.makedirs(path, exist_ok=True)
+        indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tokens, minlength=vocab_size), out=indptr[1:])
+        np.save(os.path.join(path, "indptr.npy"), indptr)
+        np.save(os.path.join(path, "doc_ids.npy"), doc_ids.astype(np.int32))
+        np.save(os.path.join(path, "tfs.npy"), tfs.astype(np.int32))
+        np.save(os.path.join(path, "doc_lens.npy"), doc_lens.astype(np.int32))
+        return
+
+
+class BM25Index:
+    """An incremental BM25 index composed of multiple immutable segments.
+
+    Adding documents only tokenizes the new documents and writes them to a new segment,
+    while the global statistics (the document frequencies, the number of documents and the average document length)
+    are updated in place. As the BM25 scores are computed with the global statistics at query time,
+    the results are identical to an index built from scratch.
+    Segments are merged with a logarithmic merge policy to keep the number of segments small.
+    The merging is performed out of core, thus the memory usage is bounded by `merge_buffer_size` postings.
+    """
+
+    manifest_name = "manifest.json"
+
+    def __init__(
+        self,
+        index_path: str,
+        method: str = "lucene",
+        idf_method: Optional[str] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        delta: float = 0.5,
+        merge_factor: int = 10,
+        merge_buffer_size: int = 10000000,
+        background_merge: bool = True,
+    ) -> None:
+        self.index_path = index_path
+        self.merge_factor = merge_factor
+        self.merge_buffer_size = merge_buffer_size
+        self.background_merge = background_merge
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._merge_thread: Optional[threading.Thread] = None
+
+        manifest_path = os.path.join(self.index_path, self.manifest_name)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            with open(os.path.join(self.index_path, "vocab.json"), "r") as f:
+                self.vocab: dict[str, int] = json.load(f)
+            self.doc_freqs = np.load(os.path.join(self.index_path, "doc_freqs.npy"))
+        else:
+            os.makedirs(self.index_path, exist_ok=True)
+            manifest = {
+                "method": method,
+                "idf_method": idf_method,
+                "k1": k1,
+                "b": b,
+                "delta": delta,
+                "num_docs": 0,
+                "total_length": 0,
+                "next_segment_id": 0,
+                "segments": [],
+            }
+            self.vocab: dict[str, int] = {}
+            self.doc_freqs = np.zeros(0, dtype=np.int64)
+        self.method = manifest["method"]
+        self.idf_method = manifest["idf_method"] or self.method
+        self.k1 = manifest["k1"]
+        self.b = manifest["b"]
+        self.delta = manifest["delta"]
+        self.num_docs = manifest["num_docs"]
+        self.total_length = manifest["total_length"]
+        self._next_segment_id = manifest["next_segment_id"]
+        self.segments: list[BM25Segment] = []
+        start = 0
+        for name in manifest["segments"]:
+            segment = BM25Segment(os.path.join(self.index_path, name), start)
+            self.segments.append(segment)
+            start += segment.num_docs
+        assert start == self.num_docs, "Inconsistent segments and manifest."
+
+        self._idf_fn = _select_idf_scorer(self.idf_method)
+        self._tfc_fn = _select_tfc_scorer(self.method)
+        return
+
+    @TIME_METER("bm25_index", "add-documents")
+    def add_documents(self, documents: list[list[str]]) -> None:
+        """Add tokenized documents to the index as a new segment.
+
+        :param documents: The tokenized documents.
+        :type documents: list[list[str]]
+        :return: None
+        """
+        if len(documents) == 0:
+            return
+        with self._write_lock:
+            # convert tokens to ids, extending the vocabulary
+            token_ids = []
+            for doc in documents:
+                ids = []
+                for token in doc:
+                    if token not in self.vocab:
+                        self.vocab[token] = len(self.vocab)
+                    ids.append(self.vocab[token])
+                token_ids.append(ids)
+            vocab_size = len(self.vocab)
+
+            # count the (token, document) pairs
+            doc_lens = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+            flat_tokens = np.fromiter(
+                (i for ids in token_ids for i in ids),
+                dtype=np.int64,
+                count=int(doc_lens.sum()),
+            )
+            flat_docs = np.repeat(np.arange(len(documents), dtype=np.int64), doc_lens)
+            pairs, tfs = np.unique(
+                flat_tokens * len(documents) + flat_docs, return_counts=True
+            )
+            tokens = pairs // len(documents)
+            doc_ids = pairs % len(documents)
+
+            # write the new segment
+            with self._lock:
+                segment_path = os.path.join(self.index_path, self._new_segment_name())
+            BM25Segment.write(
+                segment_path,
+                tokens=tokens,
+                doc_ids=doc_ids,
+                tfs=tfs,
+                doc_lens=doc_lens,
+                vocab_size=vocab_size,
+            )
+            doc_freqs = np.zeros(vocab_size, dtype=np.int64)
+            doc_freqs[: len(self.doc_freqs)] = self.doc_freqs
+            doc_freqs += np.bincount(tokens, minlength=vocab_size)
+
+            # update the segments and the global statistics
+            with self._lock:
+                segment = BM25Segment(segment_path, self.num_docs)
+                self.segments = self.segments + [segment]
+                self.doc_freqs = doc_freqs
+                self.num_docs += len(documents)
+                self.total_length += int(doc_lens.sum())
+                self._save(save_vocab=True)
+
+        # merge segments
+        if self.background_merge:
+            if self._merge_thread is None or not self._merge_thread.is_alive():
+                self._merge_thread = threading.Thread(
+                    target=self._merge_loop, daemon=True
+                )
+                self._merge_thread.start()
+        else:
+            self._merge_loop()
+        return
+
+    @TIME_METER("bm25_index", "search")
+    def search(
+        self, queries: list[list[str]], top_k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Search the index with the tokenized queries.
+
+        :param queries: The tokenized queries.
+        :type queries: list[list[str]]
+        :param top_k: The number of documents to return for each query.
+        :type top_k: int
+        :return: The global document ids and the scores with shape [bsz, top_k].
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        with self._lock:
+            segments = self.segments
+            doc_freqs = self.doc_freqs
+            num_docs = self.num_docs
+            avg_length = self.total_length / max(num_docs, 1)
+        top_k = min(top_k, num_docs)
+        tfc_0 = self._tfc_fn(
+            tf_array=0, l_d=0, l_avg=avg_length, k1=self.k1, b=self.b, delta=self.delta
+        )
+        all_indices = np.zeros([len(queries), top_k], dtype=np.int64)
+        all_scores = np.zeros([len(queries), top_k], dtype=np.float32)
+        if top_k == 0:
+            return all_indices, all_scores
+        for n, query in enumerate(queries):
+            # tokens added after the snapshot are ignored
+            token_ids = [self.vocab.get(t, len(doc_freqs)) for t in query]
+            token_ids = [t for t in token_ids if t < len(doc_freqs)]
+            idfs = [self._idf_fn(doc_freqs[t], N=num_docs) for t in token_ids]
+            # the score of the tokens that do not occur in the document
+            base_score = sum(idfs) * tfc_0
+
+            # collect top_k candidates from each segment
+            cand_indices = []
+            cand_scores = []
+            for segment in segments:
+                scores = self._score_segment(
+                    segment, token_ids, idfs, avg_length, tfc_0
+                )
+                k = min(top_k, segment.num_docs)
+                indices = np.argpartition(-scores, k - 1)[:k]
+                cand_indices.append(indices + segment.start)
+                cand_scores.append(scores[indices])
+            cand_indices = np.concatenate(cand_indices)
+            cand_scores = np.concatenate(cand_scores)
+            order = np.argsort(-cand_scores, kind="stable")[:top_k]
+            all_indices[n] = cand_indices[order]
+            all_scores[n] = cand_scores[order] + base_score
+        return all_indices, all_scores
+
+    def _score_segment(
+        self,
+        segment: BM25Segment,
+        token_ids: list[int],
+        idfs: list[float],
+        avg_length: float,
+        tfc_0: float,
+    ) -> np.ndarray:
+        scores = np.zeros(segment.num_docs, dtype=np.float32)
+        for token_id, idf in zip(token_ids, idfs):
+            if token_id >= segment.vocab_size:
+                continue
+            start, end = segment.indptr[token_id], segment.indptr[token_id + 1]
+            if start == end:
+                continue
+            doc_ids = segment.doc_ids[start:end]
+            tfc = self._tfc_fn(
+                tf_array=segment.tfs[start:end].astype(np.float32),
+                l_d=segment.doc_lens[doc_ids],
+                l_avg=avg_length,
+                k1=self.k1,
+                b=self.b,
+                delta=self.delta,
+            )
+            scores[doc_ids] += idf * (tfc - tfc_0)
+        return scores
+
+    def merge_segments(self, segments: Optional[list[BM25Segment]] = None) -> None:
+        """Merge the contiguous segments into a single segment.
+
+        :param segments: The segments to merge. If None, all segments will be merged.
+        :type segments: Optional[list[BM25Segment]]
+        :return: None
+        """
+        if segments is None:
+            segments = list(self.segments)
+        if len(segments) <= 1:
+            return
+        logger.debug(f"Merging {len(segments)} segments.")
+
+        start = segments[0].start
+        vocab_size = max(s.vocab_size for s in segments)
+        counts = np.zeros(vocab_size, dtype=np.int64)
+        for segment in segments:
+            counts[: segment.vocab_size] += np.diff(segment.indptr)
+        indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        del counts
+
+        # prepare the memory-mapped outputs
+        with self._lock:
+            segment_name = self._new_segment_name()
+        segment_path = os.path.join(self.index_path, segment_name)
+        os.makedirs(segment_path, exist_ok=True)
+        np.save(os.path.join(segment_path, "indptr.npy"), indptr)
+        doc_ids_out = np.lib.format.open_memmap(
+            os.path.join(segment_path, "doc_ids.npy"),
+            mode="w+",
+            dtype=np.int32,
+            shape=(int(indptr[-1]),),
+        )
+        tfs_out = np.lib.format.open_memmap(
+            os.path.join(segment_path, "tfs.npy"),
+            mode="w+",
+            dtype=np.int32,
+            shape=(int(indptr[-1]),),
+        )
+        doc_lens_out = np.lib.format.open_memmap(
+            os.path.join(segment_path, "doc_lens.npy"),
+            mode="w+",
+            dtype=np.int32,
+            shape=(sum(s.num_docs for s in segments),),
+        )
+        for segment in segments:
+            offset = segment.start - start
+            doc_lens_out[offset : offset + segment.num_docs] = segment.doc_lens
+
+        # merge the postings token range by token range,
+        # so that at most `merge_buffer_size` postings are loaded into memory at once.
+        # the stable sort keeps the documents of each token in ascending order
+        token_start = 0
+        while token_start < vocab_size:
+            token_end = np.searchsorted(
+                indptr, indptr[token_start] + self.merge_buffer_size, side="right"
+            )
+            token_end = min(max(token_end - 1, token_start + 1), vocab_size)
+            tokens, doc_ids, tfs = [], [], []
+            for segment in segments:
+                t0 = min(token_start, segment.vocab_size)
+                t1 = min(token_end, segment.vocab_size)
+                p0, p1 = segment.indptr[t0], segment.indptr[t1]
+                tokens.append(
+                    np.repeat(
+                        np.arange(t0, t1, dtype=np.int64),
+                        np.diff(segment.indptr[t0 : t1 + 1]),
+                    )
+                )
+                doc_ids.append(segment.doc_ids[p0:p1] + (segment.start - start))
+                tfs.append(segment.tfs[p0:p1])
+            order = np.argsort(np.concatenate(tokens), kind="stable")
+            p0, p1 = indptr[token_start], indptr[token_end]
+            doc_ids_out[p0:p1] = np.concatenate(doc_ids)[order]
+            tfs_out[p0:p1] = np.concatenate(tfs)[order]
+            token_start = token_end
+        doc_ids_out.flush()
+        tfs_out.flush()
+        doc_lens_out.flush()
+        del doc_ids_out, tfs_out, doc_lens_out
+        merged = BM25Segment(segment_path, start)
+
+        # replace the merged segments
+        with self._lock:
+            pos = self.segments.index(segments[0])
+            assert self.segments[pos : pos + len(segments)] == segments
+            self.segments = (
+                self.segments[:pos] + [merged] + self.segments[pos + len(segments) :]
+            )
+            self._save(save_vocab=False)
+        for segment in segments:
+            shutil.rmtree(segment.path)
+        return
+
+    def wait_merging(self) -> None:
+        """Wait for the background merging to finish."""
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+            self._merge_thread = None
+        return
+
+    def _merge_loop(self) -> None:
+        while (segments := self._find_merge()) is not None:
+            self.merge_segments(segments)
+        return
+
+    def _find_merge(self) -> Optional[list[BM25Segment]]:
+        """Find `merge_factor` contiguous segments in the same size level, preferring the newest ones."""
+        segments = self.segments
+        if self.merge_factor < 2:
+            return None
+        levels = []
+        for segment in segments:
+            level, num_docs = 0, segment.num_docs
+            while num_docs >= self.merge_factor:
+                num_docs //= self.merge_factor
+                level += 1
+            levels.append(level)
+        for i in range(len(segments) - self.merge_factor, -1, -1):
+            window = levels[i : i + self.merge_factor]
+            if min(window) == max(window):
+                return segments[i : i + self.merge_factor]
+        return None
+
+    def _new_segment_name(self) -> str:
+        name = f"segment_{self._next_segment_id:06d}"
+        self._next_segment_id += 1
+        return name
+
+    def _save(self, save_vocab: bool) -> None:
+        if save_vocab:
+            vocab_path = os.path.join(self.index_path, "vocab.json")
+            with open(f"{vocab_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(self.vocab, f, ensure_ascii=False)
+            os.replace(f"{vocab_path}.tmp", vocab_path)
+            freqs_path = os.path.join(self.index_path, "doc_freqs.npy")
+            with open(f"{freqs_path}.tmp", "wb") as f:
+                np.save(f, self.doc_freqs)
+            os.replace(f"{freqs_path}.tmp", freqs_path)
+        manifest = {
+            "method": self.method,
+            "idf_method": self.idf_method,
+            "k1": self.k1,
+            "b": self.b,
+            "delta": self.delta,
+            "num_docs": self.num_docs,
+            "total_length": self.total_length,
+            "next_segment_id": self._next_segment_id,
+            "segments": [s.name for s in self.segments],
+        }
+        manifest_path = os.path.join(self.index_path, self.manifest_name)
+        with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+        return
+
+    def __len__(self) -> int:
+        return self.num_docs
@@ -1,12 +1,21 @@
+import multiprocessing
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
-from typing import Iterable, Optional
+from functools import lru_cache
+from itertools import chain, repeat
+from typing import Generator, Iterable, Optional
 
 import bm25s
+import lance
+import pandas as pd
 from omegaconf import MISSING
 
-from flexrag.utils import Choices, LOGGER_MANAGER, TIME_METER
+from flexrag.utils import Choices, LOGGER_MANAGER, SimpleProgressLogger, TIME_METER
 
+from .bm25_index import BM25Index
 from .retriever_base import (
     RETRIEVERS,
     LocalRetriever,
@@ -16,6 +25,28 @@ from .retriever_base import (
 
 logger = LOGGER_MANAGER.get_logger("flexrag.retrievers.bm25s")
 
+_LEGACY_CORPUS = ("corpus.jsonl", "corpus.mmindex.json")
+
+
+@lru_cache
+def _load_stemmer(lang: str):
+    try:
+        import Stemmer
+
+        return Stemmer.Stemmer(lang)
+    except:
+        return None
+
+
+def _tokenize(texts: list[str], lang: str) -> list[list[str]]:
+    return bm25s.tokenize(
+        texts,
+        stopwords=lang,
+        stemmer=_load_stemmer(lang),
+        return_ids=False,
+        show_progress=False,
+    )
+
 
 @dataclass
 class BM25SRetrieverConfig(LocalRetrieverConfig):
@@ -28,6 +59,11 @@ class BM25SRetrieverConfig(LocalRetrieverConfig):
     delta: float = 0.5
     lang: str = "english"
     indexed_fields: Optional[list[str]] = None
+    segment_size: int = 100000
+    merge_factor: int = 10
+    merge_buffer_size: int = 10000000
+    background_merge: bool = True
+    num_workers: int = 1
 
 
 @RETRIEVERS("bm25s", config_class=BM25SRetrieverConfig)
@@ -37,51 +73,122 @@ class BM25SRetriever(LocalRetriever):
     def __init__(self, cfg: BM25SRetrieverConfig) -> None:
         super().__init__(cfg)
         # set basic args
-        try:
-            import Stemmer
-
-            self._stemmer = Stemmer.Stemmer(cfg.lang)
-        except:
-            self._stemmer = None
+        self._stemmer = _load_stemmer(cfg.lang)
 
         # load retriever
         self.database_path = cfg.database_path
-        if os.path.exists(self.database_path) and bool(os.listdir(self.database_path)):
+        self.db_path = os.path.join(self.database_path, "database.lance")
+        self.index_path = os.path.join(self.database_path, "index")
+        if os.path.exists(os.path.join(self.database_path, "params.index.json")):
+            # load the index built by the previous versions
+            logger.warning(
+                "Loading a legacy bm25s index, which does not support adding passages incrementally."
+            )
             self._retriever = bm25s.BM25.load(
                 self.database_path,
                 mmap=True,
                 load_corpus=True,
             )
+            self.index = None
+            self.database = None
         else:
-            os.makedirs(self.database_path, exist_ok=True)
-            self._retriever = bm25s.BM25(
-                method=cfg.method,
-                idf_method=cfg.idf_method,
-                backend=cfg.backend,
-                k1=cfg.k1,
-                b=cfg.b,
-                delta=cfg.delta,
-            )
+            self._retriever = None
+            self.index = self._load_index(cfg)
+            if os.path.exists(self.db_path):
+                self.database = lance.dataset(self.db_path)
+            else:
+                self.database = None
+        self._cfg = cfg
+        if self.database is not None:
+            self._reconcile_database()
+        self.segment_size = cfg.segment_size
+        self.num_workers = cfg.num_workers
         self._lang = cfg.lang
         self._indexed_fields = cfg.indexed_fields
         return
 
     @TIME_METER("bm25s_retriever", "add-passages")
     def add_passages(self, passages: Iterable[dict[str, str]]):
-        logger.warning(
-            "bm25s Retriever does not support add passages. This function will build the index from scratch."
-        )
-        passages = list(passages)
-        if len(self._indexed_fields) == 1:
-            indexed = [p[self._indexed_fields[0]] for p in passages]
+        migrate_legacy = self._retriever is not None
+        if migrate_legacy:
+            # migrate the corpus of the legacy index into the segments first
+            logger.info("Migrating the legacy bm25s index into segments.")
+            self._clean_segments()
+            corpus = self._retriever.corpus
+            legacy_passages = (corpus[i] for i in range(len(corpus)))
+            passages = chain(legacy_passages, passages)
+
+        def get_batch() -> Generator[list[dict[str, str]], None, None]:
+            batch = []
+            for passage in passages:
+                if len(batch) == self.segment_size:
+                    yield batch
+                    batch = []
+                batch.append(passage)
+            if batch:
+                yield batch
+            return
+
+        # only the new passages are tokenized and written to new segments,
+        # thus the memory usage is bounded by `segment_size`
+        build_from_scratch = len(self.index) == 0
+        p_logger = SimpleProgressLogger(logger, interval=self.log_interval)
+        if self.num_workers > 1:
+            # lance is not fork-safe, thus the workers are spawned
+            pool = ProcessPoolExecutor(
+                self.num_workers, mp_context=multiprocessing.get_context("spawn")
+            )
         else:
-            indexed = [" ".join([p[f] for f in self._indexed_fields]) for p in passages]
-        indexed_tokens = bm25s.tokenize(
-            indexed, stopwords=self._lang, stemmer=self._stemmer
-        )
-        self._retriever.index(indexed_tokens)
-        self._retriever.corpus = passages
-        self._retriever.save(self.database_path, corpus=passages)
+            pool = nullcontext()
+        with pool:
+            for batch in get_batch():
+                if len(self._indexed_fields) == 1:
+                    indexed = [p[self._indexed_fields[0]] for p in batch]
+                else:
+                    indexed = [
+                        " ".join([p[f] for f in self._indexed_fields]) for p in batch
+                    ]
+                if self.num_workers > 1:
+                    chunk_size = (len(indexed) - 1) // self.num_workers + 1
+                    chunks = [
+                        indexed[i : i + chunk_size]
+                        for i in range(0, len(indexed), chunk_size)
+                    ]
+                    tokens = list(
+                        chain(*pool.map(_tokenize, chunks, repeat(self._lang)))
+                    )
+                else:
+                    tokens = _tokenize(indexed, self._lang)
+
+                # the database is rolled back if the segment fails to be written
+                data_to_add = pd.DataFrame(batch)
+                if self.database is None:
+                    prev_version = None
+                    self.database = lance.write_dataset(
+                        data_to_add, uri=self.db_path, mode="create"
+                    )
+                else:
+                    prev_version = self.database.version
+                    self.database = lance.write_dataset(
+                        data_to_add,
+                        uri=self.db_path,
+                        mode="append",
+                        schema=self.database.schema,
+                    )
+                try:
+                    self.index.add_documents(tokens)
+                except:
+                    self._rollback_database(prev_version)
+                    raise
+                p_logger.update(step=len(batch), desc="Indexing passages")
+
+        # merge all segments into the final index
+        if build_from_scratch:
+            self.merge_segments()
+        if migrate_legacy:
+            self._remove_legacy_files()
+            self._retriever = None
+        logger.info("Finished adding passages")
         return
 
     @TIME_METER("bm25s_retriever", "search")
@@ -89,12 +196,42 @@ class BM25SRetriever(LocalRetriever):
         self,
         query: list[str],
         **search_kwargs,
+    ) -> list[list[RetrievedContext]]:
+        top_k = search_kwargs.pop("top_k", self.top_k)
+        if self._retriever is not None:
+            return self._legacy_search_batch(query, top_k, **search_kwargs)
+
+        # retrieve
+        indices, scores = self.index.search(_tokenize(query, self._lang), top_k)
+        retrieved = self.database.take(indices.flatten()).to_pylist()
+
+        # form final results
+        results = []
+        for i, (q, score) in enumerate(zip(query, scores)):
+            results.append(
+                [
+                    RetrievedContext(
+                        retriever=self.name,
+                        query=q,
+                        data=retrieved[i * indices.shape[1] + j],
+                        score=float(s),
+                    )
+                    for j, s in enumerate(score)
+                ]
+            )
+        return results
+
+    def _legacy_search_batch(
+        self,
+        query: list[str],
+        top_k: int,
+        **search_kwargs,
     ) -> list[list[RetrievedContext]]:
         # retrieve
         query_tokens = bm25s.tokenize(query, stemmer=self._stemmer, show_progress=False)
         contexts, scores = self._retriever.retrieve(
             query_tokens,
-            k=search_kwargs.get("top_k", self.top_k),
+            k=top_k,
             show_progress=False,
             **search_kwargs,
         )
@@ -115,18 +252,95 @@ class BM25SRetriever(LocalRetriever):
             )
         return results
 
+    def _reconcile_database(self) -> None:
+        """Roll the database back to the version that matches the index.
+        The database is ahead of the index if the process crashed after appending to the database."""
+        num_docs = len(self.index)
+        if self.database.count_rows() == num_docs:
+            return
+        logger.warning("The database is ahead of the index, rolling it back.")
+        versions = sorted((v["version"] for v in self.database.versions()), reverse=True)
+        for version in versions:
+            if self.database.checkout_version(version).count_rows() == num_docs:
+                self._rollback_database(version)
+                return
+        if num_docs == 0:
+            self._rollback_database(None)
+            return
+        raise RuntimeError("Inconsistent index and database.")
+
+    def _rollback_database(self, version: Optional[int]) -> None:
+        """Restore the database to the given version, None means removing the database."""
+        if version is None:
+            shutil.rmtree(self.db_path, ignore_errors=True)
+            self.database = None
+            return
+        self.database.checkout_version(version).restore()
+        self.database = lance.dataset(self.db_path)
+        return
+
+    def merge_segments(self) -> None:
+        """Merge all segments of the index into a single segment."""
+        self.index.wait_merging()
+        self.index.merge_segments()
+        return
+
     def clean(self) -> None:
-        del self._retriever.scores
-        del self._retriever.vocab_dict
+        """Remove the index and the database of the retriever, including the files of the legacy index.
+
+        Different from the previous versions, which only released the in-memory index,
+        the files under `database_path` are deleted.
+        """
+        self._clean_segments()
+        self._remove_legacy_files()
+        self._retriever = None
         return
 
+    def _clean_segments(self) -> None:
+        """Remove the segmented index and the database."""
+        if self.index is not None:
+            self.index.wait_merging()
+        if os.path.exists(self.index_path):
+            shutil.rmtree(self.index_path)
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+        self.database = None
+        self.index = self._load_index(self._cfg)
+        return
+
+    def _remove_legacy_files(self) -> None:
+        """Remove the files of the legacy bm25s index.
+        The `params.index.json` is removed first, thus the segmented index is loaded since then."""
+        params_path = os.path.join(self.database_path, "params.index.json")
+        if os.path.exists(params_path):
+            os.remove(params_path)
+        for name in os.listdir(self.database_path):
+            if name.endswith((".index.json", ".index.npy")) or name in _LEGACY_CORPUS:
+                os.remove(os.path.join(self.database_path, name))
+        return
+
+    def _load_index(self, cfg: BM25SRetrieverConfig) -> BM25Index:
+        return BM25Index(
+            self.index_path,
+            method=cfg.method,
+            idf_method=cfg.idf_method,
+            k1=cfg.k1,
+            b=cfg.b,
+            delta=cfg.delta,
+            merge_factor=cfg.merge_factor,
+            merge_buffer_size=cfg.merge_buffer_size,
+            background_merge=cfg.background_merge,
+        )
+
     def __len__(self) -> int:
-        if hasattr(self._retriever, "scores"):
+        if self._retriever is not None:
             return self._retriever.scores.get("num_docs", 0)
-        return 0
+        return len(self.index)
 
     @property
     def fields(self) -> list[str]:
-        if self._retriever.corpus is not None:
+        if self._retriever is not None:
             return self._retriever.corpus[0].keys()
+        if self.database is not None:
+            return self.database.schema.names
         return []
@@ -1,17 +1,25 @@
+import json
+import math
 import os
 import shutil
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
+from datetime import timedelta
+from itertools import islice
 from typing import Generator, Iterable, Optional
 
 import lance
 import numpy as np
 import pandas as pd
-from omegaconf import MISSING
-from scipy.spatial.distance import cdist
+from omegaconf import MISSING, OmegaConf
 
 from flexrag.models import ENCODERS, EncoderBase
-from flexrag.utils import SimpleProgressLogger, TIME_METER, LOGGER_MANAGER
+from flexrag.utils import Choices, SimpleProgressLogger, TIME_METER, LOGGER_MANAGER
 
+from .embedding_store import EmbeddingQuantizer, EmbeddingStore
 from .index import DenseIndexBase, DENSE_INDEX
 from .retriever_base import (
     RETRIEVERS,
@@ -33,7 +41,101 @@ class DenseRetrieverConfig(LocalRetrieverConfig, DenseIndexConfig):
     query_encoder_config: EncoderConfig = field(default_factory=EncoderConfig)  # type: ignore
     passage_encoder_config: EncoderConfig = field(default_factory=EncoderConfig)  # type: ignore
     refine_factor: int = 1
+    embedding_precision: Choices(["float32", "float16", "int8", "binary"]) = "float32"  # type: ignore
+    use_embedding_store: bool = True
     encode_fields: Optional[list[str]] = None
+    encode_workers: int = 1
+    queue_size: int = 8
+    write_batch_size: int = 65536
+    target_rows_per_fragment: int = 1048576
+    compact_threshold: int = 16
+    version_retention_hours: Optional[float] = None
+    fast_start: bool = False
+    id_field: str = "id"
+    purge_threshold: float = 0.05
+    background_purge: bool = True
+
+
+class _ReadWriteLock:
+    """A lock that allows multiple readers or a single writer.
+    The waiting writers block the new readers, so that the writers are not starved.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        return
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._writers_waiting == 0)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                self._cond.wait_for(lambda: self._readers == 0)
+            finally:
+                self._writers_waiting -= 1
+            try:
+                yield
+            finally:
+                self._cond.notify_all()
+
+
+def _set_index_precision(
+    cfg: DenseRetrieverConfig, precision: str
+) -> DenseRetrieverConfig:
+    """Set the precision of the faiss index (including the faiss shards) to the precision of the embeddings."""
+    if precision not in ["float16", "int8"]:
+        return cfg
+    index_type = DENSE_INDEX[cfg.index_type]["main_name"]
+    if index_type == "FaissIndex":
+        return OmegaConf.merge(cfg, {"faiss_config": {"precision": precision}})
+    if (index_type == "ShardedIndex") and (
+        DENSE_INDEX[cfg.sharded_config.index_type]["main_name"] == "FaissIndex"
+    ):
+        return OmegaConf.merge(
+            cfg, {"sharded_config": {"faiss_config": {"precision": precision}}}
+        )
+    return cfg
+
+
+def _remove_index_files(index_path: str) -> None:
+    """Remove the files of an index, whose names are all prefixed by the `index_path`."""
+    dirname, basename = os.path.split(index_path)
+    if not os.path.exists(dirname):
+        return
+    for name in os.listdir(dirname):
+        if (name == basename) or name.startswith(f"{basename}."):
+            path = os.path.join(dirname, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    return
+
+
+def _move_index_files(src_path: str, dst_path: str) -> None:
+    """Move the files of an index from `src_path` to `dst_path` in the same directory."""
+    dirname, basename = os.path.split(src_path)
+    for name in os.listdir(dirname):
+        if (name == basename) or name.startswith(f"{basename}."):
+            os.replace(
+                os.path.join(dirname, name), f"{dst_path}{name[len(basename):]}"
+            )
+    return
 
 
 @RETRIEVERS("dense", config_class=DenseRetrieverConfig)
@@ -48,10 +150,21 @@ class DenseRetriever(LocalRetriever):
         # set args
         self.database_path = cfg.database_path
         self.encode_fields = cfg.encode_fields
-
-        # load encoder
-        self.query_encoder = ENCODERS.load(cfg.query_encoder_config)
-        self.passage_encoder = ENCODERS.load(cfg.passage_encoder_config)
+        self.encode_workers = cfg.encode_workers
+        self.queue_size = cfg.queue_size
+        self.write_batch_size = cfg.write_batch_size
+        self.target_rows_per_fragment = cfg.target_rows_per_fragment
+        self.compact_threshold = cfg.compact_threshold
+        self.version_retention_hours = cfg.version_retention_hours
+        self.id_field = cfg.id_field
+        self.purge_threshold = cfg.purge_threshold
+        self.background_purge = cfg.background_purge
+        self._lock = _ReadWriteLock()
+        self._purge_thread: Optional[threading.Thread] = None
+        self.checkpoint_path = os.path.join(self.database_path, "checkpoint.json")
+        self.manifest_path = os.path.join(self.database_path, "manifest.json")
+        self.tombstones_path = os.path.join(self.database_path, "tombstones.npy")
+        self.purge_marker_path = os.path.join(self.database_path, "purge.json")
 
         # load database
         self.db_path = os.path.join(self.database_path, "database.lance")
@@ -59,20 +172,121 @@ class DenseRetriever(LocalRetriever):
             self.database = lance.dataset(self.db_path)
         else:
             self.database = None
+        self._manifest = self._load_manifest()
+        self._fields = None if self._manifest is None else self._manifest["fields"]
+        if os.path.exists(self.tombstones_path):
+            self.tombstones = np.load(self.tombstones_path)
+        else:
+            self.tombstones = np.zeros([0], dtype=np.int64)
+
+        # load quantizer
+        self.quantizer = EmbeddingQuantizer(
+            os.path.join(self.database_path, "quantizer"),
+            precision=cfg.embedding_precision,
+        )
+        if (self.database is not None) and (not self.quantizer.is_fitted):
+            if self.quantizer.precision != "float32":
+                logger.warning(
+                    "The database is created without quantization, "
+                    "ignoring the configured precision."
+                )
+            self.quantizer.precision = "float32"
+            self.quantizer.embedding_size = (
+                self.database.head(num_rows=1).to_pandas()["vector"][0].shape[0]
+            )
 
-        # load index
+        # load encoders and index, the faiss index stores the vectors in the same precision
+        self._index_cfg = _set_index_precision(cfg, self.quantizer.precision)
         index_path = os.path.join(self.database_path, f"index.{cfg.index_type}")
-        self.index = DENSE_INDEX.load(cfg, index_path=index_path)
+        if cfg.fast_start:
+            with ThreadPoolExecutor(3) as pool:
+                query_encoder = pool.submit(ENCODERS.load, cfg.query_encoder_config)
+                passage_encoder = pool.submit(ENCODERS.load, cfg.passage_encoder_config)
+                index = pool.submit(
+                    DENSE_INDEX.load, self._index_cfg, index_path=index_path
+                )
+                self.query_encoder = query_encoder.result()
+                self.passage_encoder = passage_encoder.result()
+                self.index = index.result()
+        else:
+            self.query_encoder = ENCODERS.load(cfg.query_encoder_config)
+            self.passage_encoder = ENCODERS.load(cfg.passage_encoder_config)
+            self.index = DENSE_INDEX.load(self._index_cfg, index_path=index_path)
         self.refine_factor = cfg.refine_factor
         self.distance_function = self.index.distance_function
 
+        if (self.quantizer.precision == "binary") and (
+            self.distance_function != "HAMMING"
+        ):
+            raise ValueError(
+                "The binary embeddings should be indexed with the HAMMING distance."
+            )
+        if (self.quantizer.precision != "binary") and (
+            self.distance_function == "HAMMING"
+        ):
+            raise ValueError(
+                "The HAMMING distance requires the binary precision of the embeddings."
+            )
+
+        # load embedding store, which is synced with the database on the first use
+        if cfg.use_embedding_store:
+            self.embedding_store = EmbeddingStore(
+                os.path.join(self.database_path, "embeddings"),
+                dtype=self.quantizer.dtype.name,
+            )
+        else:
+            self.embedding_store = None
+        self._store_lock = threading.Lock()
+        self._store_synced = False
+        self._store_failed = False
+
+        # recover the interrupted purge
+        self._recover_purge()
+
         # consistency check
         if not no_check:
             self._check_consistency()
+
+        # cache the metadata for the next start
+        if cfg.fast_start and (self._manifest is None):
+            try:
+                self._save_manifest()
+            except OSError as e:
+                logger.warning(f"Failed to save the manifest: {e}")
         return
 
     @TIME_METER("dense_retriever", "add-passages")
     def add_passages(self, passages: Iterable[dict[str, str]]):
+        """Add passages to the retriever.
+        The passages are processed by a pipeline with three overlapping stages:
+        reading the passages in the main thread, encoding them with `encode_workers` threads
+        and writing them to the database in a background thread every `write_batch_size` passages.
+        At most `queue_size` batches are encoded at the same time.
+
+        If the previous call is interrupted, calling this method with the same passages
+        will skip the passages that have been written to the database.
+
+        :param passages: The passages to add.
+        :type passages: Iterable[dict[str, str]]
+        :return: None
+        """
+        assert self.passage_encoder is not None, "Passage encoder is not provided."
+        self._wait_purge()
+        self._remove_manifest()
+
+        # resume from the checkpoint
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                start_rows = json.load(f)["start_rows"]
+            skip_num = len(self) - start_rows
+            logger.info(f"Resuming from checkpoint, skipping {skip_num} passages.")
+            passages = islice(passages, skip_num, None)
+            if self.index.is_trained and (len(self.index) < len(self)):
+                self._add_missing_embeddings()
+        else:
+            os.makedirs(self.database_path, exist_ok=True)
+            with open(self.checkpoint_path, "w", encoding="utf-8") as f:
+                json.dump({"start_rows": len(self)}, f)
 
         def get_batch() -> Generator[list[dict[str, str]], None, None]:
             batch = []
@@ -85,11 +299,7 @@ class DenseRetriever(LocalRetriever):
                 yield batch
             return
 
-        # generate embeddings
-        assert self.passage_encoder is not None, "Passage encoder is not provided."
-        p_logger = SimpleProgressLogger(logger, interval=self.log_interval)
-        for batch in get_batch():
-            # encode passages
+        def encode(batch: list[dict[str, str]]) -> list[dict]:
             if len(self.encode_fields) > 1:
                 data_to_encode = [
                     " ".join([f"{key}:{i[key]}" for key in self.encode_fields])
@@ -98,34 +308,471 @@ class DenseRetriever(LocalRetriever):
             else:
                 data_to_encode = [i[self.encode_fields[0]] for i in batch]
             embeddings = self.passage_encoder.encode(data_to_encode)
-            p_logger.update(step=self.batch_size, desc="Encoding passages")
-
-            # add data to database
             for n, emb in enumerate(embeddings):
                 batch[n]["vector"] = emb
-            data_to_add = pd.DataFrame(batch)
-            if self.database is None:
-                lance.write_dataset(data_to_add, uri=self.db_path, mode="create")
-                self.database = lance.dataset(self.db_path)
-            else:
-                self.database = lance.write_dataset(
-                    data_to_add,
-                    uri=self.db_path,
-                    mode="append",
-                    schema=self.database.schema,
-                )
+            return batch
 
-            # add embeddings to index
-            if self.index.is_trained:
-                self.index.add_embeddings(embeddings, serialize=False)
+        def get_encoded() -> Generator[list[dict], None, None]:
+            with ThreadPoolExecutor(self.encode_workers) as pool:
+                encoding: deque[Future] = deque()
+                for batch in get_batch():
+                    if len(encoding) >= self.queue_size:
+                        yield encoding.popleft().result()
+                    encoding.append(pool.submit(encode, batch))
+                while encoding:
+                    yield encoding.popleft().result()
+            return
+
+        # write the encoded passages in the background
+        p_logger = SimpleProgressLogger(logger, interval=self.log_interval)
+        writing: Optional[Future] = None
+        buffer = []
+        with ThreadPoolExecutor(1) as write_pool:
+            for batch in get_encoded():
+                buffer.extend(batch)
+                p_logger.update(step=len(batch), desc="Encoding passages")
+                if len(buffer) >= self.write_batch_size:
+                    if writing is not None:
+                        writing.result()
+                    writing = write_pool.submit(self._write_passages, buffer)
+                    buffer = []
+            if writing is not None:
+                writing.result()
+        if buffer:
+            self._write_passages(buffer)
 
+        if self._need_compact():
+            self.compact()
         if not self.index.is_trained:  # train index from scratch
             self.build_index()
         else:
             self.index.serialize()
+        os.remove(self.checkpoint_path)
+        self._save_manifest()
         logger.info("Finished adding passages")
         return
 
+    def _write_passages(self, passages: list[dict]) -> None:
+        """Write the encoded passages to the database and the index."""
+        # sync the embedding store before the database grows
+        embedding_store = self._get_embedding_store()
+        data_to_add = pd.DataFrame(passages)
+        embeddings = np.stack(data_to_add["vector"])
+        if not self.quantizer.is_fitted:
+            self.quantizer.fit(embeddings)
+        codes = self.quantizer.encode(embeddings)
+        data_to_add["vector"] = list(codes)
+        if self.database is None:
+            lance.write_dataset(
+                data_to_add,
+                uri=self.db_path,
+                mode="create",
+                max_rows_per_file=self.target_rows_per_fragment,
+            )
+            database = lance.dataset(self.db_path)
+        else:
+            database = lance.write_dataset(
+                data_to_add,
+                uri=self.db_path,
+                mode="append",
+                schema=self.database.schema,
+                max_rows_per_file=self.target_rows_per_fragment,
+            )
+
+        # this method runs in the writer thread, thus the searches are blocked while mutating the index
+        with self._lock.write():
+            self.database = database
+            if embedding_store is not None:
+                embedding_store.append(codes)
+            if self.index.is_trained:
+                self.index.add_embeddings(self._get_index_input(codes), serialize=False)
+        return
+
+    def _get_embedding_store(self) -> Optional[EmbeddingStore]:
+        """Get the embedding store synced with the database.
+        The store is synced on the first use instead of loading the retriever,
+        as syncing may copy all the embeddings from the database.
+
+        :return: The synced embedding store, None if the store is disabled or can not be written,
+            in which case the embeddings should be read from the database.
+        :rtype: Optional[EmbeddingStore]
+        """
+        if (self.embedding_store is None) or self._store_synced:
+            return self.embedding_store
+        if self._store_failed:
+            return None
+        with self._store_lock:
+            try:
+                self._sync_embedding_store()
+            except OSError as e:
+                logger.warning(
+                    f"Failed to sync the embedding store: {e}. "
+                    "Reading the embeddings from the database instead."
+                )
+                self._store_failed = True
+                return None
+        return self.embedding_store
+
+    def _sync_embedding_store(self) -> None:
+        """Make the embedding store consistent with the database."""
+        if (self.embedding_store is None) or self._store_synced:
+            return
+        num_rows = len(self)
+        if len(self.embedding_store) > num_rows:
+            self.embedding_store.truncate(num_rows)
+        elif len(self.embedding_store) < num_rows:
+            logger.info("Copying embeddings to the embedding store.")
+            for emb_batch in self.database.to_batches(
+                columns=["vector"],
+                offset=len(self.embedding_store),
+                batch_size=self.write_batch_size,
+            ):
+                emb_batch = np.stack(emb_batch.to_pandas()["vector"])
+                self.embedding_store.append(emb_batch)
+        self._store_synced = True
+        return
+
+    def _iter_codes(
+        self, offset: int = 0, database: Optional[lance.LanceDataset] = None
+    ) -> Generator[np.ndarray, None, None]:
+        """Iterate the quantized embeddings from `offset` in batches of `write_batch_size`.
+        If `database` is provided, the embeddings are read from it instead of the current database."""
+        if database is None:
+            embedding_store = self._get_embedding_store()
+            if embedding_store is not None:
+                for idx in range(offset, len(embedding_store), self.write_batch_size):
+                    yield np.asarray(
+                        embedding_store.data[idx : idx + self.write_batch_size]
+                    )
+                return
+            database = self.database
+        for emb_batch in database.to_batches(
+            columns=["vector"], offset=offset, batch_size=self.write_batch_size
+        ):
+            yield np.stack(emb_batch.to_pandas()["vector"])
+        return
+
+    def _get_query_input(self, query: np.ndarray) -> np.ndarray:
+        """The binary index is searched with the binary codes of the query."""
+        if self.quantizer.precision == "binary":
+            return self.quantizer.encode(query)
+        return query
+
+    def _get_index_input(self, codes: np.ndarray) -> np.ndarray:
+        """The binary codes are indexed as is, while others are indexed in float32."""
+        if self.quantizer.precision == "binary":
+            return codes
+        return self.quantizer.decode(codes)
+
+    def _add_missing_embeddings(self) -> None:
+        """Add the embeddings that are written to the database but not to the index."""
+        logger.info("Adding missing embeddings to the index.")
+        for codes in self._iter_codes(offset=len(self.index)):
+            self.index.add_embeddings(self._get_index_input(codes), serialize=False)
+        return
+
+    @TIME_METER("dense_retriever", "delete-passages")
+    def delete_passages(self, ids: Iterable[str]) -> int:
+        """Delete the passages whose `id_field` is in `ids`.
+        The deleted passages are marked as tombstones and filtered out from the search results,
+        while their rows are purged from the database and the index by `purge_deleted`,
+        which is called in the background once the tombstones exceed `purge_threshold` of the passages.
+        Note that `len(self)` counts the tombstones until they are purged.
+
+        :param ids: The ids of the passages to delete.
+        :type ids: Iterable[str]
+        :return: The number of the deleted passages.
+        :rtype: int
+        """
+        if self.database is None:
+            return 0
+        self._wait_purge()
+        ids = list(ids)
+        row_ids = [self.tombstones]
+        for idx in range(0, len(ids), self.write_batch_size):
+            id_list = ", ".join(
+                [
+                    self._to_sql_literal(i)
+                    for i in ids[idx : idx + self.write_batch_size]
+                ]
+            )
+            rows = self.database.to_table(
+                columns=["_rowoffset"], filter=f"{self.id_field} IN ({id_list})"
+            )
+            row_ids.append(rows.column("_rowoffset").to_numpy().astype(np.int64))
+        tombstones = np.unique(np.concatenate(row_ids))
+        num_deleted = len(tombstones) - len(self.tombstones)
+        with self._lock.write():
+            np.save(self.tombstones_path, tombstones)
+            self.tombstones = tombstones
+        logger.info(
+            f"Deleted {num_deleted} passages, "
+            f"{len(self.tombstones)} tombstones are waiting to be purged."
+        )
+
+        # purge the tombstones
+        if len(self.tombstones) > self.purge_threshold * len(self):
+            if self.background_purge:
+                self._purge_thread = threading.Thread(
+                    target=self.purge_deleted, daemon=True
+                )
+                self._purge_thread.start()
+            else:
+                self.purge_deleted()
+        return num_deleted
+
+    def update_passages(self, passages: Iterable[dict[str, str]]) -> None:
+        """Update the passages by their `id_field`.
+        The old passages are deleted and the new passages are added to the end of the database.
+
+        :param passages: The new passages, each of which should contain the `id_field`.
+        :type passages: Iterable[dict[str, str]]
+        :return: None
+        """
+        passages = list(passages)
+        self.delete_passages([p[self.id_field] for p in passages])
+        self.add_passages(passages)
+        return
+
+    @TIME_METER("dense_retriever", "purge-deleted")
+    def purge_deleted(self) -> None:
+        """Remove the rows of the deleted passages from the database, the embedding store and the index.
+        The index removes the embeddings in place if it supports,
+        otherwise a new index is built from the remaining embeddings.
+        The purged components are prepared while the searches keep reading the old ones,
+        and the searches only wait while they are swapped.
+
+        :return: None
+        """
+        if len(self.tombstones) == 0:
+            return
+        deleted = self.tombstones
+        logger.info(f"Purging {len(deleted)} deleted passages.")
+        self._remove_manifest()
+
+        # record the version before purging, so that an interrupted purge could be recovered
+        marker = {"version": self.database.version, "num_rows": len(self)}
+        self._save_purge_marker(marker)
+
+        try:
+            # delete the rows with another handle, as the searches read the current version,
+            # and delete them from the back, so that the offsets of the rows to delete are not shifted
+            database = lance.dataset(self.db_path)
+            for end in range(len(deleted), 0, -self.write_batch_size):
+                row_ids = deleted[max(end - self.write_batch_size, 0) : end]
+                row_list = ", ".join([str(i) for i in row_ids])
+                database.delete(f"_rowoffset IN ({row_list})")
+            database = lance.dataset(self.db_path)
+            marker["purged_version"] = database.version
+            self._save_purge_marker(marker)
+
+            # remove the embeddings from the embedding store and the index
+            self._apply_purge(deleted, database)
+        except:
+            # roll back or resume the purge, the searches read the old components until then
+            logger.error("Failed to purge the deleted passages, recovering.")
+            self._recover_purge()
+            raise
+        self._finish_purge()
+        self.compact()
+        return
+
+    def _apply_purge(self, deleted: np.ndarray, database: lance.LanceDataset) -> None:
+        """Remove the deleted rows from the embedding store and the index,
+        then swap them and the purged database in.
+        The components that have been purged are skipped,
+        and the index that could not remove the embeddings in place is rebuilt from the purged database.
+
+        :param deleted: The sorted row ids of the deleted passages before purging.
+        :type deleted: np.ndarray
+        :param database: The purged database.
+        :type database: lance.LanceDataset
+        :return: None
+        """
+        num_rows = len(self)
+        num_remains = database.count_rows()
+
+        # write the remaining embeddings to a new file, which replaces the store when swapping
+        store_path = None
+        reset_store = False
+        if self.embedding_store is not None:
+            if len(self.embedding_store) == num_rows:
+                store_path = self.embedding_store.prepare_remove(
+                    deleted, batch_size=self.write_batch_size
+                )
+            elif len(self.embedding_store) != num_remains:
+                reset_store = True
+
+        # the index that could not remove the embeddings in place is rebuilt before swapping
+        new_index = None
+        in_place = (len(self.index) == num_rows) and self.index.support_removal
+        if (len(self.index) != num_remains) and (not in_place):
+            logger.info("The index does not support removing, rebuilding it.")
+            new_index = self._rebuild_index(database)
+
+        with self._lock.write():
+            if in_place:
+                try:
+                    self.index.remove_embeddings(deleted, serialize=False)
+                except Exception as e:
+                    # the index may be modified partially, thus the searches wait for the rebuild
+                    logger.warning(f"Failed to remove the embeddings: {e}, rebuilding the index.")  # fmt: skip
+                    new_index = self._rebuild_index(database)
+            if new_index is not None:
+                self.index = new_index
+            if store_path is not None:
+                self.embedding_store.commit_remove(store_path)
+            elif reset_store:
+                # the store is rebuilt from the database on the next use
+                self.embedding_store.truncate(0)
+                self._store_synced = False
+            self.database = database
+            self.tombstones = np.zeros([0], dtype=np.int64)
+        if (new_index is None) and self.index.is_trained:
+            self.index.serialize()
+        return
+
+    def _finish_purge(self) -> None:
+        """Remove the tombstones and the purge marker after the purged components are saved."""
+        if os.path.exists(self.tombstones_path):
+            os.remove(self.tombstones_path)
+        os.remove(self.purge_marker_path)
+        return
+
+    def _rebuild_index(self, database: lance.LanceDataset) -> DenseIndexBase:
+        """Build a new index with the embeddings in `database` and move it to the path of the current index.
+        The current index is still searchable as it is loaded, until it is replaced by the returned index.
+
+        :param database: The database to build the index from.
+        :type database: lance.LanceDataset
+        :return: The new index.
+        :rtype: DenseIndexBase
+        """
+        index_path = self.index.index_path
+        tmp_path = os.path.join(
+            self.database_path, f"rebuilding.{os.path.basename(index_path)}"
+        )
+        _remove_index_files(tmp_path)
+        index = DENSE_INDEX.load(self._index_cfg, index_path=tmp_path)
+        if database.count_rows() > 0:
+            self._build_index(index, database)
+        del index
+        _remove_index_files(index_path)
+        _move_index_files(tmp_path, index_path)
+        return DENSE_INDEX.load(self._index_cfg, index_path=index_path)
+
+    def _save_purge_marker(self, marker: dict) -> None:
+        tmp_path = f"{self.purge_marker_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(marker, f)
+        os.replace(tmp_path, self.purge_marker_path)
+        return
+
+    def _recover_purge(self) -> None:
+        """Recover the purge interrupted before its marker is removed,
+        either by a crash (when loading the retriever) or by an exception (in `purge_deleted`).
+        If the rows have not been deleted from the database completely,
+        the database is rolled back to the version before purging and the tombstones are kept.
+        Otherwise, the embedding store and the index are purged as well,
+        and the index that could not remove the embeddings is rebuilt.
+        """
+        if not os.path.exists(self.purge_marker_path):
+            return
+        with open(self.purge_marker_path, "r", encoding="utf-8") as f:
+            marker = json.load(f)
+        if "purged_version" not in marker:
+            logger.warning("Found an interrupted purge, rolling back the database.")
+            database = lance.dataset(self.db_path)
+            if database.version != marker["version"]:
+                database.checkout_version(marker["version"]).restore()
+                database = lance.dataset(self.db_path)
+            with self._lock.write():
+                self.database = database
+            os.remove(self.purge_marker_path)
+        elif len(self.tombstones) == 0:
+            # the purged components have been swapped in, save the index in case it was not saved
+            if self.index.is_trained:
+                self.index.serialize()
+            self._finish_purge()
+        else:
+            logger.warning("Found an interrupted purge, resuming it.")
+            # the version before purging matches the tombstones and the components not purged yet
+            with self._lock.write():
+                self.database = lance.dataset(self.db_path, version=marker["version"])
+            self._apply_purge(self.tombstones, lance.dataset(self.db_path))
+            self._finish_purge()
+        return
+
+    def _wait_purge(self) -> None:
+        if (self._purge_thread is not None) and self._purge_thread.is_alive():
+            logger.info("Waiting for the background purge.")
+            self._purge_thread.join()
+        return
+
+    @staticmethod
+    def _to_sql_literal(value) -> str:
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return str(value)
+
+    def _filter_deleted(
+        self, indices: np.ndarray, scores: np.ndarray, top_k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Remove the tombstones from the retrieved results and keep the first `top_k` results.
+        The missing results are padded with -1."""
+        valid = indices >= 0
+        if len(self.tombstones) > 0:
+            pos = np.searchsorted(self.tombstones, indices)
+            pos = np.minimum(pos, len(self.tombstones) - 1)
+            valid &= self.tombstones[pos] != indices
+        order = np.argsort(~valid, axis=1, kind="stable")[:, :top_k]
+        valid = np.take_along_axis(valid, order, axis=1)
+        indices = np.where(valid, np.take_along_axis(indices, order, axis=1), -1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        return indices, scores
+
+    @TIME_METER("dense_retriever", "compact")
+    def compact(self) -> None:
+        """Rewrite the small fragments of the database into fragments with `target_rows_per_fragment` rows.
+        The order of the passages is preserved, thus the index is still valid after compaction.
+        If `version_retention_hours` is set, the versions older than it are removed after compaction.
+        Otherwise, all versions are kept for the readers pinned to them and for restoring.
+
+        :return: None
+        """
+        if self.database is None:
+            return
+        self._remove_manifest()
+        num_fragments = len(self.database.get_fragments())
+        # compact another handle, as the searches read the current version
+        database = lance.dataset(self.db_path)
+        metrics = database.optimize.compact_files(
+            target_rows_per_fragment=self.target_rows_per_fragment,
+        )
+        database = lance.dataset(self.db_path)
+        with self._lock.write():
+            self.database = database
+        # the versions are removed after the searches move to the compacted one
+        if self.version_retention_hours is not None:
+            database.cleanup_old_versions(
+                older_than=timedelta(hours=self.version_retention_hours)
+            )
+        logger.info(
+            f"Compacted {num_fragments} fragments into "
+            f"{len(self.database.get_fragments())} fragments "
+            f"({metrics.fragments_removed} removed, {metrics.fragments_added} added)."
+        )
+        if not os.path.exists(self.checkpoint_path):
+            self._save_manifest()
+        return
+
+    def _need_compact(self) -> bool:
+        if self.database is None:
+            return False
+        min_fragments = math.ceil(len(self) / self.target_rows_per_fragment)
+        num_fragments = len(self.database.get_fragments())
+        return num_fragments - min_fragments > self.compact_threshold
+
     @TIME_METER("dense_retriever", "search")
     def search_batch(
         self,
@@ -134,40 +781,118 @@ class DenseRetriever(LocalRetriever):
     ) -> list[list[RetrievedContext]]:
         top_k = search_kwargs.get("top_k", self.top_k)
         emb_q = self.query_encoder.encode(query)
-        indices, scores = self.index.search(
-            emb_q, top_k * self.refine_factor, **search_kwargs
-        )
-        if self.refine_factor > 1:
-            refined_indices, refined_scores = self.refine_index(emb_q, indices)
-            indices = refined_indices[:, :top_k]
-            scores = refined_scores[:, :top_k]
-        retrieved = self.database.take(
-            indices.flatten(), columns=self.fields
-        ).to_pandas()
+        with self._lock.read():
+            # over-fetch to compensate for the tombstones,
+            # the extra candidates cover three standard deviations of the number of tombstones
+            candidate_num = top_k * self.refine_factor
+            fetch_num = candidate_num
+            if len(self.tombstones) > 0:
+                ratio = len(self.tombstones) / len(self)
+                fetch_num = math.ceil(
+                    (candidate_num + 3 * math.sqrt(candidate_num * ratio))
+                    / max(1 - ratio, 1e-6)
+                )
+            max_fetch_num = min(fetch_num * 4, len(self))
+            while True:
+                fetch_num = min(fetch_num, max_fetch_num)
+                indices, scores = self.index.search(
+                    self._get_query_input(emb_q), fetch_num, **search_kwargs
+                )
+                # the index pads -1 when it can not return more candidates (e.g. IVF and HNSW)
+                exhausted = bool(np.any(indices < 0))
+                indices, scores = self._filter_deleted(indices, scores, candidate_num)
+                # the tombstones may concentrate around the query, fetch more if needed
+                if (len(self.tombstones) == 0) or exhausted:
+                    break
+                if (fetch_num >= max_fetch_num) or np.all(indices >= 0):
+                    break
+                fetch_num *= 2
+            if self.refine_factor > 1:
+                refined_indices, refined_scores = self.refine_index(emb_q, indices)
+                indices = refined_indices[:, :top_k]
+                scores = refined_scores[:, :top_k]
+            # convert the retrieved passages to python objects column by column
+            valid = indices >= 0
+            retrieved = self.database.take(indices[valid], columns=self.fields)
+        columns = [retrieved.column(name).to_pylist() for name in self.fields]
+        retrieved = iter([dict(zip(self.fields, row)) for row in zip(*columns)])
         results = []
-        for i, (q, score) in enumerate(zip(query, scores)):
+        for q, score, mask in zip(query, scores.tolist(), valid):
             results.append(
                 [
                     RetrievedContext(
                         retriever=self.name,
                         query=q,
-                        score=float(s),
-                        data=retrieved.iloc[i * top_k + j].to_dict(),
+                        score=s,
+                        data=next(retrieved),
                     )
-                    for j, s in enumerate(score)
+                    for s, m in zip(score, mask)
+                    if m
                 ]
             )
         return results
 
     def clean(self) -> None:
         self.index.clean()
+        if self.embedding_store is not None:
+            self.embedding_store.clean()
+        self.quantizer.clean()
         shutil.rmtree(self.database_path)
         self.database = None
+        self._manifest = None
+        self._fields = None
+        self._store_synced = False
+        self._store_failed = False
+        self.tombstones = np.zeros([0], dtype=np.int64)
+        return
+
+    def _load_manifest(self) -> Optional[dict]:
+        """Load the cached metadata of the database.
+        The manifest is ignored if the database has been modified after it was saved."""
+        if (self.database is None) or (not os.path.exists(self.manifest_path)):
+            return None
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning("The manifest is corrupted, ignoring it.")
+            return None
+        if manifest["version"] != self.database.version:
+            logger.info("The manifest is outdated, ignoring it.")
+            return None
+        return manifest
+
+    def _save_manifest(self) -> None:
+        """Cache the number of rows, the embedding size and the fields of the database."""
+        if self.database is None:
+            return
+        self._manifest = None
+        manifest = {
+            "version": self.database.version,
+            "num_rows": len(self),
+            "embedding_size": (
+                self.index.embedding_size if self.index.is_trained else None
+            ),
+            "fields": self.fields,
+        }
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest = manifest
+        return
+
+    def _remove_manifest(self) -> None:
+        self._manifest = None
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
         return
 
     def __len__(self) -> int:
         if self.database is None:
             return 0
+        if self._manifest is not None:
+            return self._manifest["num_rows"]
         return self.database.count_rows()
 
     @property
@@ -177,8 +902,8 @@ class DenseRetriever(LocalRetriever):
             return self.query_encoder.embedding_size
         if self.passage_encoder is not None:
             return self.passage_encoder.embedding_size
-        if self.database is not None:
-            return self.database.head(num_rows=1).to_pandas()["vector"][0].shape[0]
+        if self.quantizer.is_fitted:
+            return self.quantizer.embedding_size
         if hasattr(self, "index"):
             return self.index.embedding_size
         raise ValueError(
@@ -187,9 +912,9 @@ class DenseRetriever(LocalRetriever):
 
     @property
     def fields(self) -> list[str]:
-        fields: list = self.database.head(num_rows=1).to_pandas().columns.to_list()
-        fields.remove("vector")
-        return fields
+        if self._fields is None:
+            self._fields = [i for i in self.database.schema.names if i != "vector"]
+        return self._fields
 
     @TIME_METER("dense_retriever", "refine-index")
     def refine_index(
@@ -201,63 +926,185 @@ class DenseRetriever(LocalRetriever):
 
         :param query: The query embeddings with shape [bsz, emb_size].
         :type query: np.ndarray
-        :param indices: The retrieved indices with shape [bsz, top_k * refine_factor].
+        :param indices: The retrieved indices with shape [bsz, top_k * refine_factor], -1 for the missing ones.
         :type indices: np.ndarray
         :return: The refined indices and scores with shape [bsz, top_k * refine_factor].
         :rtype: tuple[np.ndarray, np.ndarray]
         """
-        bsz, kf = indices.shape
-        flat_indices = indices.flatten()
-        embs = np.stack(
-            self.database.take(flat_indices, columns=["vector"]).to_pandas()["vector"]
-        )  # [bsz * kf, emb_size]
-        query = np.expand_dims(query, 1).repeat(kf, axis=1).reshape(bsz * kf, -1)
-
-        # compute the distance between the query and the retrieved embeddings
-        match self.distance_function:
+        valid = indices >= 0
+        safe_indices = np.where(valid, indices, 0)
+        embedding_store = self._get_embedding_store()
+        if embedding_store is not None:
+            embs = embedding_store.get(safe_indices)  # [bsz, kf, emb_size]
+        else:
+            bsz, kf = indices.shape
+            embs = np.stack(
+                self.database.take(safe_indices.flatten(), columns=["vector"])
+                .column("vector")
+                .to_numpy(zero_copy_only=False)
+            ).reshape(bsz, kf, -1)
+        embs = self.quantizer.decode(embs)
+        query = query.astype(np.float32)[:, None, :]  # [bsz, 1, emb_size]
+
+        # compute the distance between each query and its retrieved embeddings
+        if self.quantizer.precision == "binary":
+            # rescore the binary embeddings with the float32 query
+            distance_function = "IP"
+        else:
+            distance_function = self.distance_function
+        match distance_function:
             case "L2":
-                dis = cdist(query, embs, "euclidean")
+                dis = np.linalg.norm(embs - query, axis=-1)
             case "COSINE":
-                dis = -cdist(query, embs, "cosine")
+                q_norm = np.linalg.norm(query, axis=-1)
+                e_norm = np.linalg.norm(embs, axis=-1)
+                dis = 1 - np.sum(query * embs, axis=-1) / (q_norm * e_norm)
             case "IP":
-                dis = -np.sum(query * embs, axis=1)
-            case "HAMMING":
-                dis = cdist(query, embs, "hamming")
+                dis = -np.sum(query * embs, axis=-1)
             case "MANHATTAN":
-                dis = cdist(query, embs, "cityblock")
+                dis = np.sum(np.abs(embs - query), axis=-1)
             case _:
                 raise ValueError("Unsupported distance function")
-        dis = dis.reshape(bsz, kf)
-        new_order = np.argsort(dis, axis=1)
+        dis = np.where(valid, dis, np.inf)
+        new_order = np.argsort(dis, axis=1, kind="stable")
         new_indices = np.take_along_axis(indices, new_order, axis=1)
         new_scores = np.take_along_axis(dis, new_order, axis=1)
         return new_indices, new_scores
 
-    @TIME_METER("dense_retriever", "build-index")
+    @TIME_METER("dense_retriever", "exact-search")
+    def exact_search(
+        self, query: np.ndarray, top_k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Search all the embeddings exhaustively, which is equivalent to searching a FLAT index.
+        This method is used to provide the ground truth for tuning the index.
+        The tombstones are excluded, and the slots without results are filled with -1.
+
+        :param query: The query embeddings with shape [bsz, emb_size].
+        :type query: np.ndarray
+        :param top_k: The number of embeddings to retrieve.
+        :type top_k: int
+        :return: The indices and the distances of the nearest embeddings with shape [bsz, top_k].
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        query = query.astype(np.float32)
+        if self.quantizer.precision == "binary":
+            # the inner product of the signs is equivalent to the hamming distance
+            query = np.where(query > 0, 1, -1).astype(np.float32)
+            distance_function = "IP"
+        else:
+            distance_function = self.distance_function
+        if distance_function not in ["IP", "L2", "COSINE"]:
+            raise ValueError(
+                f"Exact search does not support the {distance_function} distance."
+            )
+        if distance_function == "COSINE":
+            query = query / np.linalg.norm(query, axis=-1, keepdims=True)
+
+        tombstones = self.tombstones
+        top_dis = np.zeros([query.shape[0], 0], dtype=np.float32)
+        top_indices = np.zeros([query.shape[0], 0], dtype=np.int64)
+        offset = 0
+        for codes in self._iter_codes():
+            embs = self.quantizer.decode(codes)
+            match distance_function:
+                case "IP":
+                    dis = -query @ embs.T
+                case "L2":
+                    dis = (
+                        np.sum(query**2, axis=-1, keepdims=True)
+                        - 2 * query @ embs.T
+                        + np.sum(embs**2, axis=-1)[None]
+                    )
+                    dis = np.sqrt(np.maximum(dis, 0))
+                case "COSINE":
+                    embs = embs / np.linalg.norm(embs, axis=-1, keepdims=True)
+                    dis = 1 - query @ embs.T
+            indices = np.arange(offset, offset + embs.shape[0])
+            dis = np.where(np.isin(indices, tombstones)[None], np.inf, dis)
+            indices = np.broadcast_to(indices, dis.shape)
+            offset += embs.shape[0]
+
+            # keep the top_k nearest embeddings
+            dis = np.concatenate([top_dis, dis], axis=1)
+            indices = np.concatenate([top_indices, indices], axis=1)
+            k = min(top_k, dis.shape[1])
+            selected = np.argpartition(dis, k - 1, axis=1)[:, :k]
+            top_dis = np.take_along_axis(dis, selected, axis=1)
+            top_indices = np.take_along_axis(indices, selected, axis=1)
+        order = np.argsort(top_dis, axis=1, kind="stable")
+        top_dis = np.take_along_axis(top_dis, order, axis=1)
+        top_indices = np.take_along_axis(top_indices, order, axis=1)
+        top_indices = np.where(np.isinf(top_dis), -1, top_indices)
+        return top_indices, top_dis
+
     def build_index(self) -> None:
-        logger.info("Copying embeddings to memory map")
-        embeddings = np.memmap(
-            os.path.join(self.database_path, f"_embeddings.npy"),
-            dtype=np.float32,
-            mode="w+",
-            shape=(self.database.count_rows(), self.embedding_size),
-        )
-        idx = 0
-        for emb_batch in self.database.to_batches(columns=["vector"]):
-            emb_batch = np.stack(emb_batch.to_pandas()["vector"])
-            embeddings[idx : idx + emb_batch.shape[0]] = emb_batch
-            idx += emb_batch.shape[0]
-            del emb_batch
+        """Build the index with the embeddings in the database.
+        The index is trained with `index_train_num` randomly sampled embeddings,
+        then all the embeddings are added in batches of `write_batch_size`.
+        Thus the embeddings are never loaded into memory at once.
+
+        :return: None
+        """
+        self._build_index(self.index)
+        return
+
+    @TIME_METER("dense_retriever", "build-index")
+    def _build_index(
+        self, index: DenseIndexBase, database: Optional[lance.LanceDataset] = None
+    ) -> None:
+        """Build `index` with the embeddings in `database`, defaults to the current database."""
+        if database is None:
+            embedding_store = self._get_embedding_store()
+            source, total = self.database, len(self)
+        else:
+            embedding_store = None
+            source, total = database, database.count_rows()
+        train_num = index.index_train_num
+        if (train_num == -1) or (train_num >= total):
+            sample_ids = np.arange(total)
+        else:
+            # the number of rows is known, so sampling the row ids is equivalent to reservoir sampling
+            sample_ids = np.sort(np.random.choice(total, train_num, replace=False))
+        logger.info(f"Sampling {len(sample_ids)} embeddings to train the index.")
+        samples = []
+        for idx in range(0, len(sample_ids), self.write_batch_size):
+            ids = sample_ids[idx : idx + self.write_batch_size]
+            if embedding_store is not None:
+                codes = np.asarray(embedding_store.data[ids])
+            else:
+                codes = np.stack(
+                    source.take(ids, columns=["vector"])
+                    .column("vector")
+                    .to_numpy(zero_copy_only=False)
+                )
+            samples.append(self._get_index_input(codes))
+        samples = np.concatenate(samples, axis=0)
+
         logger.info("Training index.")
-        logger.warning("Training index may consume a lot of memory.")
-        self.index.build_index(embeddings)
-        os.remove(os.path.join(self.database_path, f"_embeddings.npy"))
+        index.build_index_streaming(
+            samples,
+            (
+                self._get_index_input(codes)
+                for codes in self._iter_codes(database=database)
+            ),
+            total,
+        )
         return
 
     def _check_consistency(self) -> None:
+        if os.path.exists(self.checkpoint_path):
+            logger.warning(
+                "Found an unfinished `add_passages`, "
+                "call `add_passages` with the same passages to resume."
+            )
+            return
         assert len(self.index) == len(self), "Inconsistent index and database."
         if self.index.is_trained:
+            if self._manifest is not None:
+                embedding_size = self._manifest["embedding_size"]
+            else:
+                embedding_size = self.embedding_size
             assert (
-                self.index.embedding_size == self.embedding_size
+                self.index.embedding_size == embedding_size
             ), "Inconsistent embedding size."
         return
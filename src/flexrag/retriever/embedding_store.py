@@ -0,0 +1,305 @@
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+from flexrag.utils import LOGGER_MANAGER
+
+logger = LOGGER_MANAGER.get_logger("flexrag.retrievers.embedding_store")
+
+
+class EmbeddingQuantizer:
+    """Convert the float32 embeddings to the storage precision and back.
+
+    The supported precisions are:
+        - float32: the embeddings are stored as is.
+        - float16: the embeddings are stored in half precision.
+        - int8: each dimension is linearly mapped to [-128, 127] by its own range,
+          which is fitted on the first batch and widened to `RANGE_STDS` standard deviations around the mean,
+          so that the embeddings added later are rarely clipped.
+          The ranges of the L2-normalized embeddings are bounded by [-1, 1].
+        - binary: the sign of each dimension is stored in one bit.
+
+    The precision, the embedding size and the ranges are stored in `{path}.json`.
+    """
+
+    # the int8 range covers at least this number of standard deviations on each side of the mean
+    RANGE_STDS = 6.0
+
+    def __init__(self, path: str, precision: str = "float32") -> None:
+        self.meta_path = f"{path}.json"
+        self.precision = str(precision)
+        self.embedding_size: Optional[int] = None
+        self.vmin: Optional[np.ndarray] = None
+        self.vmax: Optional[np.ndarray] = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["precision"] != self.precision:
+                logger.warning(
+                    f"The embeddings are saved in {meta['precision']}, "
+                    f"ignoring the configured precision {self.precision}."
+                )
+                self.precision = meta["precision"]
+            self.embedding_size = meta["embedding_size"]
+            if meta.get("vmin", None) is not None:
+                self.vmin = np.array(meta["vmin"], dtype=np.float32)
+                self.vmax = np.array(meta["vmax"], dtype=np.float32)
+        return
+
+    @property
+    def dtype(self) -> np.dtype:
+        """The dtype of the quantized embeddings."""
+        match self.precision:
+            case "float32":
+                return np.dtype(np.float32)
+            case "float16":
+                return np.dtype(np.float16)
+            case "int8":
+                return np.dtype(np.int8)
+            case "binary":
+                return np.dtype(np.uint8)
+            case _:
+                raise ValueError(f"Unsupported precision: {self.precision}")
+
+    @property
+    def code_size(self) -> int:
+        """The size of each quantized embedding."""
+        if self.precision == "binary":
+            return (self.embedding_size + 7) // 8
+        return self.embedding_size
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.embedding_size is not None
+
+    def fit(self, embeddings: np.ndarray) -> None:
+        """Fit the quantizer with the embeddings and save the meta data.
+
+        :param embeddings: The float32 embeddings with shape [n, embedding_size].
+        :type embeddings: np.ndarray
+        :return: None
+        """
+        self.embedding_size = embeddings.shape[1]
+        if self.precision == "int8":
+            if embeddings.shape[0] < 1000:
+                logger.warning(
+                    f"Fitting the int8 quantizer with only {embeddings.shape[0]} embeddings, "
+                    "the embeddings added later may be clipped."
+                )
+            mean = embeddings.mean(axis=0)
+            std = embeddings.std(axis=0)
+            vmin = np.minimum(embeddings.min(axis=0), mean - self.RANGE_STDS * std)
+            vmax = np.maximum(embeddings.max(axis=0), mean + self.RANGE_STDS * std)
+            norms = np.linalg.norm(embeddings, axis=-1)
+            if np.allclose(norms, 1, atol=1e-3):
+                vmin = np.maximum(vmin, -1)
+                vmax = np.minimum(vmax, 1)
+            self.vmin = vmin.astype(np.float32)
+            self.vmax = vmax.astype(np.float32)
+        self.save()
+        return
+
+    def save(self) -> None:
+        meta = {"precision": self.precision, "embedding_size": self.embedding_size}
+        if self.vmin is not None:
+            meta["vmin"] = self.vmin.tolist()
+            meta["vmax"] = self.vmax.tolist()
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        return
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        """Quantize the float32 embeddings.
+
+        :param embeddings: The float32 embeddings with shape [n, embedding_size].
+        :type embeddings: np.ndarray
+        :return: The quantized embeddings with shape [n, code_size].
+        :rtype: np.ndarray
+        """
+        match self.precision:
+            case "float32" | "float16":
+                return embeddings.astype(self.dtype)
+            case "int8":
+                scale = np.maximum(self.vmax - self.vmin, 1e-12) / 255
+                codes = np.round((embeddings - self.vmin) / scale) - 128
+                return np.clip(codes, -128, 127).astype(np.int8)
+            case "binary":
+                return np.packbits(embeddings > 0, axis=-1)
+            case _:
+                raise ValueError(f"Unsupported precision: {self.precision}")
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Reconstruct the float32 embeddings from the quantized embeddings.
+
+        :param codes: The quantized embeddings with shape [..., code_size].
+        :type codes: np.ndarray
+        :return: The float32 embeddings with shape [..., embedding_size].
+        :rtype: np.ndarray
+        """
+        match self.precision:
+            case "float32" | "float16":
+                return codes.astype(np.float32)
+            case "int8":
+                scale = np.maximum(self.vmax - self.vmin, 1e-12) / 255
+                return (codes.astype(np.float32) + 128) * scale + self.vmin
+            case "binary":
+                bits = np.unpackbits(codes, axis=-1, count=self.embedding_size)
+                return bits.astype(np.float32) * 2 - 1
+            case _:
+                raise ValueError(f"Unsupported precision: {self.precision}")
+
+    def clean(self) -> None:
+        self.embedding_size = None
+        self.vmin = None
+        self.vmax = None
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        return
+
+
+class EmbeddingStore:
+    """A fixed-stride embedding file that can be memory-mapped and addressed by row id.
+
+    The embeddings are stored in `{path}.bin` as a raw row-major array,
+    while the dtype and the embedding size are stored in `{path}.json`.
+    """
+
+    def __init__(self, path: str, dtype: str = "float32") -> None:
+        self.data_path = f"{path}.bin"
+        self.meta_path = f"{path}.json"
+        self.dtype = np.dtype(str(dtype))
+        self.embedding_size: Optional[int] = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if np.dtype(meta["dtype"]) != self.dtype:
+                logger.warning(
+                    f"The embedding store is saved in {meta['dtype']}, "
+                    f"ignoring the configured dtype {self.dtype}."
+                )
+                self.dtype = np.dtype(meta["dtype"])
+            self.embedding_size = meta["embedding_size"]
+        self._data: Optional[np.memmap] = None
+        return
+
+    @property
+    def data(self) -> np.ndarray:
+        """The memory-mapped embeddings with shape [n, embedding_size]."""
+        if self._data is None:
+            if len(self) == 0:
+                return np.zeros([0, self.embedding_size or 0], dtype=self.dtype)
+            self._data = np.memmap(
+                self.data_path,
+                dtype=self.dtype,
+                mode="r",
+                shape=(len(self), self.embedding_size),
+            )
+        return self._data
+
+    def append(self, embeddings: np.ndarray) -> None:
+        """Append the embeddings to the end of the store.
+
+        :param embeddings: The embeddings to append with shape [n, embedding_size].
+        :type embeddings: np.ndarray
+        :return: None
+        """
+        if self.embedding_size is None:
+            self.embedding_size = embeddings.shape[1]
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"dtype": self.dtype.name, "embedding_size": self.embedding_size}, f
+                )
+        assert (
+            embeddings.shape[1] == self.embedding_size
+        ), "Inconsistent embedding size."
+        with open(self.data_path, "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        self._data = None
+        return
+
+    def truncate(self, num: int) -> None:
+        """Truncate the store to the first `num` embeddings.
+
+        :param num: The number of embeddings to keep.
+        :type num: int
+        :return: None
+        """
+        if num < len(self):
+            with open(self.data_path, "r+b") as f:
+                f.truncate(num * self.embedding_size * self.dtype.itemsize)
+            self._data = None
+        return
+
+    def remove(self, indices: np.ndarray, batch_size: int = 65536) -> None:
+        """Remove the embeddings by row ids, the following rows are moved forward.
+
+        :param indices: The row ids to remove.
+        :type indices: np.ndarray
+        :param batch_size: The number of rows copied at a time. Defaults to 65536.
+        :type batch_size: int
+        :return: None
+        """
+        self.commit_remove(self.prepare_remove(indices, batch_size=batch_size))
+        return
+
+    def prepare_remove(self, indices: np.ndarray, batch_size: int = 65536) -> str:
+        """Write the embeddings except the removed ones to a temporary file,
+        while the store is still readable until `commit_remove` is called.
+
+        :param indices: The row ids to remove.
+        :type indices: np.ndarray
+        :param batch_size: The number of rows copied at a time. Defaults to 65536.
+        :type batch_size: int
+        :return: The path of the temporary file.
+        :rtype: str
+        """
+        keep = np.ones(len(self), dtype=bool)
+        keep[indices] = False
+        tmp_path = f"{self.data_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            for idx in range(0, len(self), batch_size):
+                emb_batch = self.data[idx : idx + batch_size][
+                    keep[idx : idx + batch_size]
+                ]
+                f.write(np.ascontiguousarray(emb_batch).tobytes())
+        return tmp_path
+
+    def commit_remove(self, tmp_path: str) -> None:
+        """Replace the store with the temporary file written by `prepare_remove`.
+
+        :param tmp_path: The path of the temporary file.
+        :type tmp_path: str
+        :return: None
+        """
+        self._data = None
+        os.replace(tmp_path, self.data_path)
+        return
+
+    def get(self, indices: np.ndarray) -> np.ndarray:
+        """Get the embeddings by row ids.
+
+        :param indices: The row ids with arbitrary shape.
+        :type indices: np.ndarray
+        :return: The embeddings with shape [*indices.shape, embedding_size].
+        :rtype: np.ndarray
+        """
+        # read the rows in ascending order to improve the locality
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        embeddings = self.data[unique_indices][inverse]
+        return embeddings.reshape(*indices.shape, self.embedding_size)
+
+    def clean(self) -> None:
+        self._data = None
+        self.embedding_size = None
+        for path in [self.data_path, self.meta_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+    def __len__(self) -> int:
+        if (self.embedding_size is None) or (not os.path.exists(self.data_path)):
+            return 0
+        row_size = self.embedding_size * self.dtype.itemsize
+        return os.path.getsize(self.data_path) // row_size
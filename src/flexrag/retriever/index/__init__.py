@@ -2,7 +2,7 @@ from .annoy_index import AnnoyIndex, AnnoyIndexConfig
 from .faiss_index import FaissIndex, FaissIndexConfig
 from .index_base import DenseIndexBase, DenseIndexBaseConfig, DENSE_INDEX
 from .scann_index import ScaNNIndex, ScaNNIndexConfig
-
+from .sharded_index import ShardedIndex, ShardedIndexConfig
 
 __all__ = [
     "AnnoyIndex",
@@ -11,6 +11,8 @@ __all__ = [
     "FaissIndexConfig",
     "ScaNNIndex",
     "ScaNNIndexConfig",
+    "ShardedIndex",
+    "ShardedIndexConfig",
     "DenseIndexBase",
     "DenseIndexBaseConfig",
     "DENSE_INDEX",
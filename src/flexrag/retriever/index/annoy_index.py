@@ -113,6 +113,10 @@ class AnnoyIndex(DenseIndexBase):
         scores = np.array(scores)
         return indices, scores
 
+    @property
+    def search_space(self) -> dict[str, list]:
+        return {"search_k": [self.n_trees * i for i in (10, 50, 100, 200, 500, 1000)]}
+
     def serialize(self) -> None:
         logger.info(f"Serializing index to {self.index_path}")
         if not os.path.exists(os.path.dirname(self.index_path)):
@@ -147,6 +151,7 @@ class AnnoyIndex(DenseIndexBase):
         return
 
     def clean(self):
+        self._clean_search_params()
         if self.index is not None:
             self.index.unload()
         if os.path.exists(self.index_path):
@@ -1,6 +1,6 @@
 import os
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Iterable, Optional
 
 import numpy as np
 
@@ -11,19 +11,41 @@ from .index_base import DenseIndexBase, DenseIndexBaseConfig, DENSE_INDEX
 logger = LOGGER_MANAGER.get_logger("flexrag.retriever.index.faiss")
 
 
+def _physical_memory() -> Optional[int]:
+    """Return the size of the physical memory in bytes, None if it could not be detected."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # `os.sysconf` is not available on Windows
+        pass
+    try:
+        import psutil
+
+        return psutil.virtual_memory().total
+    except ImportError:
+        return None
+
+
 @dataclass
 class FaissIndexConfig(DenseIndexBaseConfig):
-    index_type: Choices(["FLAT", "IVF", "PQ", "IVFPQ", "auto"]) = "auto"  # type: ignore
+    distance_function: Choices(["IP", "L2", "HAMMING"]) = "IP"  # type: ignore
+    index_type: Choices(["FLAT", "IVF", "PQ", "IVFPQ", "HNSW", "HNSWSQ", "HNSWPQ", "IVFHNSW", "auto"]) = "auto"  # type: ignore
     n_subquantizers: int = 8
     n_bits: int = 8
     n_list: int = 1000
+    hnsw_m: int = 32
+    efConstruction: int = 40
+    memory_budget: Optional[float] = None  # in GB, None means the physical memory (unlimited if undetectable)
     factory_str: Optional[str] = None
+    # the FLAT, IVF and auto indexes store float16 / int8 vectors with the SQfp16 / SQ8 scalar quantizer,
+    # which is set to the `embedding_precision` by the DenseRetriever
+    precision: Choices(["float32", "float16", "int8"]) = "float32"  # type: ignore
     # Inference Arguments
     n_probe: int = 32
     device_id: list[int] = field(default_factory=list)
     k_factor: int = 10
     polysemous_ht: int = 0
     efSearch: int = 100
+    use_mmap: bool = False
 
 
 @DENSE_INDEX("faiss", config_class=FaissIndexConfig)
@@ -50,6 +72,7 @@ class FaissIndex(DenseIndexBase):
         self.k_factor = cfg.k_factor
         self.polysemous_ht = cfg.polysemous_ht
         self.efSearch = cfg.efSearch
+        self.use_mmap = cfg.use_mmap
 
         # prepare index args
         self.index_type = cfg.index_type
@@ -57,9 +80,14 @@ class FaissIndex(DenseIndexBase):
         self.n_list = cfg.n_list
         self.n_subquantizers = cfg.n_subquantizers
         self.n_bits = cfg.n_bits
+        self.hnsw_m = cfg.hnsw_m
+        self.efConstruction = cfg.efConstruction
+        self.memory_budget = cfg.memory_budget
         self.factory_str = cfg.factory_str
+        self.precision = cfg.precision
 
         # prepare index
+        self.mmapped = False
         if os.path.exists(self.index_path):
             self.index = self.deserialize()
         else:
@@ -67,19 +95,31 @@ class FaissIndex(DenseIndexBase):
         return
 
     def build_index(self, embeddings: np.ndarray) -> None:
+        self.build_index_streaming(embeddings, [embeddings], embeddings.shape[0])
+        return
+
+    def build_index_streaming(
+        self,
+        train_embeddings: np.ndarray,
+        embeddings: Iterable[np.ndarray],
+        total: int,
+    ) -> None:
         self.clean()
         self.index = self._prepare_index(
             index_type=self.index_type,
             distance_function=self.distance_function,
-            embedding_size=embeddings.shape[1],
-            embedding_length=embeddings.shape[0],
+            embedding_size=train_embeddings.shape[1],
+            embedding_length=total,
             n_list=self.n_list,
             n_subquantizers=self.n_subquantizers,
             n_bits=self.n_bits,
+            hnsw_m=self.hnsw_m,
             factory_str=self.factory_str,
         )
-        self.train_index(embeddings=embeddings)
-        self.add_embeddings(embeddings=embeddings)
+        self.train_index(embeddings=train_embeddings)
+        for emb_batch in embeddings:
+            self.add_embeddings(embeddings=emb_batch, serialize=False)
+        self.serialize()
         return
 
     def _prepare_index(
@@ -91,8 +131,19 @@ class FaissIndex(DenseIndexBase):
         n_list: int,  # the number of cells
         n_subquantizers: int,  # the number of subquantizers
         n_bits: int,  # the number of bits per subquantizer
+        hnsw_m: int = 32,  # the number of neighbors in the HNSW graph
         factory_str: Optional[str] = None,
     ):
+        # binary embeddings are packed into bytes
+        if distance_function == "HAMMING":
+            return self._prepare_binary_index(
+                index_type=index_type,
+                embedding_size=embedding_size * 8,
+                embedding_length=embedding_length,
+                n_list=n_list,
+                factory_str=factory_str,
+            )
+
         # prepare distance function
         match distance_function:
             case "IP":
@@ -105,12 +156,32 @@ class FaissIndex(DenseIndexBase):
                 raise ValueError(f"Unknown distance function: {distance_function}")
 
         if index_type == "auto":
-            n_list = 2 ** int(np.log2(np.sqrt(embedding_length)))
-            factory_str = f"IVF{n_list},PQ{embedding_size//2}x4fs"
-            logger.info(f"Auto set index to {factory_str}")
-            logger.info(
-                f"We recommend to set n_probe to {n_list//8} for better inference performance"
+            factory_str = self._select_index(
+                distance_function=distance_function,
+                embedding_size=embedding_size,
+                embedding_length=embedding_length,
+                hnsw_m=hnsw_m,
             )
+            logger.info(f"Auto set index to {factory_str}")
+        elif factory_str is None:
+            # HNSW based indexes and the quantized vectors are built with the string factory
+            sq_type = {"float16": "SQfp16", "int8": "SQ8"}.get(self.precision, None)
+            match index_type:
+                case "FLAT" if sq_type is not None:
+                    factory_str = sq_type
+                case "IVF" if sq_type is not None:
+                    factory_str = f"IVF{n_list},{sq_type}"
+                case "HNSW":
+                    factory_str = f"HNSW{hnsw_m},Flat"
+                case "HNSWSQ":
+                    sq_type = "SQfp16" if n_bits == 16 else f"SQ{n_bits}"
+                    factory_str = f"HNSW{hnsw_m}_{sq_type}"
+                case "HNSWPQ":
+                    if distance_function != "L2":
+                        raise ValueError("HNSWPQ index only supports L2 distance.")
+                    factory_str = f"HNSW{hnsw_m}_PQ{n_subquantizers}x{n_bits}"
+                case "IVFHNSW":
+                    factory_str = f"IVF{n_list}_HNSW{hnsw_m},Flat"
 
         if factory_str is not None:
             # using string factory to build the index
@@ -149,9 +220,116 @@ class FaissIndex(DenseIndexBase):
                     raise ValueError(f"Unknown index type: {index_type}")
 
         # post process
+        self._set_construction_params(index)
+        index = self._set_index(index)
+        return index
+
+    def _prepare_binary_index(
+        self,
+        index_type: str,
+        embedding_size: int,  # the number of bits of the embeddings
+        embedding_length: int,  # the number of the embeddings
+        n_list: int,  # the number of cells
+        factory_str: Optional[str] = None,
+    ):
+        if index_type == "auto":
+            if embedding_length <= 1000000:
+                factory_str = "BFlat"
+            else:
+                n_list = 2 ** int(np.log2(4 * np.sqrt(embedding_length)))
+                factory_str = f"BIVF{n_list}"
+            logger.info(f"Auto set index to {factory_str}")
+        elif factory_str is None:
+            match index_type:
+                case "FLAT":
+                    factory_str = "BFlat"
+                case "IVF":
+                    factory_str = f"BIVF{n_list}"
+                case _:
+                    raise ValueError(
+                        f"Index type {index_type} does not support HAMMING distance."
+                    )
+        index = self.faiss.index_binary_factory(embedding_size, factory_str)
         index = self._set_index(index)
         return index
 
+    def _select_index(
+        self,
+        distance_function: str,
+        embedding_size: int,
+        embedding_length: int,
+        hnsw_m: int,
+    ) -> str:
+        """Select the index structure based on the corpus size and the memory budget.
+        HNSW is preferred for corpora with less than 1M embeddings,
+        while IVF with an HNSW coarse quantizer is used for larger corpora.
+        The embeddings are compressed if the index could not fit in the memory budget.
+
+        :return: The factory string of the selected index.
+        :rtype: str
+        """
+        if self.memory_budget is None:
+            budget = _physical_memory()
+            if budget is None:
+                logger.warning(
+                    "Unable to detect the physical memory, "
+                    "please set `memory_budget` to select the index within the budget."
+                )
+                budget = float("inf")
+        else:
+            budget = self.memory_budget * (1024**3)
+
+        # the vectors are stored in the `precision` at most
+        code_type, code_size = {
+            "float32": ("Flat", 4),
+            "float16": ("SQfp16", 2),
+            "int8": ("SQ8", 1),
+        }[self.precision]
+        if code_type == "Flat":
+            hnsw_str = f"HNSW{hnsw_m},Flat"
+        else:
+            hnsw_str = f"HNSW{hnsw_m}_{code_type}"
+
+        # candidates and their estimated memory usage per embedding in bytes
+        graph_size = hnsw_m * 2 * 4
+        candidates = []
+        if embedding_length <= 1000000:
+            candidates += [
+                (hnsw_str, embedding_size * code_size + graph_size),
+                (f"HNSW{hnsw_m}_SQ8", embedding_size + graph_size),
+                (f"HNSW{hnsw_m}_SQ4", embedding_size / 2 + graph_size),
+            ]
+        n_list = 2 ** int(np.log2(4 * np.sqrt(embedding_length)))
+        candidates += [
+            (
+                f"IVF{n_list}_HNSW{hnsw_m},{code_type}",
+                embedding_size * code_size + 8,
+            ),
+            (
+                f"IVF{n_list}_HNSW{hnsw_m},PQ{embedding_size//2}x4fs",
+                embedding_size / 4 + 8,
+            ),
+        ]
+        for factory_str, size in candidates:
+            if size * embedding_length <= budget:
+                break
+        else:
+            logger.warning("The index may exceed the memory budget.")
+        if factory_str.startswith("IVF"):
+            logger.info(
+                f"We recommend to set n_probe to {n_list//8} for better inference performance"
+            )
+        return factory_str
+
+    def _set_construction_params(self, index) -> None:
+        """Set the build-time parameters of the HNSW graph (including the HNSW coarse quantizer)."""
+        index = self.faiss.downcast_index(index)
+        if isinstance(index, self.faiss.IndexHNSW):
+            index.hnsw.efConstruction = self.efConstruction
+        elif isinstance(index, self.faiss.IndexIVF):
+            self._set_construction_params(index.quantizer)
+        return
+
     def train_index(self, embeddings: np.ndarray) -> None:
         if self.is_flat:
             logger.info("Index is flat, no need to train")
@@ -160,9 +338,7 @@ class FaissIndex(DenseIndexBase):
         if (self.index_train_num >= embeddings.shape[0]) or (
             self.index_train_num == -1
         ):
-            if embeddings.dtype != np.float32:
-                embeddings = embeddings.astype("float32")
-            self.index.train(embeddings)
+            self.index.train(self._prepare_input(embeddings))
         else:
             selected_indices = np.random.choice(
                 embeddings.shape[0],
@@ -170,16 +346,51 @@ class FaissIndex(DenseIndexBase):
                 replace=False,
             )
             selected_indices = np.sort(selected_indices)
-            selected_embeddings = embeddings[selected_indices].astype("float32")
+            selected_embeddings = self._prepare_input(embeddings[selected_indices])
             self.index.train(selected_embeddings)
         return
 
+    def _prepare_input(self, embeddings: np.ndarray) -> np.ndarray:
+        """Convert the embeddings to the dtype required by faiss."""
+        if self.is_binary:
+            return embeddings.astype(np.uint8, copy=False)
+        return embeddings.astype(np.float32, copy=False)
+
     def _add_embeddings_batch(self, embeddings: np.ndarray) -> None:
-        embeddings = embeddings.astype("float32")
+        embeddings = self._prepare_input(embeddings)
         assert self.is_trained, "Index should be trained first"
+        self._load_into_memory()
         self.index.add(embeddings)  # debug
         return
 
+    def remove_embeddings(self, indices: np.ndarray, serialize: bool = True) -> None:
+        if not self.support_removal:
+            raise NotImplementedError(
+                f"{self.index.__class__.__name__} does not support removing embeddings."
+            )
+        index = self.index if self.is_binary else self.faiss.downcast_index(self.index)
+        if self.mmapped:
+            self._load_into_memory()
+            index = (
+                self.index if self.is_binary else self.faiss.downcast_index(self.index)
+            )
+        indices = np.asarray(indices, dtype=np.int64)
+        index.remove_ids(self.faiss.IDSelectorBatch(indices))
+
+        # the flat indexes shift the remaining codes by themselves,
+        # while the inverted lists keep the original ids.
+        if isinstance(index, (self.faiss.IndexIVF, self.faiss.IndexBinaryIVF)):
+            invlists = index.invlists
+            for list_no in range(index.nlist):
+                list_size = invlists.list_size(list_no)
+                if list_size == 0:
+                    continue
+                ids = self.faiss.rev_swig_ptr(invlists.get_ids(list_no), list_size)
+                ids -= np.searchsorted(indices, ids)
+        if serialize:
+            self.serialize()
+        return
+
     def prepare_search_params(self, **kwargs):
         # set search kwargs
         k_factor = kwargs.get("k_factor", self.k_factor)
@@ -214,6 +425,8 @@ class FaissIndex(DenseIndexBase):
                     params = self.faiss.IVFPQSearchParameters(
                         nprobe=n_probe, polysemous_ht=polysemous_ht
                     )
+            elif isinstance(index, self.faiss.IndexBinaryIVF):
+                params = self.faiss.SearchParametersIVF(nprobe=n_probe)
             elif isinstance(index, self.faiss.IndexIVF):
                 if hasattr(index, "quantizer"):
                     params = self.faiss.SearchParametersIVF(
@@ -234,13 +447,49 @@ class FaissIndex(DenseIndexBase):
 
         return get_search_params(self.index)
 
+    @property
+    def search_space(self) -> dict[str, list]:
+        space = {}
+
+        def collect(index):
+            if isinstance(index, self.faiss.IndexRefine):
+                space["k_factor"] = [1, 2, 4, 8, 16]
+                collect(self.faiss.downcast_index(index.base_index))
+            elif isinstance(index, self.faiss.IndexPreTransform):
+                collect(self.faiss.downcast_index(index.index))
+            elif isinstance(index, (self.faiss.IndexIVF, self.faiss.IndexBinaryIVF)):
+                n_probes = [2**i for i in range(int(np.log2(index.nlist)) + 1)]
+                space["n_probe"] = n_probes
+                if isinstance(index, self.faiss.IndexIVF):
+                    collect(self.faiss.downcast_index(index.quantizer))
+                if isinstance(index, self.faiss.IndexIVFPQ) and (
+                    index.do_polysemous_training
+                ):
+                    code_bits = index.pq.M * index.pq.nbits
+                    space["polysemous_ht"] = [0] + [
+                        int(code_bits * r) for r in (0.2, 0.25, 0.3, 0.35)
+                    ]
+            elif isinstance(index, self.faiss.IndexHNSW):
+                space["efSearch"] = [16, 32, 64, 128, 256, 512]
+            elif isinstance(index, self.faiss.IndexPQ) and (
+                index.do_polysemous_training
+            ):
+                code_bits = index.pq.M * index.pq.nbits
+                space["polysemous_ht"] = [0] + [
+                    int(code_bits * r) for r in (0.2, 0.25, 0.3, 0.35)
+                ]
+            return
+
+        collect(self.index)
+        return space
+
     def _search_batch(
         self,
         query_vectors: np.ndarray,
         top_docs: int,
         **search_kwargs,
     ) -> tuple[np.ndarray, np.ndarray]:
-        query_vectors = query_vectors.astype("float32")
+        query_vectors = self._prepare_input(query_vectors)
         search_params = self.prepare_search_params(**search_kwargs)
         scores, indices = self.index.search(
             query_vectors, top_docs, params=search_params
@@ -254,27 +503,52 @@ class FaissIndex(DenseIndexBase):
             cpu_index = self.faiss.index_gpu_to_cpu(self.index)
         else:
             cpu_index = self.index
-        self.faiss.write_index(cpu_index, self.index_path)
+        if self.is_binary:
+            self.faiss.write_index_binary(cpu_index, self.index_path)
+        else:
+            self.faiss.write_index(cpu_index, self.index_path)
         return
 
+    def _read_index(self, io_flags: int = 0):
+        if self.is_binary:
+            return self.faiss.read_index_binary(self.index_path, io_flags)
+        return self.faiss.read_index(self.index_path, io_flags)
+
     def deserialize(self):
         logger.info(f"Loading index from {self.index_path}.")
-        if (os.path.getsize(self.index_path) / (1024**3) > 10) and (
-            not self.support_gpu
-        ):
-            logger.info("Index file is too large. Loading on CPU with memory map.")
-            cpu_index = self.faiss.read_index(self.index_path, self.faiss.IO_FLAG_MMAP)
+        if (
+            self.use_mmap or (os.path.getsize(self.index_path) / (1024**3) > 10)
+        ) and (not self.support_gpu):
+            logger.info("Loading index on CPU with memory map.")
+            cpu_index = self._read_index(self.faiss.IO_FLAG_MMAP)
+            self.mmapped = True
         else:
-            cpu_index = self.faiss.read_index(self.index_path)
+            cpu_index = self._read_index()
+            self.mmapped = False
         index = self._set_index(cpu_index)
         return index
 
+    def _load_into_memory(self) -> None:
+        """The memory-mapped index is read-only, reload it into memory before modifying it."""
+        if not self.mmapped:
+            return
+        logger.info("Reloading the memory-mapped index into memory.")
+        self.index = self._set_index(self._read_index())
+        self.mmapped = False
+        return
+
     def clean(self):
+        self._clean_search_params()
         if self.index is None:
             return
+        if self.mmapped:
+            # the memory-mapped index can not be reset
+            self.index = None
+            self.mmapped = False
+        else:
+            self.index.reset()
         if os.path.exists(self.index_path):
             os.remove(self.index_path)
-        self.index.reset()
         return
 
     @property
@@ -299,7 +573,9 @@ class FaissIndex(DenseIndexBase):
     @property
     def is_flat(self) -> bool:
         def _is_flat(index) -> bool:
-            if isinstance(self.index, self.faiss.IndexFlat):
+            if isinstance(
+                self.index, (self.faiss.IndexFlat, self.faiss.IndexBinaryFlat)
+            ):
                 return True
             if self.support_gpu:
                 if isinstance(self.index, self.faiss.GpuIndexFlat):
@@ -320,10 +596,42 @@ class FaissIndex(DenseIndexBase):
                 return True
         return False
 
+    @property
+    def is_binary(self) -> bool:
+        """Whether the index is built for the binary embeddings packed in uint8."""
+        return self.distance_function == "HAMMING"
+
+    @property
+    def larger_is_closer(self) -> bool:
+        if (self.index is None) or self.is_binary:
+            return super().larger_is_closer
+        return self.index.metric_type == self.faiss.METRIC_INNER_PRODUCT
+
+    @property
+    def support_removal(self) -> bool:
+        if (self.index is None) or self.support_gpu:
+            return False
+        index = self.index if self.is_binary else self.faiss.downcast_index(self.index)
+        if isinstance(index, (self.faiss.IndexFlatCodes, self.faiss.IndexBinaryFlat)):
+            return True
+        if isinstance(index, (self.faiss.IndexIVF, self.faiss.IndexBinaryIVF)):
+            # the fast-scan indexes store the codes in blocks, which could not be removed
+            if isinstance(index, self.faiss.IndexIVFFastScan):
+                return False
+            # the memory-mapped inverted lists are reloaded into arrays before removing
+            if self.mmapped:
+                return True
+            # the ids are shifted in place, which is only supported by the array inverted lists
+            invlists = self.faiss.downcast_InvertedLists(index.invlists)
+            return isinstance(invlists, self.faiss.ArrayInvertedLists)
+        return False
+
     @property
     def support_gpu(self) -> bool:
-        return hasattr(self.faiss, "GpuMultipleClonerOptions") and (
-            len(self.device_id) > 0
+        return (
+            hasattr(self.faiss, "GpuMultipleClonerOptions")
+            and (len(self.device_id) > 0)
+            and (not self.is_binary)
         )
 
     def __len__(self) -> int:
@@ -345,6 +653,8 @@ class FaissIndex(DenseIndexBase):
                 gpus=self.device_id,
                 ngpu=len(self.device_id),
             )
+        elif (len(self.device_id) > 0) and self.is_binary:
+            logger.warning("Binary index does not support GPU acceleration.")
         elif len(self.device_id) > 0:
             logger.warning(
                 "The installed faiss does not support GPU acceleration. "
@@ -1,6 +1,10 @@
+import json
+import os
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from itertools import product
 from time import perf_counter
+from typing import Iterable, Optional
 
 import numpy as np
 
@@ -12,7 +16,6 @@ from flexrag.utils import (
     LOGGER_MANAGER,
 )
 
-
 logger = LOGGER_MANAGER.get_logger("flexrag.retrievers.index")
 
 
@@ -31,6 +34,15 @@ class DenseIndexBase(ABC):
         self.index_path = index_path
         self.batch_size = cfg.batch_size
         self.log_interval = cfg.log_interval
+
+        # load the search parameters selected by `autotune`
+        self.search_params_path = f"{self.index_path}.search_params.json"
+        if os.path.exists(self.search_params_path):
+            with open(self.search_params_path, "r", encoding="utf-8") as f:
+                self.search_params = json.load(f)
+            logger.info(f"Using the tuned search parameters: {self.search_params}")
+        else:
+            self.search_params = {}
         return
 
     @abstractmethod
@@ -43,6 +55,43 @@ class DenseIndexBase(ABC):
         """
         return
 
+    def build_index_streaming(
+        self,
+        train_embeddings: np.ndarray,
+        embeddings: Iterable[np.ndarray],
+        total: int,
+    ) -> None:
+        """Build the index with the embeddings provided in batches.
+        The default implementation writes the embeddings into a temporary memory map and calls `build_index`.
+        Subclasses that support adding embeddings incrementally could override this method
+        to train the index with `train_embeddings` and add the embeddings batch by batch.
+
+        :param train_embeddings: The embeddings sampled to train the index.
+        :type train_embeddings: np.ndarray
+        :param embeddings: The batches of all the embeddings to add.
+        :type embeddings: Iterable[np.ndarray]
+        :param total: The total number of the embeddings.
+        :type total: int
+        :return: None
+        """
+        tmp_path = f"{self.index_path}.tmp.npy"
+        memmap = None
+        idx = 0
+        for emb_batch in embeddings:
+            if memmap is None:
+                memmap = np.memmap(
+                    tmp_path,
+                    dtype=emb_batch.dtype,
+                    mode="w+",
+                    shape=(total, emb_batch.shape[1]),
+                )
+            memmap[idx : idx + emb_batch.shape[0]] = emb_batch
+            idx += emb_batch.shape[0]
+        self.build_index(memmap)
+        del memmap
+        os.remove(tmp_path)
+        return
+
     def add_embeddings(self, embeddings: np.ndarray, serialize: bool = True) -> None:
         """Add embeddings to the index.
 
@@ -68,6 +117,34 @@ class DenseIndexBase(ABC):
     def _add_embeddings_batch(self, embeddings: np.ndarray) -> None:
         return
 
+    def remove_embeddings(self, indices: np.ndarray, serialize: bool = True) -> None:
+        """Remove embeddings from the index.
+        The ids of the remaining embeddings are shifted to stay contiguous,
+        i.e., the embedding `i` becomes `i - (the number of removed ids less than i)`.
+        Indexes that do not support removal (see `support_removal`) raise `NotImplementedError`
+        without being modified, and should be rebuilt instead.
+
+        :param indices: The sorted ids of the embeddings to remove.
+        :type indices: np.ndarray
+        :param serialize: Whether to serialize the index after removing embeddings.
+        :type serialize: bool
+        :return: None
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support removing embeddings."
+        )
+
+    @property
+    def larger_is_closer(self) -> bool:
+        """Whether the larger scores returned by `search` mean the closer embeddings,
+        i.e., the scores are similarities instead of distances."""
+        return self.distance_function == "IP"
+
+    @property
+    def support_removal(self) -> bool:
+        """Whether the index could remove the embeddings in place by `remove_embeddings`."""
+        return False
+
     @TIME_METER("retrieve", "index")
     def search(
         self,
@@ -81,11 +158,12 @@ class DenseIndexBase(ABC):
         :type query: np.ndarray
         :param top_k: The number of most similar embeddings to return, defaults to 10.
         :type top_k: int, optional
-        :param search_kwargs: Additional search arguments.
+        :param search_kwargs: Additional search arguments, which override the tuned search parameters.
         :type search_kwargs: Any
         :return: The indices and scores of the top_k most similar embeddings with shape [n, k].
         :rtype: tuple[np.ndarray, np.ndarray]
         """
+        search_kwargs = {**self.search_params, **search_kwargs}
         scores = []
         indices = []
         p_logger = SimpleProgressLogger(
@@ -119,7 +197,15 @@ class DenseIndexBase(ABC):
 
     @abstractmethod
     def clean(self) -> None:
-        """Clean the index."""
+        """Clean the index.
+        Subclasses should call `_clean_search_params`, as the tuned search parameters are invalid for the new index."""
+        return
+
+    def _clean_search_params(self) -> None:
+        """Remove the search parameters selected by `autotune`."""
+        self.search_params = {}
+        if os.path.exists(self.search_params_path):
+            os.remove(self.search_params_path)
         return
 
     @property
@@ -159,5 +245,86 @@ class DenseIndexBase(ABC):
         logger.info(f"Search time: {time_cost:.4f} s")
         return top_k_acc
 
+    @property
+    def search_space(self) -> dict[str, list]:
+        """The candidate values of the search parameters used by `autotune`."""
+        return {}
+
+    def autotune(
+        self,
+        queries: np.ndarray,
+        ground_truth: np.ndarray,
+        top_k: int = 10,
+        search_space: Optional[dict[str, list]] = None,
+        target_recall: float = 0.9,
+        save: bool = True,
+    ) -> list[dict]:
+        """Sweep the search parameters and select the fastest one that reaches the `target_recall`.
+        If no search parameters reach the `target_recall`, the one with the highest recall is selected.
+        The selected search parameters are used as the default search arguments of the index.
+
+        :param queries: The query embeddings with shape [n, d].
+        :type queries: np.ndarray
+        :param ground_truth: The indices retrieved by the exact search with shape [n, k].
+        :type ground_truth: np.ndarray
+        :param top_k: The number of embeddings to retrieve, defaults to 10.
+        :type top_k: int, optional
+        :param search_space: The candidate values of each search parameter, defaults to `self.search_space`.
+        :type search_space: Optional[dict[str, list]], optional
+        :param target_recall: The minimum recall@k of the selected search parameters, defaults to 0.9.
+        :type target_recall: float, optional
+        :param save: Whether to save the selected search parameters, defaults to True.
+        :type save: bool, optional
+        :return: The pareto frontier of recall@k and QPS, sorted by recall in descending order.
+        :rtype: list[dict]
+        """
+        if search_space is None:
+            search_space = self.search_space
+        ground_truth = ground_truth[:, :top_k]
+        names = list(search_space.keys())
+        results = []
+        for values in product(*[search_space[name] for name in names]):
+            params = dict(zip(names, values))
+            self.search(queries[: self.batch_size], top_k, **params)  # warm up
+            start_time = perf_counter()
+            indices, _ = self.search(queries, top_k, **params)
+            time_cost = perf_counter() - start_time
+            hits = (indices[:, :, None] == ground_truth[:, None, :]) & (
+                ground_truth[:, None, :] >= 0
+            )
+            recall = float(hits.any(axis=1).sum() / max((ground_truth >= 0).sum(), 1))
+            results.append(
+                {"params": params, "recall": recall, "qps": len(queries) / time_cost}
+            )
+            logger.info(
+                f"Search params: {params}, "
+                f"Recall@{top_k}: {recall*100:.2f}%, "
+                f"QPS: {results[-1]['qps']:.2f}"
+            )
+
+        # compute the pareto frontier
+        frontier = []
+        for result in sorted(results, key=lambda r: (-r["recall"], -r["qps"])):
+            if (len(frontier) == 0) or (result["qps"] > frontier[-1]["qps"]):
+                frontier.append(result)
+
+        # select the operating point
+        candidates = [r for r in frontier if r["recall"] >= target_recall]
+        if len(candidates) > 0:
+            selected = candidates[-1]
+        else:
+            logger.warning(f"No search parameters reach the recall {target_recall}.")
+            selected = frontier[0]
+        logger.info(
+            f"Selected search params: {selected['params']}, "
+            f"Recall@{top_k}: {selected['recall']*100:.2f}%, "
+            f"QPS: {selected['qps']:.2f}"
+        )
+        self.search_params = selected["params"]
+        if save:
+            with open(self.search_params_path, "w", encoding="utf-8") as f:
+                json.dump(self.search_params, f)
+        return frontier
+
 
 DENSE_INDEX = Register[DenseIndexBase]("index")
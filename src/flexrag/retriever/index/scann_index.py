@@ -44,8 +44,7 @@ class ScaNNIndex(DenseIndexBase):
         return
 
     def build_index(self, embeddings: np.ndarray) -> None:
-        if self.is_trained:
-            self.clean()
+        self.clean()
         if self.cfg.distance_function == "IP":
             distance_measure = "dot_product"
         else:
@@ -94,6 +93,14 @@ class ScaNNIndex(DenseIndexBase):
         indices = np.array([[int(i) for i in idx] for idx in indices])
         return indices, scores
 
+    @property
+    def search_space(self) -> dict[str, list]:
+        leaves = {
+            max(1, int(self.cfg.num_leaves * r))
+            for r in (0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+        }
+        return {"leaves_to_search": sorted(leaves)}
+
     def serialize(self) -> None:
         assert self.is_trained, "Index should be trained first."
         logger.info(f"Serializing index to {self.index_path}")
@@ -108,6 +115,7 @@ class ScaNNIndex(DenseIndexBase):
         return
 
     def clean(self):
+        self._clean_search_params()
         if not self.is_trained:
             return
         if os.path.exists(self.index_path):
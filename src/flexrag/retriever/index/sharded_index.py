@@ -0,0 +1,300 @@
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+from omegaconf import OmegaConf
+from omegaconf.errors import ValidationError
+
+from flexrag.utils import Choices, LOGGER_MANAGER
+
+from .index_base import DENSE_INDEX, DenseIndexBase, DenseIndexBaseConfig
+
+logger = LOGGER_MANAGER.get_logger("flexrag.retrievers.index.sharded")
+
+
+# the sub-index config is created before the sharded index is registered,
+# thus the sharded index could not be nested.
+ShardIndexConfig = DENSE_INDEX.make_config(
+    default="faiss", config_name="ShardIndexConfig"
+)
+
+
+@dataclass
+class ShardedIndexConfig(DenseIndexBaseConfig, ShardIndexConfig):
+    """The configuration for the sharded index.
+
+    :param distance_function: The distance function shared by all shards,
+        which should be supported by the sub-index. Defaults to "IP".
+    :type distance_function: str
+    :param shard_num: The number of shards. Defaults to 4.
+    :type shard_num: int
+    :param search_workers: The number of threads used to search the shards. -1 means one thread per shard. Defaults to -1.
+    :type search_workers: int
+    """
+
+    distance_function: Choices(["IP", "L2", "COSINE", "HAMMING", "MANHATTAN"]) = "IP"  # type: ignore
+    shard_num: int = 4
+    search_workers: int = -1
+
+
+@DENSE_INDEX("sharded", config_class=ShardedIndexConfig)
+class ShardedIndex(DenseIndexBase):
+    """ShardedIndex partitions the embeddings into `shard_num` contiguous ranges,
+    each of which is stored in a sub-index of any registered type.
+    Searches are sent to all shards in parallel and the per-shard results are merged.
+    New embeddings are always added to the last shard.
+    """
+
+    def __init__(self, cfg: ShardedIndexConfig, index_path: str) -> None:
+        super().__init__(cfg, index_path)
+        self.meta_path = os.path.join(self.index_path, "meta.json")
+        self.shard_num = cfg.shard_num
+        self.sub_index_type = cfg.index_type
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["shard_num"] != self.shard_num:
+                logger.warning(
+                    f"The index is built with {meta['shard_num']} shards, "
+                    f"ignoring the configured shard_num {self.shard_num}."
+                )
+                self.shard_num = meta["shard_num"]
+            assert (
+                meta["index_type"] == self.sub_index_type
+            ), f"The index is built with {meta['index_type']} shards."
+
+        # share the distance function with all shards
+        cfg_name = f"{DENSE_INDEX[self.sub_index_type]['short_names'][0]}_config"
+        try:
+            self.sub_cfg = OmegaConf.merge(
+                cfg, {cfg_name: {"distance_function": str(self.distance_function)}}
+            )
+        except ValidationError:
+            raise ValueError(
+                f"The {self.sub_index_type} index does not support "
+                f"the {self.distance_function} distance."
+            )
+
+        # load shards
+        self.deserialize()
+        self.search_workers = cfg.search_workers
+        if self.search_workers == -1:
+            self.search_workers = self.shard_num
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        return
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        """The threads searching the shards, which are started on the first search."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.search_workers)
+            return self._pool
+
+    def close(self) -> None:
+        """Shut down the threads searching the shards."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        return
+
+    def __del__(self) -> None:
+        if getattr(self, "_pool", None) is not None:
+            self._pool.shutdown(wait=False)
+        return
+
+    def _shard_path(self, shard_id: int) -> str:
+        return os.path.join(self.index_path, f"shard_{shard_id}")
+
+    def build_index(self, embeddings: np.ndarray) -> None:
+        self.clean()
+        bounds = np.linspace(0, embeddings.shape[0], self.shard_num + 1, dtype=int)
+        for shard_id in range(self.shard_num):
+            logger.info(f"Building shard {shard_id}/{self.shard_num}")
+            self.build_shard(
+                shard_id, embeddings[bounds[shard_id] : bounds[shard_id + 1]]
+            )
+        return
+
+    def build_index_streaming(
+        self,
+        train_embeddings: np.ndarray,
+        embeddings: Iterable[np.ndarray],
+        total: int,
+    ) -> None:
+        self.clean()
+        bounds = np.linspace(0, total, self.shard_num + 1, dtype=int)
+        embeddings = iter(embeddings)
+        rest = None
+
+        def get_shard_embeddings(size: int):
+            nonlocal rest
+            while size > 0:
+                if (rest is None) or (len(rest) == 0):
+                    rest = next(embeddings)
+                emb_batch, rest = rest[:size], rest[size:]
+                size -= len(emb_batch)
+                yield emb_batch
+            return
+
+        # all shards are trained with the same samples
+        for shard_id, shard in enumerate(self.shards):
+            logger.info(f"Building shard {shard_id}/{self.shard_num}")
+            os.makedirs(self.index_path, exist_ok=True)
+            size = bounds[shard_id + 1] - bounds[shard_id]
+            shard.build_index_streaming(
+                train_embeddings, get_shard_embeddings(size), size
+            )
+        self._save_meta()
+        return
+
+    def build_shard(self, shard_id: int, embeddings: np.ndarray) -> None:
+        """Build (or rebuild) a single shard.
+        As each shard holds a contiguous range of the embeddings,
+        a trained shard (except the last one) could only be rebuilt with the same number of embeddings.
+
+        :param shard_id: The id of the shard to build.
+        :type shard_id: int
+        :param embeddings: The embeddings of the shard.
+        :type embeddings: np.ndarray
+        :return: None
+        """
+        shard = self.shards[shard_id]
+        if shard.is_trained and (shard_id != self.shard_num - 1):
+            assert len(shard) == embeddings.shape[0], (
+                f"Shard {shard_id} contains {len(shard)} embeddings, "
+                f"but {embeddings.shape[0]} embeddings are provided."
+            )
+        os.makedirs(self.index_path, exist_ok=True)
+        shard.build_index(embeddings)
+        self._save_meta()
+        return
+
+    def _add_embeddings_batch(self, embeddings: np.ndarray) -> None:
+        self.shards[-1].add_embeddings(embeddings, serialize=False)
+        return
+
+    def remove_embeddings(self, indices: np.ndarray, serialize: bool = True) -> None:
+        indices = np.asarray(indices, dtype=np.int64)
+        bounds = self.offsets + [len(self)]
+        for shard_id, shard in enumerate(self.shards):
+            start, end = np.searchsorted(indices, bounds[shard_id : shard_id + 2])
+            if start < end:
+                shard.remove_embeddings(
+                    indices[start:end] - bounds[shard_id], serialize=serialize
+                )
+        return
+
+    @property
+    def larger_is_closer(self) -> bool:
+        return self.shards[0].larger_is_closer
+
+    @property
+    def support_removal(self) -> bool:
+        return all(shard.support_removal for shard in self.shards if shard.is_trained)
+
+    def _search_batch(
+        self,
+        query: np.ndarray,
+        top_k: int,
+        **search_kwargs,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # fan out the queries to all shards, each of which uses its own tuned search parameters
+        futures = [
+            self.pool.submit(
+                shard._search_batch,
+                query,
+                top_k,
+                **{**shard.search_params, **search_kwargs},
+            )
+            for shard in self.shards
+        ]
+        indices = []
+        scores = []
+        for offset, future in zip(self.offsets, futures):
+            shard_indices, shard_scores = future.result()
+            shard_indices = np.asarray(shard_indices, dtype=np.int64)
+            shard_scores = np.asarray(shard_scores, dtype=np.float32)
+            # pad the results if the shard returns less than top_k results
+            if shard_indices.shape[1] < top_k:
+                pad_width = ((0, 0), (0, top_k - shard_indices.shape[1]))
+                shard_indices = np.pad(shard_indices, pad_width, constant_values=-1)
+                shard_scores = np.pad(shard_scores, pad_width)
+            indices.append(np.where(shard_indices >= 0, shard_indices + offset, -1))
+            scores.append(shard_scores)
+        indices = np.concatenate(indices, axis=1)  # [bsz, shard_num * top_k]
+        scores = np.concatenate(scores, axis=1)  # [bsz, shard_num * top_k]
+
+        # merge the top_k results of all shards
+        if self.larger_is_closer:
+            keys = np.where(indices >= 0, -scores, np.inf)
+        else:
+            keys = np.where(indices >= 0, scores, np.inf)
+        top_k = min(top_k, keys.shape[1])
+        selected = np.sort(np.argpartition(keys, top_k - 1, axis=1)[:, :top_k])
+        order = np.argsort(
+            np.take_along_axis(keys, selected, axis=1), axis=1, kind="stable"
+        )
+        selected = np.take_along_axis(selected, order, axis=1)
+        indices = np.take_along_axis(indices, selected, axis=1)
+        scores = np.take_along_axis(scores, selected, axis=1)
+        return indices, scores
+
+    def serialize(self) -> None:
+        for shard in self.shards:
+            if shard.is_trained:
+                shard.serialize()
+        self._save_meta()
+        return
+
+    def deserialize(self) -> None:
+        self.shards: list[DenseIndexBase] = [
+            DENSE_INDEX.load(self.sub_cfg, index_path=self._shard_path(i))
+            for i in range(self.shard_num)
+        ]
+        return
+
+    def _save_meta(self) -> None:
+        os.makedirs(self.index_path, exist_ok=True)
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"shard_num": self.shard_num, "index_type": self.sub_index_type}, f
+            )
+        return
+
+    def clean(self) -> None:
+        self.close()
+        self._clean_search_params()
+        for shard in self.shards:
+            shard.clean()
+        if os.path.exists(self.index_path):
+            shutil.rmtree(self.index_path)
+        return
+
+    @property
+    def offsets(self) -> list[int]:
+        """The global id of the first embedding in each shard."""
+        lengths = [len(shard) if shard.is_trained else 0 for shard in self.shards]
+        return np.cumsum([0] + lengths[:-1]).tolist()
+
+    @property
+    def search_space(self) -> dict[str, list]:
+        return self.shards[0].search_space
+
+    @property
+    def embedding_size(self) -> int:
+        return self.shards[0].embedding_size
+
+    @property
+    def is_trained(self) -> bool:
+        return all(shard.is_trained for shard in self.shards)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards if shard.is_trained)
@@ -66,7 +66,7 @@ def batched_cache(func):
         disable_cache = search_kwargs.pop(
             "disable_cache", os.environ.get("DISABLE_CACHE", "False")
         )
-        if disable_cache == "True":
+        if disable_cache in (True, "True"):
             return func(self, query, **search_kwargs)
 
         # search from cache
@@ -80,7 +80,7 @@ def batched_cache(func):
             for q in query
         ]
         keys = [json.dumps(key, sort_keys=True) for key in keys]
-        results = [dict_to_retrieved(RETRIEVAL_CACHE.get(k, None)) for k in keys]
+        results = [dict_to_retrieved(r) for r in RETRIEVAL_CACHE.get_many(keys)]
 
         # search from database
         new_query = [q for q, r in zip(query, results) if r is None]
@@ -90,7 +90,10 @@ def batched_cache(func):
             # update cache
             for n, r in zip(new_indices, new_results):
                 results[n] = r
-                RETRIEVAL_CACHE[keys[n]] = retrieved_to_dict(r)
+            RETRIEVAL_CACHE.set_many(
+                [keys[n] for n in new_indices],
+                [retrieved_to_dict(r) for r in new_results],
+            )
         # check results
         check(results)
         return results
@@ -1,16 +1,18 @@
 import importlib
+import inspect
 import json
 import logging
+import math
 import os
 import sys
 import threading
+import weakref
 from contextlib import contextmanager
 from dataclasses import field, make_dataclass
 from enum import Enum
-from functools import partial
-from multiprocessing import Manager
+from functools import partial, wraps
 from time import perf_counter
-from typing import Coroutine, Generic, Iterable, Optional, TypeVar
+from typing import Generic, Iterable, Optional, TypeVar
 
 import numpy as np
 from omegaconf import MISSING, DictConfig, ListConfig, OmegaConf
@@ -325,56 +327,266 @@ json.dumps = partial(json.dumps, cls=_CustomEncoder)
 json.dump = partial(json.dump, cls=_CustomEncoder)
 
 
+class _LatencyHistogram:
+    """A fixed-size histogram of latencies with logarithmic buckets.
+
+    Each power of two is split into `SUB_BUCKETS` linear buckets,
+    thus the estimated percentiles overestimate the latencies by less than 1 / SUB_BUCKETS relatively.
+    """
+
+    __slots__ = ("counts", "calls", "total", "max")
+    SUB_BUCKETS = 8
+    MIN_EXP = -23  # about 0.1 us
+    MAX_EXP = 15  # about 9 hours
+    NUM_BUCKETS = (MAX_EXP - MIN_EXP + 1) * SUB_BUCKETS
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        return
+
+    def record(self, elapsed: float) -> None:
+        mantissa, exp = math.frexp(elapsed)  # elapsed = mantissa * 2 ** exp
+        idx = (exp - self.MIN_EXP) * self.SUB_BUCKETS + int(
+            (mantissa - 0.5) * 2 * self.SUB_BUCKETS
+        )
+        if idx < 0:
+            idx = 0
+        elif idx >= self.NUM_BUCKETS:
+            idx = self.NUM_BUCKETS - 1
+        self.counts[idx] += 1
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        return
+
+    def merge(self, other: "_LatencyHistogram") -> None:
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.calls += other.calls
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th percentile (0 <= q <= 100) by the upper bound of the bucket."""
+        if self.calls == 0:
+            return 0.0
+        target = self.calls * q / 100
+        accumulated = 0
+        for idx, c in enumerate(self.counts):
+            accumulated += c
+            if (accumulated >= target) and (c > 0):
+                exp, sub = divmod(idx, self.SUB_BUCKETS)
+                upper = math.ldexp(
+                    0.5 + (sub + 1) / (2 * self.SUB_BUCKETS), exp + self.MIN_EXP
+                )
+                return min(upper, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "counts": list(self.counts),
+            "calls": self.calls,
+            "total": self.total,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "_LatencyHistogram":
+        hist = cls()
+        hist.counts = list(data["counts"])
+        hist.calls = data["calls"]
+        hist.total = data["total"]
+        hist.max = data["max"]
+        return hist
+
+
+class _ThreadSentinel:
+    """A weak referenceable object whose lifetime is bound to a thread."""
+
+
+# the recordings of the parent process should not be counted again in the forked children
+_TIME_METERS: "weakref.WeakSet[_TimeMeter]" = weakref.WeakSet()
+
+
+def _reset_time_meters() -> None:
+    for meter in list(_TIME_METERS):
+        meter.reset()
+    return
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_time_meters)
+
+
 class _TimeMeter:
+    """Record the latencies of the decorated functions.
+
+    The latencies are recorded into the per-thread histograms without any locking or
+    inter-process communication, so that the instrumentation is cheap enough for the hot paths.
+    The histograms of all threads are merged when the statistics are requested,
+    and the histograms of the exited threads are folded into the merged recordings.
+    Recordings of other processes are not collected automatically,
+    use `snapshot` in the child process and `merge` in the parent process to combine them.
+    """
+
     def __init__(self):
-        self._manager = Manager()
-        self.timers = self._manager.dict()
+        self._local = threading.local()
+        self._lock = threading.Lock()  # only used when registering a new thread
+        self._thread_timers: list[dict[tuple[str, ...], _LatencyHistogram]] = []
+        self._merged_timers: dict[tuple[str, ...], _LatencyHistogram] = {}
+        _TIME_METERS.add(self)
         return
 
     def __call__(self, *timer_names: str):
         def time_it(func):
+            @wraps(func)
             def wrapper(*args, **kwargs):
                 start_time = perf_counter()
                 result = func(*args, **kwargs)
-                end_time = perf_counter()
-                if timer_names not in self.timers:
-                    self.timers[timer_names] = self._manager.list()
-                self.timers[timer_names].append(end_time - start_time)
+                elapsed = perf_counter() - start_time
+                try:
+                    hist = self._local.timers[timer_names]
+                except (AttributeError, KeyError):
+                    hist = self._get_histogram(timer_names)
+                hist.record(elapsed)
                 return result
 
+            @wraps(func)
             async def async_wrapper(*args, **kwargs):
                 start_time = perf_counter()
                 result = await func(*args, **kwargs)
-                end_time = perf_counter()
-                if timer_names not in self.timers:
-                    self.timers[timer_names] = self._manager.list()
-                self.timers[timer_names].append(end_time - start_time)
+                elapsed = perf_counter() - start_time
+                try:
+                    hist = self._local.timers[timer_names]
+                except (AttributeError, KeyError):
+                    hist = self._get_histogram(timer_names)
+                hist.record(elapsed)
                 return result
 
-            if isinstance(func, Coroutine):
+            if inspect.iscoroutinefunction(func):
                 return async_wrapper
             return wrapper
 
         return time_it
 
+    def _get_histogram(self, timer_names: tuple[str, ...]) -> _LatencyHistogram:
+        """Get the histogram of current thread, create it if not exists."""
+        try:
+            timers = self._local.timers
+        except AttributeError:
+            timers = self._local.timers = {}
+            # the sentinel is released with the thread-local storage when the thread exits
+            self._local.sentinel = _ThreadSentinel()
+            weakref.finalize(
+                self._local.sentinel, self._fold_released, weakref.ref(self), timers
+            )
+            with self._lock:
+                self._thread_timers.append(timers)
+        if timer_names not in timers:
+            timers[timer_names] = _LatencyHistogram()
+        return timers[timer_names]
+
+    @staticmethod
+    def _fold_released(
+        meter_ref: "weakref.ref[_TimeMeter]",
+        timers: dict[tuple[str, ...], _LatencyHistogram],
+    ) -> None:
+        """Fold the histograms of an exited thread, unless the meter has been released."""
+        meter = meter_ref()
+        if meter is not None:
+            meter._fold(timers)
+        return
+
+    def _fold(self, timers: dict[tuple[str, ...], _LatencyHistogram]) -> None:
+        """Fold the histograms of an exited thread into the merged recordings."""
+        with self._lock:
+            for n, thread_timers in enumerate(self._thread_timers):
+                if thread_timers is timers:
+                    break
+            else:  # the recordings have been reset
+                return
+            for name, hist in timers.items():
+                if name not in self._merged_timers:
+                    self._merged_timers[name] = _LatencyHistogram()
+                self._merged_timers[name].merge(hist)
+            self._thread_timers.pop(n)
+        return
+
+    @property
+    def timers(self) -> dict[tuple[str, ...], _LatencyHistogram]:
+        """The histograms merged from all threads and the explicitly merged recordings."""
+        merged: dict[tuple[str, ...], _LatencyHistogram] = {}
+        # merge under the lock, so that a folding thread is not counted twice
+        with self._lock:
+            for timers in [self._merged_timers] + self._thread_timers:
+                for name, hist in list(timers.items()):
+                    if name not in merged:
+                        merged[name] = _LatencyHistogram()
+                    merged[name].merge(hist)
+        return merged
+
+    def snapshot(self) -> dict[tuple[str, ...], dict]:
+        """Return a picklable snapshot of the recordings in current process.
+
+        :return: The snapshot that can be passed to `merge` in another process.
+        :rtype: dict[tuple[str, ...], dict]
+        """
+        return {name: hist.to_dict() for name, hist in self.timers.items()}
+
+    def merge(self, snapshot: dict[tuple[str, ...], dict]) -> None:
+        """Merge the recordings from another process.
+
+        :param snapshot: The snapshot returned by `snapshot`.
+        :type snapshot: dict[tuple[str, ...], dict]
+        :return: None
+        """
+        with self._lock:
+            for name, data in snapshot.items():
+                name = tuple(name)
+                if name not in self._merged_timers:
+                    self._merged_timers[name] = _LatencyHistogram()
+                self._merged_timers[name].merge(_LatencyHistogram.from_dict(data))
+        return
+
+    def reset(self) -> None:
+        """Clear all the recordings."""
+        # replace the lock first, as the old thread-local storage folds the timers on release
+        self._lock = threading.Lock()
+        self._thread_timers = []
+        self._merged_timers = {}
+        self._local = threading.local()
+        return
+
     @property
     def statistics(self) -> list[dict[str, float]]:
         statistics = []
         for k, v in self.timers.items():
-            v = list(v)
             statistics.append(
                 {
                     "name": k,
-                    "calls": len(v),
-                    "average call time": np.mean(v),
-                    "total time": np.sum(v),
+                    "calls": v.calls,
+                    "average call time": v.total / max(v.calls, 1),
+                    "total time": v.total,
+                    "p50": v.percentile(50),
+                    "p90": v.percentile(90),
+                    "p99": v.percentile(99),
+                    "max": v.max,
                 }
             )
         return statistics
 
     @property
     def details(self) -> dict:
-        return {k: v for k, v in self.timers.items()}
+        """The histogram of each timer.
+        Note that the raw latencies of each call are no longer kept since the histograms are introduced,
+        each value is a dict of `counts` (the number of calls in each bucket), `calls`, `total` and `max`.
+        """
+        return {k: v.to_dict() for k, v in self.timers.items()}
 
 
 TIME_METER = _TimeMeter()
@@ -27,3 +27,12 @@ class TestAssistant:
         assistant = BasicAssistant(self.cfg.assistant_config)
         r1, _, _ = assistant.answer(self.query)
         return
+
+    @pytest.mark.asyncio
+    async def test_answer_batch(self):
+        assistant = BasicAssistant(self.cfg.assistant_config)
+        results = assistant.answer_batch([self.query, self.query])
+        assert len(results) == 2
+        r2, _, _ = await assistant.async_answer(self.query)
+        assert isinstance(r2, str)
+        return
@@ -2,6 +2,8 @@ import os
 import sys
 import tempfile
 
+import pytest
+
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from flexrag.cache import (
@@ -10,6 +12,8 @@ from flexrag.cache import (
     LMDBBackendConfig,
     ShelveBackendConfig,
 )
+from flexrag.cache.backends import load_backend
+from flexrag.cache.persistent_cache import _LEGACY_META_KEY
 
 
 class TestCache:
@@ -101,3 +105,140 @@ class TestCache:
             cache.clear()
             assert len(cache) == 0
         return
+
+    def test_evict_order(self):
+        # test LFU
+        cache = PersistentCache(
+            PersistentCacheConfig(backend="dict", maxsize=3, evict_order="LFU")
+        )
+        cache["a"] = "a"
+        cache["b"] = "b"
+        cache["c"] = "c"
+        assert cache["a"] == "a"
+        assert cache["a"] == "a"
+        assert cache["c"] == "c"
+        cache["d"] = "d"
+        assert set(cache) == {"a", "c", "d"}
+        cache["e"] = "e"
+        assert set(cache) == {"a", "c", "e"}
+
+        # test FIFO
+        cache = PersistentCache(
+            PersistentCacheConfig(backend="dict", maxsize=3, evict_order="FIFO")
+        )
+        cache["a"] = "a"
+        cache["b"] = "b"
+        cache["c"] = "c"
+        assert cache["a"] == "a"
+        cache["d"] = "d"
+        assert set(cache) == {"b", "c", "d"}
+
+        # test reset arguments
+        cache.reset_arguments(maxsize=2, evict_order="LRU")
+        assert set(cache) == {"c", "d"}
+        assert cache.evict_order == "LRU"
+        return
+
+    def test_batched_operations(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = PersistentCacheConfig(
+                backend="lmdb",
+                lmdb_config=LMDBBackendConfig(
+                    db_path=os.path.join(tmpdir, "test.lmdb"),
+                    serializer="json",
+                ),
+                maxsize=3,
+                evict_order="LRU",
+            )
+            cache = PersistentCache(cfg)
+
+            # test set_many & get_many
+            cache.set_many(["a", "b", "c"], ["a", "b", "c"])
+            assert cache.get_many(["a", "x", "c"]) == ["a", None, "c"]
+            cache.set_many(["d"], ["d"])
+            assert set(cache) == {"a", "c", "d"}
+
+            # test delete_many
+            cache.delete_many(["a", "x"])
+            assert set(cache) == {"c", "d"}
+        return
+
+    def test_read_transaction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = PersistentCacheConfig(
+                backend="lmdb",
+                lmdb_config=LMDBBackendConfig(
+                    db_path=os.path.join(tmpdir, "test.lmdb"),
+                    serializer="json",
+                ),
+                maxsize=2,
+                evict_order="FIFO",
+            )
+            cache = PersistentCache(cfg)
+
+            # FIFO reads the items in read-only transactions
+            cache.set_many(["a", "b"], ["a", "b"])
+            assert cache["a"] == "a"
+            assert cache.get_many(["a", "x"]) == ["a", None]
+            cache["c"] = "c"
+            assert set(cache) == {"b", "c"}
+
+            # writing in a read-only transaction is rejected
+            backend = load_backend(
+                PersistentCacheConfig(
+                    backend="lmdb",
+                    lmdb_config=LMDBBackendConfig(
+                        db_path=os.path.join(tmpdir, "backend.lmdb"),
+                        serializer="json",
+                    ),
+                )
+            )
+            with backend.transaction():
+                assert backend.get("x") is None
+                with pytest.raises(RuntimeError):
+                    backend["x"] = "x"
+            assert "x" not in backend
+        return
+
+    def test_repair_metadata(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = PersistentCacheConfig(
+                backend="lmdb",
+                lmdb_config=LMDBBackendConfig(
+                    db_path=os.path.join(tmpdir, "test.lmdb"),
+                    serializer="pickle",
+                ),
+                maxsize=3,
+                evict_order="LRU",
+            )
+            cache = PersistentCache(cfg)
+            cache["a"] = "a"
+            cache["b"] = "b"
+            del cache
+
+            # simulate an older version writing the legacy metadata and an item
+            backend = load_backend(
+                PersistentCacheConfig(
+                    backend="lmdb",
+                    lmdb_config=LMDBBackendConfig(
+                        db_path=os.path.join(tmpdir, "backend.lmdb"),
+                        serializer="json",
+                    ),
+                )
+            )
+            backend[_LEGACY_META_KEY] = {
+                "maxsize": 3,
+                "evict_order": "LRU",
+                "order": {"a": None, "b": None, "c": None},
+                "counter": {},
+            }
+            backend["c"] = "c"
+            del backend
+
+            # the legacy metadata is dropped and the metadata is rebuilt
+            cache = PersistentCache(cfg)
+            assert len(cache) == 3
+            assert set(cache) == {"a", "b", "c"}
+            cache["d"] = "d"
+            assert len(cache) == 3
+        return
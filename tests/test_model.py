@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dataclasses import dataclass, field
 
 import pytest
@@ -6,6 +7,8 @@ from omegaconf import OmegaConf
 
 from flexrag.models import (
     AnthropicGenerator,
+    CachedEncoder,
+    CachedEncoderConfig,
     AnthropicGeneratorConfig,
     CohereEncoder,
     CohereEncoderConfig,
@@ -29,6 +32,7 @@ from flexrag.models import (
     VLLMGenerator,
     VLLMGeneratorConfig,
 )
+from flexrag.models.utils import bucket_by_length
 from flexrag.prompt import ChatPrompt, ChatTurn
 
 
@@ -128,6 +132,7 @@ class EncodeTestConfig:
     hf_config: HFEncoderConfig = field(default_factory=HFEncoderConfig)
     jina_config: JinaEncoderConfig = field(default_factory=JinaEncoderConfig)
     cohere_config: CohereEncoderConfig = field(default_factory=CohereEncoderConfig)
+    cached_config: CachedEncoderConfig = field(default_factory=CachedEncoderConfig)
 
 
 class TestEncode:
@@ -178,3 +183,57 @@ class TestEncode:
         r2 = await encoder.async_encode(self.text)
         assert (r1 - r2).max() < 1e-4
         return
+
+    @pytest.mark.asyncio
+    async def test_cached(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.cfg.cached_config.cache_path = tempdir
+            encoder = CachedEncoder(self.cfg.cached_config)
+            r1 = encoder.encode(self.text)
+            r2 = await encoder.async_encode(self.text)
+            assert (r1 - r2).max() < 1e-4
+
+            # load the embeddings from the persistent cache
+            encoder = CachedEncoder(self.cfg.cached_config)
+            base_calls = []
+
+            def encode(texts):
+                base_calls.append(texts)
+                return base_encode(texts)
+
+            base_encode = encoder.encoder.encode
+            encoder.encoder.encode = encode
+            r3 = encoder.encode(self.text)
+            assert (r1 - r3).max() < 1e-4
+            assert len(base_calls) == 0
+
+            # only the uncached texts are encoded by the base encoder
+            r4 = encoder.encode(self.text + ["Who is Clark Kent?"])
+            assert (r1 - r4[:2]).max() < 1e-4
+            assert base_calls == [["Who is Clark Kent?"]]
+        return
+
+
+class TestUtils:
+    def test_bucket_by_length(self):
+        lengths = [3, 10, 1, 7, 7, 2, 25, 4]
+        batches = bucket_by_length(lengths, max_tokens=16)
+
+        # the padded size of each batch is under the budget,
+        # except the single input that is longer than the budget
+        for batch in batches:
+            padded_size = len(batch) * max(lengths[i] for i in batch)
+            assert (padded_size <= 16) or (len(batch) == 1)
+        assert batches[0] == [6]
+
+        # each input is assigned to exactly one batch, thus the order could be restored
+        assert sorted(i for batch in batches for i in batch) == list(range(8))
+        outputs = [None] * len(lengths)
+        for batch in batches:
+            for i, output in zip(batch, [lengths[i] * 2 for i in batch]):
+                outputs[i] = output
+        assert outputs == [length * 2 for length in lengths]
+
+        # empty input
+        assert bucket_by_length([], max_tokens=16) == []
+        return
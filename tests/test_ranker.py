@@ -1,10 +1,14 @@
 import os
+import tempfile
 from dataclasses import dataclass, field
 
+import numpy as np
 import pytest
 from omegaconf import OmegaConf
 
 from flexrag.ranker import (
+    CascadeRanker,
+    CascadeRankerConfig,
     CohereRanker,
     CohereRankerConfig,
     HFColBertRanker,
@@ -23,6 +27,7 @@ from flexrag.ranker import (
     VoyageRankerConfig,
     RankingResult,
 )
+from flexrag.retriever import RetrievedContext
 
 
 @dataclass
@@ -98,12 +103,51 @@ class TestRanker:
         self.valid_result(r1, r2)
         return
 
+    def test_rank_gpt_tournament(self):
+        cfg = OmegaConf.merge(
+            self.cfg.rankgpt_config,
+            {"window_strategy": "tournament", "window_size": 2, "step_size": 1},
+        )
+        candidates = [f"{c} ({n})" for n in range(3) for c in self.candidates]
+        for batch_queries in [False, True]:
+            cfg.batch_queries = batch_queries
+            ranker = RankGPTRanker(cfg)
+            r = ranker.rank_batch(
+                [self.query, self.query], [candidates, self.candidates]
+            )
+            # the results are permutations of the candidates
+            assert sorted(r[0].candidates) == sorted(candidates)
+            assert sorted(r[1].candidates) == sorted(self.candidates)
+        return
+
     @pytest.mark.asyncio
     async def test_rank_hf_cross(self):
         ranker = HFCrossEncoderRanker(self.cfg.hf_cross_config)
         r1 = ranker.rank(self.query, self.candidates)
         r2 = await ranker.async_rank(self.query, self.candidates)
         self.valid_result(r1, r2)
+        r3 = ranker.rank_batch([self.query, self.query], [self.candidates, []])
+        self.valid_result(r1, r3[0])
+        assert len(r3[1].candidates) == 0
+        return
+
+    def test_rank_score_cache(self):
+        cfg = OmegaConf.merge(
+            self.cfg.hf_cross_config,
+            {
+                "use_score_cache": True,
+                "score_cache_config": {"backend": "dict", "maxsize": 100},
+            },
+        )
+        ranker = HFCrossEncoderRanker(cfg)
+        r1 = ranker.rank(self.query, self.candidates)
+        assert len(ranker.score_cache) == len(self.candidates)
+        r2 = ranker.rank(self.query, self.candidates[::-1])
+        self.valid_result(r1, r2)
+
+        # the arguments that do not affect the scores are excluded from the cache keys
+        cfg = OmegaConf.merge(cfg, {"max_tokens": 1024, "ranking_field": "text"})
+        assert HFCrossEncoderRanker(cfg).ranker_identity == ranker.ranker_identity
         return
 
     @pytest.mark.asyncio
@@ -112,6 +156,9 @@ class TestRanker:
         r1 = ranker.rank(self.query, self.candidates)
         r2 = await ranker.async_rank(self.query, self.candidates)
         self.valid_result(r1, r2)
+        r3 = ranker.rank_batch([self.query, self.query], [self.candidates, []])
+        self.valid_result(r1, r3[0])
+        assert len(r3[1].candidates) == 0
         return
 
     @pytest.mark.asyncio
@@ -120,4 +167,83 @@ class TestRanker:
         r1 = ranker.rank(self.query, self.candidates)
         r2 = await ranker.async_rank(self.query, self.candidates)
         self.valid_result(r1, r2)
+        r3 = ranker.rank_batch([self.query, self.query], [self.candidates, []])
+        self.valid_result(r1, r3[0])
+        assert len(r3[1].candidates) == 0
+        return
+
+    def test_rank_hf_colbert_token_store(self):
+        passages = [{"id": str(n), "text": c} for n, c in enumerate(self.candidates)]
+        candidates = [
+            RetrievedContext(retriever="test", query=self.query, data=p)
+            for p in passages
+        ]
+        with tempfile.TemporaryDirectory() as tempdir:
+            cfg = OmegaConf.merge(
+                self.cfg.hf_colbert_config,
+                {"ranking_field": "text", "token_store_path": tempdir},
+            )
+            ranker = HFColBertRanker(cfg)
+            r1 = ranker.rank(self.query, candidates)
+            ranker.add_passages(passages)
+            r2 = ranker.rank(self.query, candidates)
+            self.valid_result(r1, r2)
+
+            # the partially committed documents are dropped when reloading
+            with open(os.path.join(tempdir, "offsets.bin"), "ab") as f:
+                f.write(np.array([1 << 20], dtype=np.int64).tobytes())
+            with open(os.path.join(tempdir, "ids.jsonl"), "a") as f:
+                f.write('"partial')
+            ranker = HFColBertRanker(cfg)
+            assert len(ranker.token_store) == len(passages)
+            r3 = ranker.rank(self.query, candidates)
+            self.valid_result(r1, r3)
+
+            # the score cache is looked up before the token store
+            cache_cfg = OmegaConf.merge(
+                cfg,
+                {
+                    "use_score_cache": True,
+                    "score_cache_config": {"backend": "dict", "maxsize": 100},
+                },
+            )
+            ranker = HFColBertRanker(cache_cfg)
+            r4 = ranker.rank(self.query, candidates)
+            assert len(ranker.score_cache) == len(candidates)
+            self.valid_result(r1, r4)
+
+            # the token store built by another model is cleaned
+            cfg.normalize_embeddings = not cfg.normalize_embeddings
+            ranker = HFColBertRanker(cfg)
+            assert len(ranker.token_store) == 0
+        return
+
+    def test_rank_cascade(self):
+        cfg = OmegaConf.merge(
+            OmegaConf.structured(CascadeRankerConfig),
+            {
+                "ranker_type": ["hf_colbert", "hf_cross_encoder"],
+                "hf_colbert_config": self.cfg.hf_colbert_config,
+                "hf_cross_encoder_config": self.cfg.hf_cross_config,
+            },
+        )
+        cfg.hf_colbert_config.reserve_num = 1
+        ranker = CascadeRanker(cfg)
+        r = ranker.rank_batch([self.query, self.query], [self.candidates, []])
+        assert len(r[0].candidates) == 1
+        assert len(r[1].candidates) == 0
+
+        # the stages are delegated by `_rank` as well
+        ((indices, scores),) = ranker._rank_batch([self.query], [self.candidates])
+        assert [self.candidates[i] for i in indices] == r[0].candidates
+        assert scores[indices[0]] == r[0].scores[0]
+
+        # the final order of the candidates is cached
+        cfg.use_score_cache = True
+        cfg.score_cache_config = {"backend": "dict", "maxsize": 100}
+        ranker = CascadeRanker(cfg)
+        r1 = ranker.rank(self.query, self.candidates)
+        assert len(ranker.score_cache) == 1
+        r2 = ranker.rank(self.query, self.candidates)
+        assert r1.candidates == r2.candidates == r[0].candidates
         return
@@ -2,6 +2,11 @@ import os
 import tempfile
 import uuid
 import pytest
+import bm25s
+import lance
+import numpy as np
+import pandas as pd
+from copy import deepcopy
 from dataclasses import dataclass, field
 
 from omegaconf import MISSING, OmegaConf
@@ -17,6 +22,7 @@ from flexrag.retriever import (
     TypesenseRetriever,
     TypesenseRetrieverConfig,
 )
+from flexrag.retriever.embedding_store import EmbeddingQuantizer
 
 
 @dataclass
@@ -77,6 +83,201 @@ class TestRetrievers:
             assert len(r[1]) == 10
         return
 
+    def test_dense_fast_start(self):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))[:1000]
+        with tempfile.TemporaryDirectory() as tempdir:
+            cfg = deepcopy(self.cfg.dense_config)
+            cfg.database_path = tempdir
+            cfg.fast_start = True
+            retriever = DenseRetriever(cfg)
+            retriever.add_passages(corpus)
+            expected = retriever.search(self.query, disable_cache=True)
+
+            # the truncated manifest is ignored and rewritten
+            with open(retriever.manifest_path, "r+", encoding="utf-8") as f:
+                f.truncate(10)
+            retriever = DenseRetriever(cfg)
+            assert len(retriever) == len(corpus)
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == [
+                [c.data["id"] for c in ctxs] for ctxs in expected
+            ]
+            assert DenseRetriever(cfg)._manifest is not None
+        return
+
+    def test_dense_delete_passages(self):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.cfg.dense_config.database_path = tempdir
+            retriever = DenseRetriever(self.cfg.dense_config)
+            retriever.add_passages(corpus)
+
+            # deleted passages are filtered out before and after purging
+            r = retriever.search(self.query, disable_cache=True)
+            deleted = [c.data["id"] for ctxs in r for c in ctxs]
+            retriever.delete_passages(deleted)
+            retriever.purge_deleted()
+            assert len(retriever) == len(corpus) - len(set(deleted))
+            assert len(retriever.index) == len(retriever)
+            r = retriever.search(self.query, disable_cache=True)
+            for ctxs in r:
+                assert len(ctxs) == 10
+                assert all(c.data["id"] not in deleted for c in ctxs)
+        return
+
+    def test_dense_exact_search(self):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))[:1000]
+        with tempfile.TemporaryDirectory() as tempdir:
+            cfg = deepcopy(self.cfg.dense_config)
+            cfg.database_path = tempdir
+            retriever = DenseRetriever(cfg)
+            retriever.add_passages(corpus)
+
+            # the tombstones are excluded from the ground truth
+            query = retriever.query_encoder.encode(self.query)
+            indices, _ = retriever.exact_search(query, 10)
+            retriever.delete_passages([corpus[i]["id"] for i in indices[:, 0]])
+            new_indices, _ = retriever.exact_search(query, 10)
+            assert not np.isin(new_indices, retriever.tombstones).any()
+            assert (new_indices >= 0).all()
+        return
+
+    def test_dense_interrupted_purge(self, monkeypatch):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))[:1000]
+        deleted = [p["id"] for p in corpus[::7]]
+        with tempfile.TemporaryDirectory() as tempdir:
+            cfg = deepcopy(self.cfg.dense_config)
+            cfg.database_path = tempdir
+            cfg.purge_threshold = 1.0
+            retriever = DenseRetriever(cfg)
+            retriever.add_passages(corpus)
+            retriever.delete_passages(deleted)
+            expected = retriever.search(self.query, disable_cache=True)
+            expected = [[c.data["id"] for c in ctxs] for ctxs in expected]
+
+            # interrupt the purge after the first deletion of the database
+            retriever.write_batch_size = 16
+            delete = lance.LanceDataset.delete
+
+            def interrupted_delete(*args, **kwargs):
+                delete(*args, **kwargs)
+                raise RuntimeError("Interrupted.")
+
+            monkeypatch.setattr(lance.LanceDataset, "delete", interrupted_delete)
+            with pytest.raises(RuntimeError):
+                retriever.purge_deleted()
+            monkeypatch.undo()
+
+            # the database is rolled back in place and the tombstones are kept
+            assert len(retriever) == len(corpus)
+            assert len(retriever.tombstones) == len(deleted)
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == expected
+
+            # the database is rolled back and the tombstones are kept
+            retriever = DenseRetriever(cfg)
+            assert len(retriever) == len(corpus)
+            assert len(retriever.tombstones) == len(deleted)
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == expected
+
+            # interrupt the purge while removing the embeddings from the embedding store
+            def interrupted_remove(*args, **kwargs):
+                raise RuntimeError("Interrupted.")
+
+            retriever.embedding_store.prepare_remove = interrupted_remove
+            with pytest.raises(RuntimeError):
+                retriever.purge_deleted()
+
+            # the searches read the components before purging until they are swapped
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == expected
+
+            # the purge is resumed
+            retriever = DenseRetriever(cfg)
+            assert len(retriever) == len(corpus) - len(deleted)
+            assert len(retriever.index) == len(retriever)
+            assert len(retriever.embedding_store) == len(retriever)
+            assert len(retriever.tombstones) == 0
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == expected
+
+            # the index is rebuilt if it fails to remove the embeddings
+            retriever.delete_passages([p["id"] for p in corpus[1::7]])
+            retriever.index.remove_embeddings = interrupted_remove
+            retriever.purge_deleted()
+            assert not os.path.exists(retriever.purge_marker_path)
+            assert len(retriever.index) == len(retriever)
+            retriever = DenseRetriever(cfg)
+            assert len(retriever.index) == len(retriever)
+            assert len(retriever.tombstones) == 0
+        return
+
+    def test_dense_lazy_embedding_store(self):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))[:1000]
+        with tempfile.TemporaryDirectory() as tempdir:
+            cfg = deepcopy(self.cfg.dense_config)
+            cfg.database_path = tempdir
+            cfg.refine_factor = 4
+            retriever = DenseRetriever(cfg)
+            retriever.add_passages(corpus)
+            expected = retriever.search(self.query, disable_cache=True)
+            expected = [[c.data["id"] for c in ctxs] for ctxs in expected]
+
+            # loading the retriever does not build the embedding store
+            store_path = os.path.join(tempdir, "embeddings.bin")
+            os.remove(store_path)
+            retriever = DenseRetriever(cfg)
+            assert not os.path.exists(store_path)
+
+            # the embeddings are read from the database if the store can not be written
+            def failed_append(*args, **kwargs):
+                raise OSError("Read-only file system.")
+
+            retriever.embedding_store.append = failed_append
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == expected
+
+            # the store is built on the first use
+            retriever = DenseRetriever(cfg)
+            r = retriever.search(self.query, disable_cache=True)
+            assert [[c.data["id"] for c in ctxs] for ctxs in r] == expected
+            assert len(retriever.embedding_store) == len(retriever)
+        return
+
+    def test_dense_int8_index(self):
+        import faiss
+
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))[:1000]
+        with tempfile.TemporaryDirectory() as tempdir:
+            cfg = deepcopy(self.cfg.dense_config)
+            cfg.database_path = tempdir
+            cfg.embedding_precision = "int8"
+            retriever = DenseRetriever(cfg)
+            retriever.add_passages(corpus)
+
+            # the flat index stores the vectors with the 8-bit scalar quantizer
+            index = faiss.downcast_index(retriever.index.index)
+            assert isinstance(index, faiss.IndexScalarQuantizer)
+            r = retriever.search(self.query, disable_cache=True)
+            assert len(r[0]) == 10
+        return
+
+    def test_int8_quantizer(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal([2000, 768]).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        with tempfile.TemporaryDirectory() as tempdir:
+            # the embeddings added later are quantized with the ranges fitted on the first batch
+            quantizer = EmbeddingQuantizer(os.path.join(tempdir, "q"), "int8")
+            quantizer.fit(embeddings[:1000])
+            decoded = quantizer.decode(quantizer.encode(embeddings))
+
+            # the error is small relative to the spread of each dimension
+            error = np.abs(decoded - embeddings) / embeddings.std(axis=0)
+            assert error.max() < 0.05
+        return
+
     def test_bm25s_retriever(self):
         with tempfile.TemporaryDirectory() as tempdir:
             # load retriever
@@ -94,6 +295,67 @@ class TestRetrievers:
             assert len(r[1]) == 10
         return
 
+    def test_bm25s_add_passages(self):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))
+        with tempfile.TemporaryDirectory() as tempdir:
+            # build index from scratch
+            self.cfg.bm25s_config.database_path = os.path.join(tempdir, "full")
+            retriever = BM25SRetriever(self.cfg.bm25s_config)
+            retriever.add_passages(corpus)
+            r1 = retriever.search(self.query, disable_cache=True)
+
+            # build index incrementally
+            self.cfg.bm25s_config.database_path = os.path.join(tempdir, "incr")
+            retriever = BM25SRetriever(self.cfg.bm25s_config)
+            retriever.add_passages(corpus[: len(corpus) // 2])
+            retriever.add_passages(corpus[len(corpus) // 2 :])
+            retriever.merge_segments()
+            r2 = retriever.search(self.query, disable_cache=True)
+            assert len(retriever) == len(corpus)
+            for ctxs1, ctxs2 in zip(r1, r2):
+                assert [c.score for c in ctxs1] == pytest.approx(
+                    [c.score for c in ctxs2], rel=1e-4
+                )
+
+            # the database written ahead of the index is rolled back when reloading
+            lance.write_dataset(
+                pd.DataFrame(corpus[:10]),
+                uri=retriever.db_path,
+                mode="append",
+                schema=retriever.database.schema,
+            )
+            retriever = BM25SRetriever(self.cfg.bm25s_config)
+            assert retriever.database.count_rows() == len(corpus)
+            r3 = retriever.search(self.query, disable_cache=True)
+            for ctxs1, ctxs3 in zip(r1, r3):
+                assert [c.score for c in ctxs1] == pytest.approx(
+                    [c.score for c in ctxs3], rel=1e-4
+                )
+        return
+
+    def test_bm25s_migrate_legacy(self):
+        corpus = list(LineDelimitedDataset(self.cfg.corpus_path))
+        legacy_corpus = corpus[: len(corpus) // 2]
+        with tempfile.TemporaryDirectory() as tempdir:
+            # build an index with the layout of the previous versions
+            legacy = bm25s.BM25()
+            legacy.index(
+                bm25s.tokenize([p["text"] for p in legacy_corpus], stopwords="english")
+            )
+            legacy.save(tempdir, corpus=legacy_corpus)
+
+            # the legacy corpus is migrated when adding passages
+            self.cfg.bm25s_config.database_path = tempdir
+            retriever = BM25SRetriever(self.cfg.bm25s_config)
+            retriever.add_passages(corpus[len(corpus) // 2 :])
+            assert len(retriever) == len(corpus)
+            assert not os.path.exists(os.path.join(tempdir, "params.index.json"))
+            retriever = BM25SRetriever(self.cfg.bm25s_config)
+            assert len(retriever) == len(corpus)
+            r = retriever.search(self.query, disable_cache=True)
+            assert len(r[0]) == 10
+        return
+
     def test_elastic_retriever(self, setup_elastic):
         # load retriever
         retriever: ElasticRetriever = setup_elastic
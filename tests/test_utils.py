@@ -0,0 +1,102 @@
+import gc
+import random
+import threading
+import weakref
+from time import perf_counter
+
+from flexrag.utils import _LatencyHistogram, _TimeMeter
+
+
+class TestTimeMeter:
+    def test_percentile(self):
+        rng = random.Random(0)
+        latencies = [rng.lognormvariate(-7, 1.5) for _ in range(10000)]
+        hist = _LatencyHistogram()
+        for latency in latencies:
+            hist.record(latency)
+        assert hist.calls == len(latencies)
+        assert hist.max == max(latencies)
+
+        # the estimation is the upper bound of the bucket
+        latencies.sort()
+        for q in [1, 50, 90, 99, 100]:
+            expected = latencies[max(int(len(latencies) * q / 100) - 1, 0)]
+            estimated = hist.percentile(q)
+            assert expected <= estimated <= expected * (1 + 1 / hist.SUB_BUCKETS)
+        return
+
+    def test_merge(self):
+        rng = random.Random(0)
+        hist1 = _LatencyHistogram()
+        hist2 = _LatencyHistogram()
+        hist_all = _LatencyHistogram()
+        for n in range(1000):
+            latency = rng.expovariate(1000)
+            (hist1 if n % 3 else hist2).record(latency)
+            hist_all.record(latency)
+        hist1.merge(hist2)
+        assert hist1.counts == hist_all.counts
+        assert hist1.calls == hist_all.calls
+        assert abs(hist1.total - hist_all.total) < 1e-9
+        assert hist1.max == hist_all.max
+
+        # the histograms are restored from the snapshots of other processes
+        meter1 = _TimeMeter()
+        meter2 = _TimeMeter()
+        meter1("test", "merge")(lambda: None)()
+        meter2("test", "merge")(lambda: None)()
+        meter2.merge(meter1.snapshot())
+        assert meter2.timers[("test", "merge")].calls == 2
+        return
+
+    def test_fold_exited_threads(self):
+        meter = _TimeMeter()
+        func = meter("test", "thread")(lambda: None)
+
+        def worker():
+            for _ in range(10):
+                func()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gc.collect()
+
+        # the timers of the exited threads are folded into the merged recordings
+        assert len(meter._thread_timers) == 0
+        assert meter.timers[("test", "thread")].calls == 40
+        assert meter.statistics[0]["calls"] == 40
+        return
+
+    def test_release_meter(self):
+        # the meters are not kept alive by the fork hook
+        meter = _TimeMeter()
+        meter("test", "release")(lambda: None)()
+        ref = weakref.ref(meter)
+        del meter
+        gc.collect()
+        assert ref() is None
+        return
+
+    def test_overhead(self):
+        meter = _TimeMeter()
+
+        def func():
+            return
+
+        timed_func = meter("test", "overhead")(func)
+        num = 100000
+        start_time = perf_counter()
+        for _ in range(num):
+            func()
+        base_time = perf_counter() - start_time
+        start_time = perf_counter()
+        for _ in range(num):
+            timed_func()
+        timed_time = perf_counter() - start_time
+
+        # the overhead is about 1us per call, the bound only catches the pathological slowdowns
+        assert (timed_time - base_time) / num < 1e-4
+        return